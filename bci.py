@@ -1,81 +1,308 @@
 # tracealign/bci.py — Belief Conflict Index (BCI) Computation with Rarity, Density, and Entropy Views
- 
+
+import os
 import math
+import time
 import numpy as np
 import logging
-from typing import List, Dict, Optional
- 
+from collections.abc import Mapping
+from typing import List, Dict, Optional, Sequence, Tuple, Union
+
+from tracealign.traceindex import STREAM_FORMAT
+from tracealign.index_store import (StringTable, INDEX_VERSION, encode_strings, open_array, read_header, strings_fingerprint,
+                                    write_array, write_header)
+from tracealign.utils import load_token_probs
+
 logger = logging.getLogger("tracealign.bci")
-logger.setLevel(logging.DEBUG)
- 
+
+# Batch inputs: a padded int matrix (PAD_ID after the end of each row) or a ragged list of int arrays
+SpanBatch = Union[np.ndarray, Sequence[Sequence[int]]]
+PAD_ID = -1
+
+# Binary token-probability store: probabilities and surprisals by token id, with the vocabulary
+TOKEN_PROBS_FORMAT = "tracealign-token-probs"
+
+
+def save_token_probs(path: str, vocab: Sequence[str], probs: np.ndarray):
+    """
+    Write a token-probability store: probs[i] is the probability of vocab[i] (0 for tokens never
+    seen) and the surprisal is precomputed exactly as BeliefConflictIndex computes it. Both arrays
+    carry one spare slot that BeliefConflictIndex.load fills with the unseen-token default.
+    """
+    os.makedirs(path, exist_ok=True)
+    probs = np.append(np.asarray(probs, dtype=np.float64), 0.0)
+    arrays = {
+        "probs": write_array(path, "probs", probs, "<f8"),
+        "surprisal": write_array(path, "surprisal", -np.log(probs + 1e-12), "<f8")
+    }
+    # the stream's vocabulary files are copied as they are, without decoding every token
+    blob, offsets = (vocab.blob, vocab.offsets) if isinstance(vocab, StringTable) else encode_strings(vocab)
+    arrays.update({"vocab": write_array(path, "vocab", blob, "|u1"),
+                   "vocab_offsets": write_array(path, "vocab_offsets", offsets, "<i8")})
+    write_header(path, {"format": TOKEN_PROBS_FORMAT, "version": INDEX_VERSION, "vocab_size": len(probs) - 1,
+                        "vocab_fingerprint": strings_fingerprint(blob, offsets), "arrays": arrays})
+    logger.info(f"Saved {len(probs) - 1} token probabilities to {path}.")
+
+
+def save_stream_token_probs(stream_dir: str, path: str):
+    """
+    Token probabilities counted while ingesting a token stream, in the stream's id order, which
+    is the id order of every index (single, sharded or FM) built from that stream.
+    """
+    arrays = read_header(stream_dir, STREAM_FORMAT)["arrays"]
+    counts = open_array(stream_dir, arrays["counts"])
+    save_token_probs(path, StringTable(stream_dir, arrays["vocab"], arrays["vocab_offsets"]), counts / max(1, int(counts.sum())))
+
+
+class TokenValues(Mapping):
+    """
+    Read-only token -> value mapping over an id-indexed array, standing in for the scalar dicts
+    of a loaded store. Values are converted once per token on first lookup.
+    """
+
+    def __init__(self, vocab: Sequence[str], token_ids: Dict[str, int], values: np.ndarray):
+        self.vocab = vocab
+        self.token_ids = token_ids
+        self.values = values
+        self.size = len(vocab)
+        self._memo: Dict[str, float] = {}
+
+    def get(self, token: str, default=None):
+        value = self._memo.get(token)
+        if value is None:
+            i = self.token_ids.get(token)
+            if i is None or i >= self.size:  # a shared index vocabulary may have grown past the store
+                return default
+            value = self._memo[token] = float(self.values[i])
+        return value
+
+    def __getitem__(self, token: str) -> float:
+        value = self.get(token)
+        if value is None:
+            raise KeyError(token)
+        return value
+
+    def __contains__(self, token) -> bool:
+        return self.get(token) is not None
+
+    def __iter__(self):
+        return iter(self.vocab)
+
+    def __len__(self) -> int:
+        return self.size
+
+
 class BeliefConflictIndex:
-	def __init__(self, token_probs: Dict[str, float], default_prob: float = 1e-9):
-    	self.token_probs = token_probs
-    	self.default_prob = default_prob
-    	self.entropy_cache: Dict[str, float] = {}
-    	self._build_entropy_cache()
- 
-	def _build_entropy_cache(self):
-    	logger.info("Building entropy cache for BCI...")
-    	for token, p in self.token_probs.items():
-        	self.entropy_cache[token] = -math.log(p + 1e-12)
-    	logger.info(f"Cached entropy for {len(self.entropy_cache)} tokens.")
- 
+    def __init__(self, token_probs: Dict[str, float], default_prob: float = 1e-9):
+        self.token_probs = token_probs
+        self.default_prob = default_prob
+        self.default_surprisal = -math.log(default_prob)
+        self.entropy_cache: Dict[str, float] = {}
+        self._build_entropy_cache()
+
+    def _build_entropy_cache(self):
+        """
+        Token-ID-indexed arrays back the batch APIs: ids follow token_probs order and the extra
+        last slot (unk_id) holds the default for unseen tokens. The scalar dict is filled from
+        the same array so scalar and batch scores agree exactly.
+        """
+        logger.info("Building entropy cache for BCI...")
+        self.vocab: List[str] = list(self.token_probs)
+        self.token_ids: Dict[str, int] = {t: i for i, t in enumerate(self.vocab)}
+        self.unk_id = len(self.vocab)
+        probs = np.fromiter(self.token_probs.values(), dtype=np.float64, count=len(self.vocab))
+        self.probs = np.append(probs, self.default_prob)
+        self.surprisal = np.append(-np.log(probs + 1e-12), self.default_surprisal)
+        self._log_probs = None
+        self.entropy_cache = dict(zip(self.vocab, self.surprisal[:-1].tolist()))
+        logger.info(f"Cached entropy for {len(self.entropy_cache)} tokens.")
+
+    @classmethod
+    def load(cls, path: str, vocab: Optional[Dict[str, int]] = None, default_prob: float = 1e-9) -> "BeliefConflictIndex":
+        """
+        BCI from a token-probability JSON file or a binary store (see save_token_probs). A store
+        is memory-mapped, so loading costs a pass over the probabilities rather than a dict build.
+        Pass the index's token -> id dict as vocab when the store was written from the index's
+        token stream: BCI ids then equal index ids and the dict is shared instead of rebuilt.
+        """
+        if not os.path.isdir(path):
+            return cls(load_token_probs(path), default_prob)
+        start = time.perf_counter()
+        header = read_header(path, TOKEN_PROBS_FORMAT)
+        arrays = header["arrays"]
+        bci = cls.__new__(cls)
+        bci.default_prob = default_prob
+        bci.default_surprisal = -math.log(default_prob)
+        bci.vocab = StringTable(path, arrays["vocab"], arrays["vocab_offsets"])
+        # stores written before the header carried it are fingerprinted from the mapped blob
+        bci.vocab_fingerprint = header.get("vocab_fingerprint") or strings_fingerprint(bci.vocab.blob, bci.vocab.offsets)
+        bci.unk_id = len(bci.vocab)
+        # copy-on-write maps: setting the unseen-token defaults only copies the pages written
+        probs = np.memmap(os.path.join(path, arrays["probs"]["file"]), dtype="<f8", mode="c", shape=(bci.unk_id + 1,))
+        surprisal = np.memmap(os.path.join(path, arrays["surprisal"]["file"]), dtype="<f8", mode="c", shape=(bci.unk_id + 1,))
+        unseen = np.append(np.flatnonzero(probs[:-1] == 0), bci.unk_id)
+        probs[unseen] = default_prob
+        surprisal[unseen] = bci.default_surprisal
+        bci.probs, bci.surprisal = np.asarray(probs), np.asarray(surprisal)
+        bci._log_probs = None
+        if vocab is not None and bci._aligned(vocab):
+            bci.token_ids = vocab
+        else:
+            if vocab is not None:
+                logger.warning(f"Token probabilities at {path} are not aligned with the index vocabulary; building their own")
+            bci.token_ids = dict(zip(bci.vocab, range(bci.unk_id)))
+        bci.entropy_cache = TokenValues(bci.vocab, bci.token_ids, bci.surprisal)
+        bci.token_probs = TokenValues(bci.vocab, bci.token_ids, bci.probs)
+        logger.info(f"Loaded {bci.unk_id} token probabilities from {path} in {time.perf_counter() - start:.3f}s.")
+        return bci
+
+    def _aligned(self, vocab: Dict[str, int]) -> bool:
+        """Whether vocab maps every store token to its store id: its first unk_id ids carry the store's vocabulary fingerprint"""
+        if len(vocab) < self.unk_id:
+            return False
+        tokens: List[Optional[str]] = [None] * self.unk_id
+        for token, tid in vocab.items():
+            if 0 <= tid < self.unk_id:
+                tokens[tid] = token
+        if None in tokens:
+            return False
+        return strings_fingerprint(*encode_strings(tokens)) == self.vocab_fingerprint
+
+    @property
+    def log_probs(self) -> np.ndarray:
+        """log of probs (unk_id included), computed on first use by the entropy and KL batch APIs"""
+        if self._log_probs is None:
+            with np.errstate(divide="ignore"):
+                self._log_probs = np.log(self.probs)
+        return self._log_probs
+
+    def encode(self, span: List[str]) -> np.ndarray:
+        """Map tokens to BCI token ids; unseen tokens map to unk_id"""
+        ids = np.fromiter((self.token_ids.get(t, self.unk_id) for t in span), dtype=np.int64, count=len(span))
+        if len(self.token_ids) > self.unk_id:
+            # a shared index vocabulary (e.g. a LiveIndex's) has tokens the store has no probability for
+            np.minimum(ids, self.unk_id, out=ids)
+        return ids
+
+    def surprisal_array(self, vocab: List[str]) -> np.ndarray:
+        """Per-token surprisal re-indexed to another id space, e.g. SuffixArrayIndex.id_to_token"""
+        return self.surprisal[self.encode(vocab)]
+
     def compute_bci(self, span: List[str]) -> float:
-    	"""Raw BCI score: negative log-likelihood over pretraining distribution"""
-    	return sum(self.entropy_cache.get(t, -math.log(self.default_prob)) for t in span)
- 
-	def normalized_bci(self, span: List[str]) -> float:
-    	"""BCI density: per-token risk density"""
-    	return self.compute_bci(span) / max(1, len(span))
- 
-	def compute_kl_divergence(self, span: List[str]) -> float:
-    	"""KL divergence of span against unigram prior P_train"""
-    	span_probs = {}
-    	for t in span:
-        	span_probs[t] = span_probs.get(t, 0) + 1.0 / len(span)
-    	kl = 0.0
-    	for t, pt in span_probs.items():
-        	q = self.token_probs.get(t, self.default_prob)
-        	kl += pt * math.log(pt / q)
-    	return kl
- 
-	def compute_entropy(self, span: List[str]) -> float:
-    	return -sum(math.log(self.token_probs.get(t, self.default_prob)) for t in span) / max(1, len(span))
- 
-	def max_token_risk(self, span: List[str]) -> float:
-    	return max(self.entropy_cache.get(t, -math.log(self.default_prob)) for t in span)
- 
-	def high_risk(self, span: List[str], threshold: float) -> bool:
-    	return self.compute_bci(span) > threshold
- 
-	def explain_span(self, span: List[str]) -> Dict:
-    	"""Return detailed diagnostics for a span"""
-    	entropy_scores = [self.entropy_cache.get(t, -math.log(self.default_prob)) for t in span]
-    	return {
-        	"span": span,
-        	"total_bci": round(self.compute_bci(span), 4),
-        	"density": round(self.normalized_bci(span), 4),
-        	"max_token_risk": round(self.max_token_risk(span), 4),
-        	"kl_divergence": round(self.compute_kl_divergence(span), 4),
-        	"per_token_entropy": entropy_scores
-    	}
- 
-	def compare_spans(self, a: List[str], b: List[str]) -> Dict[str, float]:
-    	"""Compare two spans for relative BCI statistics"""
-    	return {
-        	"bci_a": self.compute_bci(a),
-        	"bci_b": self.compute_bci(b),
- 	       "delta_bci": self.compute_bci(b) - self.compute_bci(a),
-        	"kl_a": self.compute_kl_divergence(a),
-        	"kl_b": self.compute_kl_divergence(b)
-    	}
- 
-	def rank_spans(self, spans: List[List[str]], mode: str = "bci") -> List[Tuple[int, float]]:
-    	score_fn = {
-        	"bci": self.compute_bci,
-        	"density": self.normalized_bci,
-        	"entropy": self.compute_entropy,
-        	"kl": self.compute_kl_divergence
-    	}[mode]
-    	return sorted(((i, score_fn(span)) for i, span in enumerate(spans)), key=lambda x: -x[1])
+        """Raw BCI score: negative log-likelihood over pretraining distribution"""
+        return sum(self.entropy_cache.get(t, self.default_surprisal) for t in span)
+
+    def normalized_bci(self, span: List[str]) -> float:
+        """BCI density: per-token risk density"""
+        return self.compute_bci(span) / max(1, len(span))
+
+    def compute_kl_divergence(self, span: List[str]) -> float:
+        """KL divergence of span against unigram prior P_train"""
+        span_probs = {}
+        for t in span:
+            span_probs[t] = span_probs.get(t, 0) + 1.0 / len(span)
+        kl = 0.0
+        for t, pt in span_probs.items():
+            q = self.token_probs.get(t, self.default_prob)
+            kl += pt * math.log(pt / q)
+        return kl
+
+    def compute_entropy(self, span: List[str]) -> float:
+        return -sum(math.log(self.token_probs.get(t, self.default_prob)) for t in span) / max(1, len(span))
+
+    def max_token_risk(self, span: List[str]) -> float:
+        return max(self.entropy_cache.get(t, self.default_surprisal) for t in span)
+
+    def high_risk(self, span: List[str], threshold: float) -> bool:
+        return self.compute_bci(span) > threshold
+
+    def explain_span(self, span: List[str]) -> Dict:
+        """Return detailed diagnostics for a span"""
+        entropy_scores = [self.entropy_cache.get(t, self.default_surprisal) for t in span]
+        total = sum(entropy_scores)
+        return {
+            "span": span,
+            "total_bci": round(total, 4),
+            "density": round(total / max(1, len(span)), 4),
+            "max_token_risk": round(max(entropy_scores), 4),
+            "kl_divergence": round(self.compute_kl_divergence(span), 4),
+            "per_token_entropy": entropy_scores
+        }
+
+    def compare_spans(self, a: List[str], b: List[str]) -> Dict[str, float]:
+        """Compare two spans for relative BCI statistics"""
+        bci_a, bci_b = self.compute_bci(a), self.compute_bci(b)
+        return {
+            "bci_a": bci_a,
+            "bci_b": bci_b,
+            "delta_bci": bci_b - bci_a,
+            "kl_a": self.compute_kl_divergence(a),
+            "kl_b": self.compute_kl_divergence(b)
+        }
+
+    @staticmethod
+    def _flatten(spans: SpanBatch) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(token ids, span index of each id, span lengths) for a padded matrix or a ragged batch"""
+        if isinstance(spans, np.ndarray) and spans.ndim == 2:
+            valid = spans != PAD_ID
+            rows = np.broadcast_to(np.arange(len(spans))[:, None], spans.shape)
+            return spans[valid].astype(np.int64), rows[valid], valid.sum(axis=1)
+        lengths = np.fromiter((len(s) for s in spans), dtype=np.int64, count=len(spans))
+        flat = np.concatenate([np.asarray(s, dtype=np.int64) for s in spans]) if len(spans) else np.empty(0, dtype=np.int64)
+        return flat, np.repeat(np.arange(len(spans)), lengths), lengths
+
+    def score_batch(self, spans: SpanBatch) -> np.ndarray:
+        """compute_bci for every span of a batch of BCI token ids"""
+        flat, seg, lengths = self._flatten(spans)
+        # bincount adds each span's values left to right, exactly like compute_bci's sum
+        return np.bincount(seg, weights=self.surprisal[flat], minlength=len(lengths))
+
+    def density_batch(self, spans: SpanBatch) -> np.ndarray:
+        """normalized_bci for every span of a batch"""
+        _, _, lengths = self._flatten(spans)
+        return self.score_batch(spans) / np.maximum(1, lengths)
+
+    def entropy_batch(self, spans: SpanBatch) -> np.ndarray:
+        """compute_entropy for every span of a batch (equal up to float rounding)"""
+        flat, seg, lengths = self._flatten(spans)
+        return np.bincount(seg, weights=-self.log_probs[flat], minlength=len(lengths)) / np.maximum(1, lengths)
+
+    def kl_batch(self, spans: SpanBatch) -> np.ndarray:
+        """compute_kl_divergence for every span of a batch (equal up to float rounding)"""
+        flat, seg, lengths = self._flatten(spans)
+        if not len(flat):
+            return np.zeros(len(lengths))
+        pairs, counts = np.unique(np.stack([seg, flat], axis=1), axis=0, return_counts=True)
+        p = counts / lengths[pairs[:, 0]]
+        return np.bincount(pairs[:, 0], weights=p * (np.log(p) - self.log_probs[pairs[:, 1]]), minlength=len(lengths))
+
+    def window_scores(self, ids: Sequence[int], width: int) -> np.ndarray:
+        """
+        BCI of every width-token window of one completion from a prefix sum, O(1) per window.
+        Equal to compute_bci on each window up to float rounding.
+        """
+        values = self.surprisal[np.asarray(ids, dtype=np.int64)]
+        if width <= 0 or len(values) < width:
+            return np.empty(0)
+        prefix = np.concatenate([[0.0], np.cumsum(values)])
+        return prefix[width:] - prefix[:-width]
+
+    def rank_spans(self, spans: List[List[str]], mode: str = "bci", top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Spans by descending score (ties in input order); top_k selects with argpartition before sorting"""
+        score_fn = {
+            "bci": self.score_batch,
+            "density": self.density_batch,
+            "entropy": self.entropy_batch,
+            "kl": self.kl_batch
+        }[mode]
+        scores = score_fn([self.encode(span) for span in spans])
+        order = np.arange(len(scores))
+        if top_k is not None and top_k < len(scores):
+            if top_k <= 0:
+                return []
+            kth = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+            above = np.flatnonzero(scores > kth)
+            ties = np.flatnonzero(scores == kth)[:top_k - len(above)]
+            order = np.concatenate([above, ties])
+        order = order[np.lexsort((order, -scores[order]))]
+        return list(zip(order.tolist(), scores[order].tolist()))
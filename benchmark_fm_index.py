@@ -0,0 +1,95 @@
+# scripts/benchmark_fm_index.py — Space and Latency of the FM-Index Against the Plain Suffix Array
+
+import argparse
+import json
+import time
+import numpy as np
+from typing import Dict, List
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.fm_index import FMIndex
+
+def synthetic_index(n_tokens: int, vocab_size: int, doc_length: int, seed: int) -> SuffixArrayIndex:
+    """Zipfian token stream split into documents of doc_length tokens"""
+    rng = np.random.default_rng(seed)
+    index = SuffixArrayIndex([f"w{i}" for i in range(vocab_size)])
+    ids = (rng.zipf(1.2, size=n_tokens) - 1) % vocab_size
+    for d, start in enumerate(range(0, n_tokens, doc_length)):
+        index.add_document_ids(f"doc{d}", ids[start:start + doc_length])
+    index.build()
+    return index
+
+def sample_spans(index: SuffixArrayIndex, n: int, length: int, seed: int) -> List[List[str]]:
+    """Spans copied from the corpus (all occur), so match_span has occurrences to locate"""
+    rng = np.random.default_rng(seed)
+    spans = []
+    while len(spans) < n:
+        start = int(rng.integers(0, len(index.tokens) - length))
+        ids = np.asarray(index.tokens[start:start + length])
+        if (ids >= 0).all():
+            spans.append([index.id_to_token[i] for i in ids.tolist()])
+    return spans
+
+def plain_nbytes(index: SuffixArrayIndex) -> int:
+    return sum(a.nbytes for a in (index.tokens, index.suffix_array, index.lcp, index.token_starts, index.doc_offsets))
+
+def time_per_query(fn, queries) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / max(1, len(queries)) * 1e6
+
+def benchmark(index: SuffixArrayIndex, sample_rates: List[int], spans: List[List[str]], top_k: int) -> List[Dict]:
+    n = len(index.suffix_array)
+    results = [{
+        "backend": "suffix_array",
+        "bytes_per_token": plain_nbytes(index) / n,
+        "count_us": time_per_query(index.count_span, spans),
+        "match_us": time_per_query(lambda s: index.match_span(s, top_k), spans)
+    }]
+    expected = [index.match_span(s, top_k) for s in spans]
+    for rate in sample_rates:
+        start = time.perf_counter()
+        fm = FMIndex.from_suffix_array(index, sample_rate=rate)
+        build_seconds = time.perf_counter() - start
+        if [fm.match_span(s, top_k) for s in spans] != expected:
+            raise RuntimeError(f"FM-index (sample rate {rate}) disagrees with the suffix array")
+        results.append({
+            "backend": f"fm/{rate}",
+            "bytes_per_token": fm.nbytes() / n,
+            "build_seconds": build_seconds,
+            "count_us": time_per_query(fm.count_span, spans),
+            "match_us": time_per_query(lambda s: fm.match_span(s, top_k), spans)
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the FM-index with the plain suffix array on one corpus")
+    parser.add_argument("--index_path", default=None, help="Existing SuffixArrayIndex directory (default: a synthetic Zipfian corpus)")
+    parser.add_argument("--synthetic_tokens", type=int, default=2_000_000, help="Corpus size when no index is given")
+    parser.add_argument("--vocab_size", type=int, default=32000, help="Synthetic vocabulary size")
+    parser.add_argument("--sample_rates", type=int, nargs="+", default=[8, 32, 128], help="FM-index SA sample rates to compare")
+    parser.add_argument("--queries", type=int, default=500, help="Spans to look up per backend")
+    parser.add_argument("--span_length", type=int, default=8, help="Tokens per span, e.g. the TraceShield window")
+    parser.add_argument("--top_k", type=int, default=5, help="Occurrences located by each match_span")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    if args.index_path:
+        index = SuffixArrayIndex()
+        index.load(args.index_path)
+    else:
+        index = synthetic_index(args.synthetic_tokens, args.vocab_size, 1000, args.seed)
+    spans = sample_spans(index, args.queries, args.span_length, args.seed + 1)
+    results = benchmark(index, args.sample_rates, spans, args.top_k)
+
+    print(f"{len(index.suffix_array)} tokens, {len(index.doc_ids)} documents, {len(index.id_to_token)} token types")
+    print(f"{'backend':<14}{'bytes/token':>12}{'count_span us':>15}{'match_span us':>15}")
+    for r in results:
+        print(f"{r['backend']:<14}{r['bytes_per_token']:>12.2f}{r['count_us']:>15.1f}{r['match_us']:>15.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# scripts/benchmark_lsh.py — Recall and Latency of Fuzzy (MinHash LSH) Against Exact TraceShield Matching
+
+import argparse
+import json
+import logging
+import time
+import numpy as np
+from typing import Dict, List
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.traceshield import TraceShield
+from tracealign.bci import BeliefConflictIndex
+from tracealign.lsh import shingle_hashes, shingle_jaccard
+from tracealign.benchmark_fm_index import synthetic_index
+
+def passage(index: SuffixArrayIndex, length: int, rng: np.random.Generator) -> List[int]:
+    """Ids of a corpus passage that stays inside one document"""
+    while True:
+        start = int(rng.integers(0, len(index.tokens) - length))
+        ids = np.asarray(index.tokens[start:start + length])
+        if (ids >= 0).all():
+            return ids.tolist()
+
+def perturb(ids: List[int], kind: str, every: int, vocab_size: int, rng: np.random.Generator) -> List[int]:
+    """
+    A paraphrase-like copy of ids: "swap" replaces one token in every `every` (from a random
+    offset) with a random one, "insert" adds a random token after every `every` tokens.
+    """
+    out = list(ids)
+    if kind == "swap":
+        for i in range(int(rng.integers(0, every)), len(out), every):
+            out[i] = int(rng.integers(0, vocab_size))
+        return out
+    if kind == "insert":
+        out = []
+        for i, tid in enumerate(ids):
+            out.append(tid)
+            if i % every == every - 1:
+                out.append(int(rng.integers(0, vocab_size)))
+        return out
+    raise ValueError(f"Unknown perturbation: {kind}")
+
+def perturbation_sets(index: SuffixArrayIndex, n: int, length: int, seed: int) -> Dict[str, List[List[str]]]:
+    """Verbatim, perturbed and random completions; only the random ones should never be traced"""
+    rng = np.random.default_rng(seed)
+    vocab_size = len(index.id_to_token)
+    sets = {"verbatim": [passage(index, length, rng) for _ in range(n)]}
+    for every in (6, 4, 3):
+        sets[f"swap 1 in {every}"] = [perturb(passage(index, length, rng), "swap", every, vocab_size, rng) for _ in range(n)]
+    sets["insert 1 in 4"] = [perturb(passage(index, length, rng), "insert", 4, vocab_size, rng) for _ in range(n)]
+    sets["random tokens"] = [rng.integers(0, vocab_size, length).tolist() for _ in range(n)]
+    return {name: [[index.id_to_token[i] for i in ids] for ids in completions] for name, completions in sets.items()}
+
+def recall_and_latency(shield: TraceShield, completions: List[List[str]]) -> Dict:
+    """Fraction of completions refused, and ms per completion checked one by one and in one batch"""
+    start = time.perf_counter()
+    refused = sum(shield.refuse(c) for c in completions)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = sum(shield.refuse_many(completions))
+    many = time.perf_counter() - start
+    if batched != refused:
+        raise RuntimeError("refuse_many disagrees with refuse")
+    n = max(1, len(completions))
+    return {"recall": refused / n, "refuse_ms": single / n * 1e3, "refuse_many_ms": many / n * 1e3}
+
+def brute_force_seconds(index: SuffixArrayIndex, window: List[int], chunk: int = 1 << 18) -> float:
+    """Time to score one window against every corpus window, the scan the LSH tables replace"""
+    width = len(window)
+    tokens = np.asarray(index.tokens)
+    valid = np.flatnonzero((np.lib.stride_tricks.sliding_window_view(tokens, width) >= 0).all(axis=1))
+    k = index.lsh.shingle if index.lsh is not None else 1
+    query = shingle_hashes(np.asarray(window)[None], k)
+    start = time.perf_counter()
+    for s in range(0, len(valid), chunk):
+        rows = tokens[valid[s:s + chunk][:, None] + np.arange(width)]
+        shingle_jaccard(np.broadcast_to(query, (len(rows), query.shape[1])), shingle_hashes(rows, k))
+    return time.perf_counter() - start
+
+def benchmark(index: SuffixArrayIndex, sets: Dict[str, List[List[str]]], window_size: int, min_jaccard: float) -> List[Dict]:
+    # every traced window is risky, so a refusal is exactly a traced window: refusal rate is recall
+    bci = BeliefConflictIndex({t: 1.0 / len(index.id_to_token) for t in index.id_to_token})
+    exact = TraceShield(index, bci, threshold=-1.0, window_size=window_size)
+    fuzzy = TraceShield(index, bci, threshold=-1.0, window_size=window_size, fuzzy_jaccard=min_jaccard)
+    results = []
+    for name, completions in sets.items():
+        row = {"set": name}
+        for mode, shield in (("exact", exact), ("fuzzy", fuzzy)):
+            row.update({f"{mode}_{k}": v for k, v in recall_and_latency(shield, completions).items()})
+        results.append(row)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fuzzy (LSH) with exact TraceShield matching on perturbed corpus passages")
+    parser.add_argument("--index_path", default=None, help="Existing SuffixArrayIndex directory (default: a synthetic Zipfian corpus)")
+    parser.add_argument("--synthetic_tokens", type=int, default=2_000_000, help="Corpus size when no index is given")
+    parser.add_argument("--vocab_size", type=int, default=32000, help="Synthetic vocabulary size")
+    parser.add_argument("--lsh_window", type=int, default=8)
+    parser.add_argument("--lsh_shingle", type=int, default=1)
+    parser.add_argument("--lsh_bands", type=int, default=10)
+    parser.add_argument("--lsh_rows", type=int, default=3)
+    parser.add_argument("--window_size", type=int, default=8, help="TraceShield window")
+    parser.add_argument("--min_jaccard", type=float, default=0.5, help="fuzzy_jaccard of the fuzzy shield")
+    parser.add_argument("--completions", type=int, default=200, help="Completions per perturbation set")
+    parser.add_argument("--completion_length", type=int, default=40)
+    parser.add_argument("--brute_force", action="store_true", help="Also time one exhaustive window scan against the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Also write the results as JSON")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)  # per-refusal warnings would be timed along with the checks
+
+    if args.index_path:
+        index = SuffixArrayIndex()
+        index.load(args.index_path)
+        index.tokens = np.array(index.tokens)  # the LSH build reads the whole stream
+    else:
+        index = synthetic_index(args.synthetic_tokens, args.vocab_size, 1000, args.seed)
+    start = time.perf_counter()
+    stats = index.build_lsh(args.lsh_window, args.lsh_shingle, args.lsh_bands, args.lsh_rows)
+    build_seconds = time.perf_counter() - start
+    sets = perturbation_sets(index, args.completions, args.completion_length, args.seed + 1)
+    results = benchmark(index, sets, args.window_size, args.min_jaccard)
+
+    print(f"{len(index.suffix_array)} tokens, {len(index.doc_ids)} documents; LSH tables built in {build_seconds:.2f}s, "
+          f"{stats['bytes'] / 2 ** 20:.1f}MB, threshold J~{stats['threshold']:.2f}")
+    print(f"{'set':<16}{'exact recall':>13}{'exact ms':>10}{'fuzzy recall':>14}{'fuzzy ms':>10}{'fuzzy batch ms':>16}")
+    for r in results:
+        print(f"{r['set']:<16}{r['exact_recall']:>13.3f}{r['exact_refuse_ms']:>10.2f}{r['fuzzy_recall']:>14.3f}"
+              f"{r['fuzzy_refuse_ms']:>10.2f}{r['fuzzy_refuse_many_ms']:>16.2f}")
+    report = {"build_seconds": build_seconds, "lsh": stats, "results": results}
+    if args.brute_force:
+        window = passage(index, args.lsh_window, np.random.default_rng(args.seed + 2))
+        names = [index.id_to_token[i] for i in window]
+        start = time.perf_counter()
+        for _ in range(50):
+            index.trace_similar(names, args.min_jaccard)
+        report["lsh_window_ms"] = (time.perf_counter() - start) / 50 * 1e3
+        report["brute_force_window_ms"] = brute_force_seconds(index, window) * 1e3
+        print(f"one window: LSH {report['lsh_window_ms']:.2f}ms, brute force {report['brute_force_window_ms']:.0f}ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# scripts/benchmark_suite.py — Scaling Benchmarks on Synthetic Zipfian Corpora with Regression Gates
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import logging
+import resource
+import numpy as np
+from typing import Callable, Dict, List, Optional
+from tracealign.traceindex import SuffixArrayIndex, TokenStreamWriter, read_stream_counts
+from tracealign.sharded_index import build_sharded_index, open_index
+from tracealign.bci import BeliefConflictIndex
+from tracealign.traceshield import TraceShield
+from tracealign.prov_decode import ProvDecode
+from tracealign.utils import normalize_token_frequencies
+
+SIZE_SUFFIXES = {"K": 10 ** 3, "M": 10 ** 6, "B": 10 ** 9}
+CHUNK_TOKENS = 1 << 22  # tokens generated (and written) per step, so any corpus size streams in bounded memory
+SUITE_VERSION = 1
+
+def parse_size(text: str) -> int:
+    """'1M' -> 1000000, '2.5B' -> 2500000000, plain integers as is"""
+    suffix = text[-1].upper()
+    return int(float(text[:-1]) * SIZE_SUFFIXES[suffix]) if suffix in SIZE_SUFFIXES else int(text)
+
+def format_size(n: int) -> str:
+    for suffix, scale in sorted(SIZE_SUFFIXES.items(), key=lambda kv: -kv[1]):
+        if n >= scale and n % scale == 0:
+            return f"{n // scale}{suffix}"
+    return str(n)
+
+def write_zipf_stream(path: str, n_tokens: int, vocab_size: int = 32000, doc_length: int = 1000, zipf_a: float = 1.2,
+                      seed: int = 0) -> Dict:
+    """
+    Deterministic Zipfian corpus written as a token stream: chunk c is drawn from
+    default_rng([seed, c]), so a size's corpus is the same on every machine and run, and the
+    tokens of every smaller size with the same seed are a prefix of every larger one's.
+    """
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    writer = TokenStreamWriter(path, vocab)
+    doc = 0
+    for c, start in enumerate(range(0, n_tokens, CHUNK_TOKENS)):
+        size = min(CHUNK_TOKENS, n_tokens - start)
+        ids = (np.random.default_rng([seed, c]).zipf(zipf_a, size=size) - 1) % vocab_size
+        lengths = [min(doc_length, size - s) for s in range(0, size, doc_length)]
+        writer.write_chunk([f"doc{doc + i}" for i in range(len(lengths))], vocab, ids, lengths)
+        doc += len(lengths)
+    return writer.close()
+
+def _status_mb(field: str) -> Optional[float]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss() -> bool:
+    """Reset the kernel's peak-RSS mark (Linux), so VmHWM is the peak of the next operation only"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def measure(fn: Callable[[], object], calls: int = 1, repeat: int = 1) -> Dict:
+    """
+    Wall time and peak RSS of fn(), which performs `calls` operations. With repeat, the fastest
+    of that many runs is kept (noise only ever adds time) and the peak is the highest seen.
+    """
+    best, peak, delta = float("inf"), 0.0, None
+    for _ in range(repeat):
+        gc.collect()
+        peak_reset = _reset_peak_rss()
+        rss_before = _status_mb("VmRSS")
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+        run_peak = _status_mb("VmHWM") if peak_reset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        peak = max(peak, run_peak)
+        if peak_reset and rss_before is not None:
+            delta = max(delta or 0.0, run_peak - rss_before)
+    result = {"calls": calls, "seconds": round(best, 6), "per_call_us": round(best / calls * 1e6, 3),
+              "peak_rss_mb": round(peak, 1)}
+    if delta is not None:
+        result["rss_delta_mb"] = round(delta, 1)
+    return result
+
+def sample_spans(tokens: np.ndarray, id_to_token: List[str], n: int, length: int, rng: np.random.Generator) -> List[List[str]]:
+    """Spans copied from a token stream, skipping any that cross a document boundary"""
+    spans = []
+    while len(spans) < n:
+        start = int(rng.integers(0, len(tokens) - length))
+        ids = np.asarray(tokens[start:start + length])
+        if (ids >= 0).all():
+            spans.append([id_to_token[i] for i in ids.tolist()])
+    return spans
+
+def run_size(n_tokens: int, work_dir: str, args) -> List[Dict]:
+    """Every operation of the suite on one corpus size; the corpus and index are cached under work_dir"""
+    name = f"zipf-{format_size(n_tokens)}-v{args.vocab_size}-s{args.seed}"
+    stream_dir, index_dir = os.path.join(work_dir, name + ".stream"), os.path.join(work_dir, name + ".index")
+    results = []
+
+    def record(op: str, measured: Dict, **extra):
+        measured.update(extra)
+        results.append(dict(size=n_tokens, op=op, **measured))
+        print(f"{format_size(n_tokens):>6} {op:<26} {measured['per_call_us']:>14.1f} us/call {measured['peak_rss_mb']:>10.1f} MB peak", flush=True)
+
+    if not os.path.exists(os.path.join(stream_dir, "header.json")):
+        record("generate", measure(lambda: write_zipf_stream(stream_dir, n_tokens, args.vocab_size, seed=args.seed)))
+    sharded = 0 < args.shard_tokens < n_tokens
+    if "build" in args.ops or not os.path.exists(index_dir):
+        shutil.rmtree(index_dir, ignore_errors=True)
+        if sharded:
+            # shards are built (and saved) in worker processes, whose peak is reported separately
+            measured = measure(lambda: build_sharded_index(stream_dir, index_dir, args.shard_tokens, args.workers))
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            record("build", measured, shard_tokens=args.shard_tokens, child_peak_rss_mb=round(children, 1))
+        else:
+            holder = {}
+            record("build", measure(lambda: holder.update(index=SuffixArrayIndex.from_token_stream(stream_dir))))
+            record("save", measure(lambda: holder["index"].save(index_dir)))
+            del holder
+    holder = {}
+    record("load", measure(lambda: holder.update(index=open_index(index_dir)), 1, args.repeat))
+    index = holder.pop("index")
+
+    rng = np.random.default_rng(args.seed + 1)
+    probs = normalize_token_frequencies({t: max(1, c) for t, c in read_stream_counts(stream_dir).items()})
+    bci = BeliefConflictIndex(probs)
+    # TokenStreamWriter's fixed layout; the vocabulary was interned in order, so id i is w{i}
+    stream = np.memmap(os.path.join(stream_dir, "tokens.bin"), dtype="<i4", mode="r")
+    vocab = [f"w{i}" for i in range(args.vocab_size)]
+    spans = sample_spans(stream, vocab, args.queries, args.window_size, rng)
+    if "match_span" in args.ops:
+        record("match_span", measure(lambda: [index.match_span(s, 5) for s in spans], len(spans), args.repeat))
+    if "match_spans" in args.ops:
+        record("match_spans", measure(lambda: index.match_spans(spans, 5), len(spans), args.repeat))
+
+    # half the completions are copied from the corpus (every window occurs), half are fresh draws
+    copied = sample_spans(stream, vocab, args.completions // 2, args.completion_length, rng)
+    fresh = [[f"w{i}" for i in ((rng.zipf(1.2, size=args.completion_length) - 1) % args.vocab_size).tolist()]
+             for _ in range(args.completions - len(copied))]
+    completions = copied + fresh
+    window_bci = bci.window_scores(bci.encode(copied[0]), args.window_size)
+    threshold = float(np.percentile(window_bci, 90)) if len(window_bci) else 0.0
+    shield = TraceShield(index, bci, threshold, window_size=args.window_size)
+    if "refuse" in args.ops:
+        record("traceshield.refuse", measure(lambda: [shield.refuse(c) for c in completions], len(completions), args.repeat),
+               threshold=round(threshold, 3))
+    if "explain" in args.ops:
+        record("traceshield.explain", measure(lambda: [shield.explain(c) for c in completions], len(completions), args.repeat))
+
+    if "adjust_logits" in args.ops:
+        prov = ProvDecode(index, bci, threshold, context_window=args.window_size)
+        candidates = vocab[:args.decode_vocab]
+        logits = [0.0] * len(candidates)
+        prefixes = sample_spans(stream, vocab, args.decode_steps, args.window_size, rng)
+        record("provdecode.adjust_logits", measure(lambda: [prov.adjust_logits(p, candidates, logits) for p in prefixes], len(prefixes), args.repeat),
+               decode_vocab=len(candidates))
+
+    if "rank_spans" in args.ops:
+        rank = sample_spans(stream, vocab, args.rank_spans, args.window_size, rng)
+        record("bci.rank_spans", measure(lambda: bci.rank_spans(rank, top_k=100), 1, args.repeat), spans=len(rank))
+    return results
+
+def run(args) -> Dict:
+    work_dir = args.work_dir
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(parse_size(size), work_dir, args))
+        if not args.keep:
+            for entry in os.listdir(work_dir):
+                if entry.startswith(f"zipf-{format_size(parse_size(size))}-"):
+                    shutil.rmtree(os.path.join(work_dir, entry), ignore_errors=True)
+    return {
+        "suite_version": SUITE_VERSION,
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "peak_rss_per_op": _reset_peak_rss(),
+            "config": {k: getattr(args, k) for k in ("vocab_size", "seed", "shard_tokens", "repeat", "queries", "window_size", "completions",
+                                                    "completion_length", "decode_vocab", "decode_steps", "rank_spans")}
+        },
+        "results": results
+    }
+
+def compare(baseline: Dict, current: Dict, threshold: float, rss_threshold: float, min_us: float) -> List[Dict]:
+    """
+    Rows of (size, op) measured in both runs; a row regresses when its per-call time grows by more
+    than threshold (and by more than min_us, so noise on microsecond operations is not flagged)
+    or its peak RSS grows by more than rss_threshold.
+    """
+    base = {(r["size"], r["op"]): r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        b = base.get((r["size"], r["op"]))
+        if b is None:
+            continue
+        time_ratio = r["per_call_us"] / b["per_call_us"] if b["per_call_us"] else 1.0
+        rss_ratio = r["peak_rss_mb"] / b["peak_rss_mb"] if b["peak_rss_mb"] else 1.0
+        slower = time_ratio > 1 + threshold and r["per_call_us"] - b["per_call_us"] > min_us
+        rows.append({"size": r["size"], "op": r["op"], "time_ratio": time_ratio, "rss_ratio": rss_ratio,
+                     "regressed": slower or rss_ratio > 1 + rss_threshold})
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark index, TraceShield, ProvDecode and BCI scaling; compare runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the suite and write results as JSON")
+    run_parser.add_argument("--sizes", nargs="+", default=["1M", "10M"], help="Corpus sizes in tokens, e.g. 1M 10M 100M 1B")
+    run_parser.add_argument("--ops", nargs="+", default=["build", "match_span", "match_spans", "refuse", "explain", "adjust_logits", "rank_spans"],
+                            help="Operations to measure (load always runs)")
+    run_parser.add_argument("--output", required=True, help="Results JSON, e.g. a baseline to compare later runs against")
+    run_parser.add_argument("--work_dir", default="bench_work", help="Where corpora and indexes are generated")
+    run_parser.add_argument("--keep", action="store_true", help="Keep generated corpora and indexes for later runs")
+    run_parser.add_argument("--shard_tokens", type=int, default=0,
+                            help="Build corpora larger than this as sharded indexes (0 = always one index); needed past ~50M tokens per 4GB RAM")
+    run_parser.add_argument("--workers", type=int, default=None, help="Shard build processes (default: all cores)")
+    run_parser.add_argument("--repeat", type=int, default=5, help="Runs per query measurement; the fastest is kept")
+    run_parser.add_argument("--vocab_size", type=int, default=32000)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--queries", type=int, default=2000, help="Spans per match_span measurement")
+    run_parser.add_argument("--window_size", type=int, default=8)
+    run_parser.add_argument("--completions", type=int, default=200, help="Completions per TraceShield measurement")
+    run_parser.add_argument("--completion_length", type=int, default=200)
+    run_parser.add_argument("--decode_vocab", type=int, default=32000, help="Candidate tokens per adjust_logits call")
+    run_parser.add_argument("--decode_steps", type=int, default=200)
+    run_parser.add_argument("--rank_spans", type=int, default=100000, help="Spans ranked by one rank_spans call")
+
+    compare_parser = commands.add_parser("compare", help="Flag regressions of a run against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative growth of time per call")
+    compare_parser.add_argument("--rss_threshold", type=float, default=0.25, help="Allowed relative growth of peak RSS")
+    compare_parser.add_argument("--min_us", type=float, default=1.0, help="Ignore slowdowns smaller than this per call")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        logging.disable(logging.WARNING)  # per-refusal warnings would be timed along with the checks
+        report = run(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold, args.rss_threshold, args.min_us)
+    print(f"{'size':>6} {'op':<26}{'time':>9}{'rss':>9}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regressed"] else ""
+        print(f"{format_size(row['size']):>6} {row['op']:<26}{row['time_ratio']:>8.2f}x{row['rss_ratio']:>8.2f}x{flag}")
+    regressions = sum(row["regressed"] for row in rows)
+    print(f"{regressions} regression(s) in {len(rows)} comparable measurements")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
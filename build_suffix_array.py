@@ -1,25 +1,90 @@
 # scripts/build_suffix_array.py — Construct SuffixArrayIndex from Corpus
- 
+
 import os
+import shutil
 import argparse
-from tracealign.utils import read_corpus, tokenize_corpus
-from tracealign.traceindex import SuffixArrayIndex
- 
+from tracealign.utils import HFTokenizerFn, ingest_corpus, normalize_token_frequencies, save_token_distribution, setup_logging, soft_tokenize
+from tracealign.traceindex import SuffixArrayIndex, read_stream_counts
+from tracealign.sharded_index import build_sharded_index, is_sharded, manifest_vocab
+from tracealign.fm_index import DEFAULT_SAMPLE_RATE, FMIndex
+from tracealign.bci import save_stream_token_probs
+
 def main():
-	parser = argparse.ArgumentParser(description="Build suffix array index for TRACEALIGN")
-	parser.add_argument("--input_dir", required=True, help="Directory containing input .txt or .jsonl files")
-	parser.add_argument("--output_path", required=True, help="Path to save the suffix array index")
-	args = parser.parse_args()
- 
-	corpus = read_corpus(args.input_dir)
-	tokenized = tokenize_corpus(corpus)
- 
-	index = SuffixArrayIndex()
-	for doc in tokenized:
-    	index.add_document(doc["id"], doc["tokens"])
-	index.build()
-	index.save(args.output_path)
- 
+    parser = argparse.ArgumentParser(description="Build suffix array index for TRACEALIGN")
+    parser.add_argument("--input_dir", required=True, help="Directory containing input .txt or .jsonl files (optionally .gz)")
+    parser.add_argument("--output_path", required=True, help="Path to save the suffix array index")
+    parser.add_argument("--method", choices=["doubling", "naive"], default="doubling", help="Suffix array construction engine")
+    parser.add_argument("--verify", action="store_true", help="Cross-check the suffix array against the naive sort (small corpora only)")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer; builds an ID-aligned index over its token ids (used by CBD training)")
+    parser.add_argument("--workers", type=int, default=None, help="Tokenizer processes (default: all cores)")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Documents per tokenization task")
+    parser.add_argument("--stream_dir", default=None, help="Where to write the ingested token stream (default: <output_path>.stream)")
+    parser.add_argument("--keep_stream", action="store_true", help="Keep the token stream directory after the build")
+    parser.add_argument("--token_distribution", default=None, help="Also save the normalized token frequencies counted during ingestion")
+    parser.add_argument("--token_probs", default=None,
+                        help="Also save them as a binary token-probability store (directory) aligned with the index vocabulary")
+    parser.add_argument("--shard_tokens", type=int, default=0, help="Build a sharded index with at most this many tokens per shard (0 = one index)")
+    parser.add_argument("--append", action="store_true", help="Add the corpus as new shards of an existing sharded index")
+    parser.add_argument("--prefilter_n", type=int, default=0, help="Build an n-gram Bloom prefilter at this window size, e.g. the TraceShield window (0 = none)")
+    parser.add_argument("--prefilter_fpr", type=float, default=0.01, help="Target false-positive rate of the prefilter")
+    parser.add_argument("--lsh_window", type=int, default=0,
+                        help="Build MinHash LSH tables over windows of this size for fuzzy TraceShield checks, e.g. the TraceShield window (0 = none)")
+    parser.add_argument("--lsh_shingle", type=int, default=1, help="Tokens per shingle of the LSH window sets")
+    parser.add_argument("--lsh_bands", type=int, default=10, help="LSH bands; each costs 8 bytes per corpus window")
+    parser.add_argument("--lsh_rows", type=int, default=3, help="MinHash values per LSH band; more rows raise the similarity threshold")
+    parser.add_argument("--doc_listing", action="store_true",
+                        help="Precompute the document array so attribution lists distinct source documents in time proportional to their number")
+    parser.add_argument("--backend", choices=["suffix_array", "fm"], default="suffix_array", help="Plain suffix array or compressed FM-index")
+    parser.add_argument("--sa_sample_rate", type=int, default=DEFAULT_SAMPLE_RATE,
+                        help="FM-index only: keep the suffix array entry of every Nth stream position; larger is smaller but locates matches slower")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.backend == "fm" and (args.shard_tokens > 0 or args.append):
+        parser.error("--backend fm builds a single index; --shard_tokens and --append are not supported")
+    if args.backend == "fm" and args.lsh_window > 0:
+        parser.error("--lsh_window needs the token stream of a suffix array index; it is not supported with --backend fm")
+    if args.backend == "fm" and args.doc_listing:
+        parser.error("--doc_listing needs the full suffix array; it is not supported with --backend fm")
+
+    stream_dir = args.stream_dir or args.output_path.rstrip("/") + ".stream"
+    tokenizer_fn, vocab = soft_tokenize, None
+    if args.tokenizer:
+        tokenizer_fn = HFTokenizerFn(args.tokenizer)
+        vocab = tokenizer_fn.vocab()
+    if args.append:
+        if not is_sharded(args.output_path):
+            parser.error("--append needs an existing sharded index at --output_path")
+        # new shards extend the existing id space instead of starting their own
+        vocab = vocab or manifest_vocab(args.output_path)
+    ingest_corpus(args.input_dir, stream_dir, tokenizer_fn, workers=args.workers, chunk_size=args.chunk_size, vocab=vocab)
+
+    if args.token_distribution:
+        counts = {t: c for t, c in read_stream_counts(stream_dir).items() if c}
+        save_token_distribution(args.token_distribution, normalize_token_frequencies(counts))
+    if args.token_probs:
+        save_stream_token_probs(stream_dir, args.token_probs)
+
+    prefilter = (args.prefilter_n, args.prefilter_fpr) if args.prefilter_n > 0 else None
+    lsh = (args.lsh_window, args.lsh_shingle, args.lsh_bands, args.lsh_rows) if args.lsh_window > 0 else None
+    if args.backend == "fm":
+        FMIndex.from_token_stream(stream_dir, sample_rate=args.sa_sample_rate, method=args.method, prefilter=prefilter).save(args.output_path)
+    elif args.shard_tokens > 0 or args.append:
+        shard_tokens = args.shard_tokens if args.shard_tokens > 0 else 2 ** 62
+        build_sharded_index(stream_dir, args.output_path, shard_tokens, workers=args.workers, method=args.method,
+                            append=args.append, prefilter=prefilter, lsh=lsh, doc_listing=args.doc_listing)
+    else:
+        index = SuffixArrayIndex.from_token_stream(stream_dir, method=args.method, verify=args.verify)
+        if prefilter is not None:
+            index.build_prefilter(*prefilter)
+        if lsh is not None:
+            index.build_lsh(*lsh)
+        if args.doc_listing:
+            index.build_doc_listing()
+        index.save(args.output_path)
+        del index
+    if not args.keep_stream:
+        shutil.rmtree(stream_dir)
+
 if __name__ == "__main__":
-	main()
- 
+    main()
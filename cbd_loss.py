@@ -1,45 +1,149 @@
 # tracealign/cbd_loss.py — CBD-Aware DPOTrainer Extension for Alignment-Preserving Fine-Tuning
- 
+
+import time
 import torch
 import logging
+import numpy as np
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from trl import DPOTrainer
 from transformers import PreTrainedTokenizer
-from typing import List, Dict
- 
+from typing import List, Dict, Optional
+
+from tracealign import metrics
+from tracealign.cbd_penalty import cbd_penalties, completion_penalty, _init_penalty_worker, _worker_penalties
+
 logger = logging.getLogger("tracealign.cbd")
-logger.setLevel(logging.INFO)
- 
+
 class CBDDPOTrainer(DPOTrainer):
-	def __init__(self, model, ref_model, args, tokenizer: PreTrainedTokenizer,
-             	tracer, bci_model, bci_threshold: float, lambda_penalty: float = 0.01):
-    	super().__init__(model=model, ref_model=ref_model, args=args, tokenizer=tokenizer)
-    	self.tracer = tracer
-    	self.bci = bci_model
-    	self.threshold = bci_threshold
-    	self.lambda_penalty = lambda_penalty
- 
-	def compute_cbd_penalty(self, decoded: List[str]) -> float:
-    	risky = 0.0
-    	matches = self.tracer.trace_completion(decoded)
-    	for m in matches:
-        	if "span" in m and self.bci.high_risk(m["span"], self.threshold):
-            	risky += max(0, self.bci.compute_bci(m["span"]) - self.threshold)
-    	return risky
- 
-	def compute_loss(self, model, inputs, return_outputs=False):
-    	loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
- 
-    	# Decode model output for CBD penalty
-    	logits = outputs.logits  # [batch, seq_len, vocab_size]
-    	batch_penalty = 0.0
-    	for b in range(logits.size(0)):
-        	predicted_ids = logits[b].argmax(dim=-1).tolist()
-        	tokens = self.tokenizer.convert_ids_to_tokens(predicted_ids, skip_special_tokens=True)
-        	cbd_penalty = self.compute_cbd_penalty(tokens)
-        	batch_penalty += cbd_penalty
-        	logger.debug(f"CBD penalty for sample {b}: {cbd_penalty:.4f}")
- 
-    	total_loss = loss + self.lambda_penalty * batch_penalty
-    	logger.info(f"CBD loss added: {self.lambda_penalty * batch_penalty:.4f}, Total loss: {total_loss:.4f}")
- 
-    	return (total_loss, outputs) if return_outputs else total_loss
+    """
+    DPOTrainer with the CBD penalty. The penalty is traced on the argmax token ids of the whole
+    batch at once: model ids are mapped to index ids through a lookup table built once, so no
+    per-sample token strings are produced. penalty_workers > 0 splits the batch over a worker
+    pool (processes when the index was loaded from disk, threads otherwise); with async_penalty
+    the trace runs while backward() does, which is safe because the penalty carries no gradient.
+    """
+
+    def __init__(self, model, ref_model, args, tokenizer: PreTrainedTokenizer,
+                 tracer, bci_model, bci_threshold: float, lambda_penalty: float = 0.01,
+                 window_size: int = 8, penalty_workers: int = 0, async_penalty: bool = False):
+        super().__init__(model=model, ref_model=ref_model, args=args, tokenizer=tokenizer)
+        self.tracer = tracer
+        self.bci = bci_model
+        self.threshold = bci_threshold
+        self.lambda_penalty = lambda_penalty
+        self.window_size = window_size
+        self.async_penalty = async_penalty and penalty_workers > 0
+        self.id_map = self._model_to_index_ids(tokenizer, tracer)
+        self.surprisal = np.append(bci_model.surprisal_array(tracer.id_to_token), bci_model.default_surprisal)
+        self.penalty_workers = penalty_workers
+        self.pool: Optional[Executor] = None
+        if penalty_workers > 0:
+            if getattr(tracer, "path", None):
+                self.pool = ProcessPoolExecutor(penalty_workers, initializer=_init_penalty_worker,
+                                                initargs=(tracer.path, self.surprisal, bci_threshold, window_size))
+            else:
+                self.pool = ThreadPoolExecutor(penalty_workers)
+        self._pending_penalty: Optional[List[Future]] = None
+        self.cbd_timing = {"steps": 0, "step_seconds": 0.0, "penalty_seconds": 0.0}  # penalty_seconds: time the step blocks on CBD
+
+    @staticmethod
+    def _model_to_index_ids(tokenizer: PreTrainedTokenizer, tracer) -> np.ndarray:
+        """Index id of every model token id (-1 if the index never saw it); -2 marks special tokens, which are dropped"""
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        id_map = np.fromiter((tracer.vocab.get(t, -1) for t in tokens), dtype=np.int64, count=len(tokens))
+        id_map[[i for i in tokenizer.all_special_ids if i < len(id_map)]] = -2
+        aligned = np.array_equal(id_map[id_map >= 0], np.flatnonzero(id_map >= 0))
+        logger.info(f"Mapped {int((id_map >= 0).sum())}/{len(id_map)} model tokens to index ids (ID-aligned: {aligned})")
+        return id_map
+
+    def _index_rows(self, predicted_ids: torch.Tensor) -> List[np.ndarray]:
+        ids = predicted_ids.cpu().numpy()
+        mapped = self.id_map[np.minimum(ids, len(self.id_map) - 1)]
+        mapped[ids >= len(self.id_map)] = -1
+        return [row[row != -2] for row in mapped]
+
+    def compute_cbd_penalty(self, decoded: List[str]) -> float:
+        return completion_penalty(self.tracer, self.bci, decoded, self.threshold, self.window_size)
+
+    def _submit_penalty(self, rows: List[np.ndarray]) -> List[Future]:
+        chunk = -(-len(rows) // self.penalty_workers)
+        if isinstance(self.pool, ProcessPoolExecutor):
+            return [self.pool.submit(_worker_penalties, rows[i:i + chunk]) for i in range(0, len(rows), chunk)]
+        return [self.pool.submit(cbd_penalties, self.tracer, self.surprisal, rows[i:i + chunk], self.threshold, self.window_size)
+                for i in range(0, len(rows), chunk)]
+
+    @staticmethod
+    def _collect_penalty(futures: List[Future]) -> np.ndarray:
+        return np.concatenate([f.result() for f in futures]) if futures else np.zeros(0)
+
+    def batch_penalty(self, logits: torch.Tensor) -> np.ndarray:
+        """Per-sample CBD penalty of the argmax completions of a [batch, seq_len, vocab_size] logits tensor"""
+        rows = self._index_rows(logits.detach().argmax(dim=-1))
+        if self.pool is None:
+            return cbd_penalties(self.tracer, self.surprisal, rows, self.threshold, self.window_size)
+        return self._collect_penalty(self._submit_penalty(rows))
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True, **kwargs)
+
+        logits = outputs.logits  # [batch, seq_len, vocab_size]
+        if self.async_penalty and model.training:
+            # traced while backward() runs; training_step adds it to the reported loss
+            start = time.perf_counter()
+            self._pending_penalty = self._submit_penalty(self._index_rows(logits.detach().argmax(dim=-1)))
+            self.cbd_timing["penalty_seconds"] += time.perf_counter() - start
+            return (loss, outputs) if return_outputs else loss
+
+        start = time.perf_counter()
+        penalties = self.batch_penalty(logits)
+        if model.training:
+            self.cbd_timing["penalty_seconds"] += time.perf_counter() - start
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("CBD penalty per sample: %s", np.round(penalties, 4).tolist())
+        batch_penalty = float(penalties.sum())
+        total_loss = loss + self.lambda_penalty * batch_penalty
+        logger.info("CBD loss added: %.4f, Total loss: %.4f", self.lambda_penalty * batch_penalty, total_loss)
+
+        return (total_loss, outputs) if return_outputs else total_loss
+
+    def training_step(self, *args, **kwargs):
+        start = time.perf_counter()
+        penalty_before = self.cbd_timing["penalty_seconds"]
+        loss = super().training_step(*args, **kwargs)
+        if self._pending_penalty is not None:
+            wait = time.perf_counter()
+            penalties = self._collect_penalty(self._pending_penalty)
+            self._pending_penalty = None
+            self.cbd_timing["penalty_seconds"] += time.perf_counter() - wait
+            # super().training_step already divided the loss by the accumulation steps; match the sync path
+            added = self.lambda_penalty * float(penalties.sum()) / self.args.gradient_accumulation_steps
+            loss = loss + added
+            logger.info("CBD loss added: %.4f, Total loss: %.4f", added, loss)
+        elapsed = time.perf_counter() - start
+        timing = self.cbd_timing
+        timing["steps"] += 1
+        timing["step_seconds"] += elapsed
+        if metrics.registry.enabled:
+            metrics.registry.observe("cbd_step_seconds", elapsed)
+            metrics.registry.observe("cbd_penalty_seconds", timing["penalty_seconds"] - penalty_before)
+        if timing["steps"] % max(1, self.args.logging_steps) == 0:
+            report = self.timing_report()
+            logger.info(f"Step time {report['step_seconds']:.3f}s with CBD penalty, "
+                        f"{report['step_seconds_without_penalty']:.3f}s without (penalty {report['penalty_seconds']:.3f}s)")
+        return loss
+
+    def timing_report(self) -> Dict[str, float]:
+        """Mean seconds per training step with the CBD penalty, and without the time the step blocked on it"""
+        timing = self.cbd_timing
+        steps = max(1, timing["steps"])
+        return {
+            "steps": timing["steps"],
+            "step_seconds": timing["step_seconds"] / steps,
+            "step_seconds_without_penalty": (timing["step_seconds"] - timing["penalty_seconds"]) / steps,
+            "penalty_seconds": timing["penalty_seconds"] / steps
+        }
+
+    def close_penalty_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
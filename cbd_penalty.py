@@ -0,0 +1,42 @@
+# tracealign/cbd_penalty.py — CBD Penalty on Index Token Ids, Without the Training Stack
+
+import numpy as np
+from typing import List, Dict
+
+from tracealign.sharded_index import open_index
+
+def completion_penalty(tracer, bci, tokens: List[str], threshold: float, window_size: int) -> float:
+    """CBD penalty of one completion given as token strings: the BCI excess of every traced risky window"""
+    risky = 0.0
+    for m in tracer.trace_completion(tokens, window_size):
+        if "span" in m and bci.high_risk(m["span"], threshold):
+            risky += max(0, bci.compute_bci(m["span"]) - threshold)
+    return risky
+
+def cbd_penalties(tracer, surprisal: np.ndarray, rows: List[np.ndarray], threshold: float, window_size: int) -> np.ndarray:
+    """
+    CBD penalty of each completion, given as index token ids (-1 for tokens the index cannot
+    match). Every window_size window that occurs in the corpus and whose BCI exceeds the
+    threshold adds BCI - threshold; surprisal is the BCI surprisal indexed by the same ids,
+    with the unseen-token surprisal as its last entry.
+    """
+    penalties = np.zeros(len(rows))
+    for b, ids in enumerate(rows):
+        if len(ids) < window_size:
+            continue
+        occurs = tracer.matching_statistics_ids(ids, cap=window_size)[:len(ids) - window_size + 1] == window_size
+        if not occurs.any():
+            continue
+        prefix = np.concatenate([[0.0], np.cumsum(surprisal[ids])])
+        scores = (prefix[window_size:] - prefix[:-window_size])[occurs]
+        penalties[b] = float(np.sum(scores[scores > threshold] - threshold))
+    return penalties
+
+_worker: Dict = {}
+
+def _init_penalty_worker(index_path: str, surprisal: np.ndarray, threshold: float, window_size: int):
+    # each worker memory-maps the saved (possibly sharded) index, so the arrays are shared through the page cache
+    _worker.update(tracer=open_index(index_path), surprisal=surprisal, threshold=threshold, window_size=window_size)
+
+def _worker_penalties(rows: List[np.ndarray]) -> np.ndarray:
+    return cbd_penalties(_worker["tracer"], _worker["surprisal"], rows, _worker["threshold"], _worker["window_size"])
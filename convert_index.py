@@ -0,0 +1,17 @@
+# scripts/convert_index.py — Convert a Pickled SuffixArrayIndex to the Memory-Mapped Directory Format
+
+import argparse
+from tracealign.traceindex import convert_pickle_index
+from tracealign.utils import setup_logging
+
+def main():
+    parser = argparse.ArgumentParser(description="One-time conversion of a pickled TRACEALIGN index")
+    parser.add_argument("--input_path", required=True, help="Pickled index written by an older save()")
+    parser.add_argument("--output_dir", required=True, help="Directory to write the memory-mapped index to")
+    args = parser.parse_args()
+    setup_logging()
+
+    convert_pickle_index(args.input_path, args.output_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,57 @@
 # scripts/decode_with_prov.py — Decode using ProvDecode Penalty
- 
+
 import argparse
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from tracealign.prov_decode import ProvDecode
-from tracealign.traceindex import SuffixArrayIndex
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
+from tracealign.prov_decode import ProvDecode, ProvLogitsProcessor, decode_vocab
+from tracealign.sharded_index import open_index
 from tracealign.bci import BeliefConflictIndex
- 
+from tracealign import metrics
+from tracealign.metrics import InstrumentedTracer
+from tracealign.utils import setup_logging
+
 def main():
-	parser = argparse.ArgumentParser()
-	parser.add_argument("--model", required=True)
-	parser.add_argument("--suffix_index", required=True)
-	parser.add_argument("--token_probs", required=True)
-	parser.add_argument("--prompt", required=True)
-	parser.add_argument("--threshold", type=float, default=10.0)
-	parser.add_argument("--gamma", type=float, default=1.0)
-	args = parser.parse_args()
- 
-	tokenizer = AutoTokenizer.from_pretrained(args.model)
-	model = AutoModelForCausalLM.from_pretrained(args.model)
-	index = SuffixArrayIndex()
-	index.load(args.suffix_index)
-	token_probs = BeliefConflictIndex.load_token_probs(args.token_probs)
-	bci = BeliefConflictIndex(token_probs)
-	prov = ProvDecode(index, bci, bci_threshold=args.threshold, gamma=args.gamma)
- 
-	inputs = tokenizer(args.prompt, return_tensors="pt")
-	logits = model(**inputs).logits[0, -1]
-	vocab = [tokenizer.decode([i]) for i in range(len(logits))]
-	adjusted = prov.adjust_logits(args.prompt.split(), vocab, logits.tolist())
-	top_k = sorted(zip(vocab, adjusted), key=lambda x: -x[1])[:10]
-	for token, score in top_k:
-    	print(f"{token}\t{score:.3f}")
- 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--suffix_index", required=True)
+    parser.add_argument("--token_probs", required=True)
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--gamma", type=float, default=1.0)
+    parser.add_argument("--max_new_tokens", type=int, default=0, help="Also generate this many tokens with the ProvDecode logits processor")
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--metrics_file", default=None, help="Write index lookup and per-step veto metrics here in Prometheus text format")
+    args = parser.parse_args()
+    setup_logging()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model)
+    index = open_index(args.suffix_index)
+    if args.metrics_file:
+        index = InstrumentedTracer(index, metrics.enable())
+    bci = BeliefConflictIndex.load(args.token_probs, index.vocab)
+    prov = ProvDecode(index, bci, bci_threshold=args.threshold, gamma=args.gamma)
+
+    inputs = tokenizer(args.prompt, return_tensors="pt")
+    with torch.no_grad():
+        logits = model(**inputs).logits[0, -1]
+    vocab = decode_vocab(tokenizer, len(logits))
+    adjusted = prov.adjust_logits(args.prompt.split(), vocab, logits.tolist())
+    top_k = sorted(zip(vocab, adjusted), key=lambda x: -x[1])[:10]
+    for token, score in top_k:
+        print(f"{token}\t{score:.3f}")
+
+    if args.max_new_tokens > 0:
+        output = model.generate(
+            **inputs,
+            max_new_tokens=args.max_new_tokens,
+            num_beams=args.num_beams,
+            logits_processor=LogitsProcessorList([ProvLogitsProcessor(prov, vocab)])
+        )
+        print(tokenizer.decode(output[0], skip_special_tokens=True))
+
+    if args.metrics_file:
+        metrics.registry.write_prometheus(args.metrics_file)
+
 if __name__ == "__main__":
-	main()
+    main()
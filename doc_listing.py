@@ -0,0 +1,140 @@
+# tracealign/doc_listing.py — Document Array with Distinct-Document Listing and Per-Document Counts
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+BLOCK = 64  # suffixes per block of the range-minimum structure; partial blocks are scanned
+
+
+class DocumentListing:
+    """
+    Lists the distinct documents of a suffix array interval without visiting every occurrence
+    (after Muthukrishnan's document listing). docs[i] is the document of the i-th suffix and prev[i]
+    the largest j < i with docs[j] == docs[i] (-1 if none), so the suffixes of [lo, hi) that are
+    the first of their document are exactly those with prev < lo. Ranges are halved while a
+    range-minimum query on prev shows one is left in them, down to single blocks that are
+    scanned, so listing d documents takes O(d log(n / d)) queries in about log2(n / BLOCK)
+    rounds, each run for every pending interval at once. doc_keys holds
+    docs[i] * n + i sorted, so a document's occurrences in [lo, hi) are two binary searches.
+    """
+
+    def __init__(self, docs: np.ndarray, prev: np.ndarray, doc_keys: np.ndarray, sparse: np.ndarray):
+        self.docs = docs  # document index of each suffix, in suffix array order
+        self.prev = prev  # previous suffix of the same document, -1 for a document's first
+        self.doc_keys = doc_keys
+        self.sparse = sparse  # sparse[k, j]: position of the minimum prev in blocks [j, j + 2^k)
+
+    @classmethod
+    def from_suffix_array(cls, suffix_array: np.ndarray, doc_offsets: np.ndarray) -> "DocumentListing":
+        n = len(suffix_array)
+        docs = (np.searchsorted(doc_offsets, suffix_array, side="right") - 1).astype(np.int32)
+        order = np.argsort(docs, kind="stable")  # ranks grouped by document, ascending within each
+        prev = np.full(n, -1, dtype=np.int64)
+        same = docs[order[1:]] == docs[order[:-1]]
+        prev[order[1:][same]] = order[:-1][same]
+        doc_keys = docs[order].astype(np.int64) * n + order
+        return cls(docs, prev, doc_keys, cls._sparse_table(prev))
+
+    @staticmethod
+    def _sparse_table(prev: np.ndarray) -> np.ndarray:
+        n_blocks = (len(prev) + BLOCK - 1) // BLOCK
+        padded = np.full(n_blocks * BLOCK, np.iinfo(np.int64).max, dtype=np.int64)
+        padded[:len(prev)] = prev
+        level = np.argmin(padded.reshape(n_blocks, BLOCK), axis=1) + np.arange(n_blocks) * BLOCK
+        levels = [level]
+        width = 1
+        while 2 * width <= n_blocks:
+            left, right = level[:-width], level[width:]
+            level = np.where(padded[right] < padded[left], right, left)
+            levels.append(level)
+            width *= 2
+        table = np.zeros((len(levels), n_blocks), dtype=np.int64)
+        for k, level in enumerate(levels):
+            table[k, :len(level)] = level
+        return table
+
+    def _scan_min(self, start: np.ndarray, end: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(position, value) of the minimum prev in each [start, end) of at most BLOCK suffixes; value is max for empty ranges"""
+        rows = start[:, None] + np.arange(BLOCK)
+        values = np.where(rows < end[:, None], self.prev[np.minimum(rows, len(self.prev) - 1)], np.iinfo(np.int64).max)
+        best = np.argmin(values, axis=1)
+        return start + best, values[np.arange(len(start)), best]
+
+    def _range_min(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Position of the minimum prev in each non-empty [a, b)"""
+        first, last = a // BLOCK, (b - 1) // BLOCK
+        position, value = self._scan_min(a, np.minimum(b, (first + 1) * BLOCK))
+        tail, tail_value = self._scan_min(np.maximum(a, last * BLOCK), np.where(last > first, b, a))
+        better = tail_value < value
+        position, value = np.where(better, tail, position), np.where(better, tail_value, value)
+        inner = np.flatnonzero(last - first > 1)
+        if len(inner):
+            lo, hi = first[inner] + 1, last[inner]
+            k = np.floor(np.log2(hi - lo)).astype(np.int64)
+            left, right = self.sparse[k, lo], self.sparse[k, hi - (1 << k)]
+            middle = np.where(self.prev[right] < self.prev[left], right, left)
+            better = self.prev[middle] < value[inner]
+            position[inner[better]] = middle[better]
+        return position
+
+    def list_intervals(self, intervals: List[Tuple[int, int]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        For each suffix array interval [lo, hi): (documents, counts, first ranks), one entry per
+        distinct document in the interval, where first rank is that document's first suffix in
+        the interval. Entries come in no particular order.
+        """
+        bounds = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+        if not len(bounds):
+            return []
+        owner = np.flatnonzero(bounds[:, 0] < bounds[:, 1])
+        a, b = bounds[owner, 0], bounds[owner, 1]
+        found_owner, found_rank = [], []
+        while len(owner):
+            # ranges of one block or less are scanned whole for their first occurrences
+            leaf = b - a <= BLOCK
+            rows = a[leaf, None] + np.arange(BLOCK)
+            prev = self.prev[np.minimum(rows, len(self.prev) - 1)]
+            hit = (rows < b[leaf, None]) & (prev < bounds[owner[leaf], 0][:, None])
+            found_owner.append(np.broadcast_to(owner[leaf, None], hit.shape)[hit])
+            found_rank.append(rows[hit])
+            # a wider range is halved only while its minimum shows a first occurrence left in it
+            owner, a, b = owner[~leaf], a[~leaf], b[~leaf]
+            live = self.prev[self._range_min(a, b)] < bounds[owner, 0]
+            owner, a, b = owner[live], a[live], b[live]
+            mid = (a + b) // 2
+            owner, a, b = np.concatenate([owner, owner]), np.concatenate([a, mid]), np.concatenate([mid, b])
+        owners = np.concatenate(found_owner) if found_owner else np.empty(0, dtype=np.int64)
+        ranks = np.concatenate(found_rank) if found_rank else np.empty(0, dtype=np.int64)
+        docs = self.docs[ranks].astype(np.int64)
+        n = len(self.docs)
+        counts = np.searchsorted(self.doc_keys, docs * n + bounds[owners, 1]) - np.searchsorted(self.doc_keys, docs * n + bounds[owners, 0])
+        order = np.argsort(owners, kind="stable")
+        splits = np.searchsorted(owners[order], np.arange(1, len(bounds)))
+        return [(docs[part], counts[part], ranks[part]) for part in np.split(order, splits)]
+
+    def meta(self) -> Dict:
+        return {"block": BLOCK, "levels": int(self.sparse.shape[0]), "blocks": int(self.sparse.shape[1])}
+
+    @classmethod
+    def from_meta(cls, meta: Dict, docs: np.ndarray, prev: np.ndarray, doc_keys: np.ndarray, sparse: np.ndarray) -> "DocumentListing":
+        if meta["block"] != BLOCK:
+            raise ValueError(f"Document listing built with blocks of {meta['block']} suffixes, expected {BLOCK}")
+        return cls(docs, prev, doc_keys, sparse.reshape(meta["levels"], meta["blocks"]))
+
+
+def scan_intervals(suffix_array: np.ndarray, doc_offsets: np.ndarray,
+                   intervals: List[Tuple[int, int]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """list_intervals() without a DocumentListing, by visiting every occurrence"""
+    results = []
+    for lo, hi in intervals:
+        docs = np.searchsorted(doc_offsets, suffix_array[lo:hi], side="right") - 1
+        unique, first, counts = np.unique(docs, return_index=True, return_counts=True)
+        results.append((unique.astype(np.int64), counts, first.astype(np.int64) + lo))
+    return results
+
+
+def rank_documents(docs: np.ndarray, counts: np.ndarray, ranks: np.ndarray, limit: Optional[int] = None) -> np.ndarray:
+    """Order of one interval's entries: most occurrences first, then by first rank"""
+    order = np.lexsort((ranks, -counts))
+    return order[:limit] if limit is not None else order
@@ -1,34 +1,183 @@
 # scripts/eval_traceshield.py — Evaluate Traceshield Refusal on a Prompt Dataset
- 
+
 import argparse
-from tracealign.utils import load_jsonl
-from tracealign.traceindex import SuffixArrayIndex
+import json
+import os
+import sys
+import time
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from tracealign import metrics
+from tracealign.utils import iter_jsonl, chunked, ordered_map, soft_tokenize, json_default, HFTokenizerFn, setup_logging
+from tracealign.sharded_index import open_index
 from tracealign.bci import BeliefConflictIndex
 from tracealign.traceshield import TraceShield
- 
+from tracealign.span_cache import SpanCache, SharedSpanTable, CachedTracer, CachedBCI
+from tracealign.metrics import InstrumentedTracer, MetricsExporter, SamplingProfiler
+
+# per-process state set up once by _init_worker; the index is memory-mapped, so every worker
+# shares the same page cache instead of holding its own copy
+_shield: Optional[TraceShield] = None
+_tokenize = soft_tokenize
+
+def _init_worker(index_path: str, probs_path: str, threshold: float, window_size: int, tokenizer: Optional[str],
+                 cache_bytes: int = 0, cache_policy: str = "lru", shared: Optional[SharedSpanTable] = None,
+                 instrument: bool = False, fuzzy_jaccard: Optional[float] = None):
+    global _shield, _tokenize
+    tracer = open_index(index_path)
+    bci = BeliefConflictIndex.load(probs_path, getattr(tracer, "vocab", None))
+    if cache_bytes > 0:
+        # logged completions repeat templated text, so the same windows are traced over and over
+        cache = SpanCache(cache_bytes, cache_policy, shared)
+        tracer, bci = CachedTracer(tracer, cache), CachedBCI(bci, cache)
+    if instrument:
+        registry = metrics.enable()
+        if cache_bytes > 0:
+            registry.add_collector("span_cache", cache.stats)  # per process: only exported with workers=1
+        tracer = InstrumentedTracer(tracer, registry)
+    _shield = TraceShield(tracer, bci, threshold, window_size=window_size, fuzzy_jaccard=fuzzy_jaccard)
+    _tokenize = HFTokenizerFn(tokenizer) if tokenizer else soft_tokenize
+
+def _evaluate_chunk(records: List[Dict]) -> List[Dict]:
+    """shield.explain on each completion, tagged with its id, token count and latency"""
+    results = []
+    for record in records:
+        start = time.perf_counter()
+        tokens = _tokenize(record.get("completion", ""))
+        result = {"id": record["id"], "n_tokens": len(tokens)}
+        result.update(_shield.explain(tokens))
+        result["latency_ms"] = (time.perf_counter() - start) * 1e3
+        results.append(result)
+    return results
+
+def _evaluate_chunk_metered(records: List[Dict]) -> Tuple[List[Dict], Dict]:
+    """_evaluate_chunk plus the metrics the chunk recorded, drained so the parent can merge them"""
+    return _evaluate_chunk(records), metrics.registry.drain()
+
+def completed_ids(output_path: str) -> Set[str]:
+    """
+    Ids already in an output file from an interrupted run. A partial last line (the run died
+    mid-write) is truncated so that appending resumes on a clean line boundary.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        good = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            good += len(line)
+        f.truncate(good)
+    return done
+
+def iter_pending(prompts_path: str, done: Set[str]) -> Iterator[Dict]:
+    """Stream prompts not yet evaluated; records without an id are keyed by their line number"""
+    for i, record in enumerate(iter_jsonl(prompts_path)):
+        record["id"] = str(record.get("id", i))
+        if record["id"] not in done:
+            yield record
+
+def summarize(latencies_ms: List[float], n_tokens: int, n_refused: int, seconds: float) -> Dict:
+    summary = {
+        "completions": len(latencies_ms),
+        "refused": n_refused,
+        "seconds": round(seconds, 3),
+        "completions_per_s": round(len(latencies_ms) / max(seconds, 1e-9), 1),
+        "tokens_per_s": round(n_tokens / max(seconds, 1e-9), 1)
+    }
+    if latencies_ms:
+        p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]).tolist()
+        summary.update({"p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3)})
+    return summary
+
+def evaluate(prompts_path: str, index_path: str, probs_path: str, output_path: Optional[str] = None,
+             threshold: float = 10.0, window_size: int = 8, workers: Optional[int] = 1, chunk_size: int = 64,
+             tokenizer: Optional[str] = None, cache_mb: float = 0, cache_policy: str = "lru",
+             shared_cache_mb: float = 0, metrics_path: Optional[str] = None, profile_path: Optional[str] = None,
+             metrics_interval: float = 10.0, fuzzy_jaccard: Optional[float] = None) -> Dict:
+    """
+    Stream prompts through TraceShield in a process pool and write one JSON result per line, in
+    input order. With an existing output file, prompts it already covers are skipped and new
+    results are appended. With cache_mb, each worker keeps a span-result cache of that size;
+    shared_cache_mb adds a shared-memory table all workers read and publish to. With
+    metrics_path, the workers' tracer, shield and cache metrics are merged and written there as
+    a Prometheus text file every metrics_interval seconds; profile_path gets the collapsed stacks
+    of a sampling profiler over this process (the evaluation itself only with workers=1).
+    fuzzy_jaccard also refuses near-duplicates of high-BCI corpus windows (see TraceShield).
+    Returns the throughput summary of this run.
+    """
+    done = completed_ids(output_path) if output_path else set()
+    out = open(output_path, "a") if output_path else sys.stdout
+    shared = SharedSpanTable.create(int(shared_cache_mb * (1 << 20))) if cache_mb > 0 and shared_cache_mb > 0 else None
+    registry = metrics.enable() if metrics_path else None
+    exporter = MetricsExporter(registry, metrics_path, interval=metrics_interval).start() if registry is not None else None
+    profiler = SamplingProfiler().start() if profile_path else None
+    latencies, n_tokens, n_refused = [], 0, 0
+    start = time.perf_counter()
+    try:
+        chunks = chunked(iter_pending(prompts_path, done), chunk_size)
+        initargs = (index_path, probs_path, threshold, window_size, tokenizer, int(cache_mb * (1 << 20)), cache_policy, shared,
+                    registry is not None, fuzzy_jaccard)
+        fn = _evaluate_chunk_metered if registry is not None else _evaluate_chunk
+        for results in ordered_map(fn, chunks, workers, initializer=_init_worker, initargs=initargs):
+            if registry is not None:
+                results, state = results
+                registry.merge(state)
+            for result in results:
+                out.write(json.dumps(result, default=json_default) + "\n")
+                latencies.append(result["latency_ms"])
+                n_tokens += result["n_tokens"]
+                n_refused += result["refused"]
+            out.flush()
+    finally:
+        if output_path:
+            out.close()
+        if shared is not None:
+            shared.close()
+        if exporter is not None:
+            exporter.stop()
+            metrics.disable()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_collapsed(profile_path)
+    summary = summarize(latencies, n_tokens, n_refused, time.perf_counter() - start)
+    summary["skipped"] = len(done)
+    return summary
+
 def main():
-	parser = argparse.ArgumentParser()
-	parser.add_argument("--prompts", required=True, help="JSONL file of prompts")
-	parser.add_argument("--index", required=True, help="Path to suffix array index")
-	parser.add_argument("--probs", required=True, help="Token probability JSON")
-	parser.add_argument("--threshold", type=float, default=10.0)
-	args = parser.parse_args()
- 
-	prompts = load_jsonl(args.prompts)
-	token_probs = BeliefConflictIndex.load_token_probs(args.probs)
- 
-	index = SuffixArrayIndex()
-	index.load(args.index)
-	bci = BeliefConflictIndex(token_probs)
-	shield = TraceShield(index, bci, args.threshold)
- 
-	for p in prompts:
-    	text = p["completion"]
-    	tokens = text.strip().split()
-    	result = shield.explain(tokens)
-    	print("===", p["id"])
-    	print(result)
- 
+    parser = argparse.ArgumentParser(description="Run TraceShield over a JSONL file of completions")
+    parser.add_argument("--prompts", required=True, help="JSONL file with a 'completion' (and optional 'id') per line, optionally .gz")
+    parser.add_argument("--index", required=True, help="Path to the suffix array, FM or sharded index")
+    parser.add_argument("--probs", required=True, help="Token probability JSON or binary store")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--window_size", type=int, default=8, help="TraceShield window in tokens")
+    parser.add_argument("--fuzzy_jaccard", type=float, default=None,
+                        help="Also refuse windows this similar to a high-BCI corpus window (index built with --lsh_window)")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer the index was built with (default: soft_tokenize)")
+    parser.add_argument("--output", default=None, help="JSONL results file; resumed if it exists (default: stdout)")
+    parser.add_argument("--workers", type=int, default=None, help="Evaluation processes (default: all cores)")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Completions per worker task")
+    parser.add_argument("--cache_mb", type=float, default=0, help="Per-worker span-result cache budget (0 = no cache)")
+    parser.add_argument("--cache_policy", choices=["lru", "tinylfu"], default="lru", help="Eviction/admission policy of the span cache")
+    parser.add_argument("--shared_cache_mb", type=float, default=0, help="Shared-memory span table across workers (needs --cache_mb)")
+    parser.add_argument("--metrics_file", default=None, help="Write tracer/shield latency and counter metrics here in Prometheus text format")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between metrics file updates")
+    parser.add_argument("--profile", default=None, help="Write sampling-profiler stacks (collapsed, for flame graphs) here; use with --workers 1")
+    args = parser.parse_args()
+    setup_logging()
+
+    summary = evaluate(args.prompts, args.index, args.probs, args.output, args.threshold, args.window_size,
+                       args.workers, args.chunk_size, args.tokenizer, args.cache_mb, args.cache_policy, args.shared_cache_mb,
+                       args.metrics_file, args.profile, args.metrics_interval, args.fuzzy_jaccard)
+    print(f"{summary['completions']} completions ({summary['skipped']} already done, {summary['refused']} refused) "
+          f"in {summary['seconds']:.1f}s: {summary['completions_per_s']:.1f} completions/s, {summary['tokens_per_s']:.0f} tokens/s", file=sys.stderr)
+    if summary["completions"]:
+        print(f"latency per completion: p50 {summary['p50_ms']:.2f}ms, p95 {summary['p95_ms']:.2f}ms, p99 {summary['p99_ms']:.2f}ms", file=sys.stderr)
+
 if __name__ == "__main__":
-	main()
- 
+    main()
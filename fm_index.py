@@ -0,0 +1,431 @@
+# tracealign/fm_index.py — Compressed FM-Index Backend (BWT, Wavelet Matrix, Sampled Suffix Array)
+
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.prefilter import NgramBloom, POPCOUNT
+from tracealign.index_store import open_array, read_header, read_index, write_array, write_index
+from tracealign.span_index import SpanIndex, has_unknown, pad_queries, prefilter_spans
+
+logger = logging.getLogger("tracealign.fm_index")
+
+FM_FORMAT = "tracealign-fm-index"
+
+# Rank directory of every bit vector: an absolute count per superblock of SUPERBLOCK_WORDS
+# 64-bit words plus a uint16 count per word relative to its superblock (1.25 bits per bit)
+SUPERBLOCK_WORDS = 1024
+
+# Default SA sample rate: locating one occurrence takes at most this many LF steps, and the
+# samples cost 4 (or 8, past 2**32 tokens) bytes per sample_rate corpus tokens
+DEFAULT_SAMPLE_RATE = 32
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    return POPCOUNT[words.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64)
+
+
+class RankBits:
+    """Bit vector with O(1) rank and access, scalar or vectorized over int64 position arrays"""
+
+    def __init__(self, words: np.ndarray, superblocks: np.ndarray, relative: np.ndarray):
+        self.words = words
+        self.superblocks = superblocks
+        self.relative = relative
+
+    @classmethod
+    def from_bits(cls, bits: np.ndarray) -> "RankBits":
+        # one spare word so that rank(len(bits)) needs no bounds check
+        n_words = len(bits) // 64 + 1
+        packed = np.zeros(n_words * 8, dtype=np.uint8)
+        packed[:(len(bits) + 7) // 8] = np.packbits(bits.astype(np.uint8), bitorder="little")
+        words = packed.view("<u8")
+        counts = _popcount(words)
+        before = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        superblocks = before[::SUPERBLOCK_WORDS].astype(np.int64)
+        relative = (before - np.repeat(superblocks, SUPERBLOCK_WORDS)[:n_words]).astype(np.uint16)
+        return cls(words, superblocks, relative)
+
+    def rank(self, i: int) -> int:
+        """Number of set bits before position i"""
+        w = i >> 6
+        r = int(self.superblocks[w >> 10]) + int(self.relative[w])
+        b = i & 63
+        return r + (int(self.words[w]) & ((1 << b) - 1)).bit_count() if b else r
+
+    def bit(self, i: int) -> int:
+        return (int(self.words[i >> 6]) >> (i & 63)) & 1
+
+    def rank_many(self, i: np.ndarray) -> np.ndarray:
+        w = i >> 6
+        masked = self.words[w] & ((np.uint64(1) << (i & 63).astype(np.uint64)) - np.uint64(1))
+        return self.superblocks[w >> 10] + self.relative[w].astype(np.int64) + _popcount(masked)
+
+    def bits_many(self, i: np.ndarray) -> np.ndarray:
+        return ((self.words[i >> 6] >> (i & 63).astype(np.uint64)) & np.uint64(1)).astype(np.int64)
+
+
+class WaveletMatrix:
+    """
+    Wavelet matrix over the BWT symbols: one RankBits per bit of the symbol, most significant
+    first, where each level stably moves the symbols with a 0 bit in front of those with a 1 bit.
+    rank(c, i) costs one bit-vector rank per level, i.e. log2(vocabulary size) of them.
+    """
+
+    def __init__(self, levels: List[RankBits], zeros: List[int], sigma: int):
+        self.levels = levels
+        self.zeros = zeros  # zero bits of each level: where its 1-bit block starts
+        self.sigma = sigma
+        # position of each symbol's block after the last level, so rank(c, i) = descend(c, i) - start[c]
+        self.start = self._descend_many(np.arange(sigma, dtype=np.int64), np.zeros(sigma, dtype=np.int64))
+
+    @classmethod
+    def from_symbols(cls, symbols: np.ndarray, sigma: int) -> "WaveletMatrix":
+        height = max(1, int(sigma - 1).bit_length())
+        levels, zeros = [], []
+        values = np.asarray(symbols, dtype=np.int64)
+        for level in range(height):
+            bits = (values >> (height - 1 - level)) & 1
+            levels.append(RankBits.from_bits(bits))
+            zeros.append(int(len(values) - bits.sum()))
+            values = np.concatenate([values[bits == 0], values[bits == 1]])
+        return cls(levels, zeros, sigma)
+
+    @property
+    def height(self) -> int:
+        return len(self.levels)
+
+    def _descend_many(self, c: np.ndarray, i: np.ndarray) -> np.ndarray:
+        height = self.height
+        for level, (bits, zeros) in enumerate(zip(self.levels, self.zeros)):
+            ones = bits.rank_many(i)
+            i = np.where((c >> (height - 1 - level)) & 1, zeros + ones, i - ones)
+        return i
+
+    def rank_many(self, c: np.ndarray, i: np.ndarray) -> np.ndarray:
+        """Occurrences of symbol c[j] before position i[j]"""
+        return self._descend_many(c, i) - self.start[c]
+
+    def rank_pair(self, c: int, lo: int, hi: int) -> Tuple[int, int]:
+        """rank(c, lo) and rank(c, hi) in one pass over the levels"""
+        shift = self.height - 1
+        for bits, zeros in zip(self.levels, self.zeros):
+            words, superblocks, relative = bits.words, bits.superblocks, bits.relative
+            w, b = lo >> 6, lo & 63
+            ones_lo = int(superblocks[w >> 10]) + int(relative[w]) + (int(words[w]) & ((1 << b) - 1)).bit_count()
+            w, b = hi >> 6, hi & 63
+            ones_hi = int(superblocks[w >> 10]) + int(relative[w]) + (int(words[w]) & ((1 << b) - 1)).bit_count()
+            if (c >> shift) & 1:
+                lo, hi = zeros + ones_lo, zeros + ones_hi
+            else:
+                lo, hi = lo - ones_lo, hi - ones_hi
+            shift -= 1
+        start = int(self.start[c])
+        return lo - start, hi - start
+
+    def access_rank(self, i: int) -> Tuple[int, int]:
+        """Symbol at position i and its number of occurrences before i"""
+        c = 0
+        for bits, zeros in zip(self.levels, self.zeros):
+            w, b = i >> 6, i & 63
+            word = int(bits.words[w])
+            ones = int(bits.superblocks[w >> 10]) + int(bits.relative[w]) + (word & ((1 << b) - 1)).bit_count()
+            if (word >> b) & 1:
+                c, i = (c << 1) | 1, zeros + ones
+            else:
+                c, i = c << 1, i - ones
+        return c, i - int(self.start[c])
+
+    def access_rank_many(self, i: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Symbol at each position and its number of occurrences before that position"""
+        c = np.zeros(len(i), dtype=np.int64)
+        for bits, zeros in zip(self.levels, self.zeros):
+            bit = bits.bits_many(i)
+            ones = bits.rank_many(i)
+            c = (c << 1) | bit
+            i = np.where(bit, zeros + ones, i - ones)
+        return c, i - self.start[c]
+
+
+class FMIndex(SpanIndex):
+    """
+    Compressed tracer with the SuffixArrayIndex query interface. The token stream is kept only
+    as its Burrows-Wheeler transform in a wavelet matrix, so count_span is a backward search of
+    two ranks per token and per wavelet level, with no suffix array or stream access. Symbols
+    are token id + 1, with 0 for every document terminator; queries never contain 0, so the
+    terminators' relative order never matters.
+
+    match_span locates occurrences through a suffix array sampled every sample_rate stream
+    positions and at every document start: LF steps walk back to the nearest sample, which is
+    always in the same document. Larger sample rates shrink the index and make each located
+    match up to sample_rate times slower; counting is unaffected.
+
+    Rows are suffix array rows of the whole stream, the terminators' suffixes first, so row
+    r + len(doc_ids) is SuffixArrayIndex row r and matches come back in the same order.
+    """
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.id_to_token: List[str] = []
+        self.doc_ids: List[str] = []
+        self.doc_offsets = np.empty(0, dtype=np.int64)
+        self.counts = np.zeros(1, dtype=np.int64)  # C array: rows of suffixes starting with symbol c are [counts[c], counts[c + 1])
+        self.bwt: Optional[WaveletMatrix] = None
+        self.sampled: Optional[RankBits] = None  # rows whose stream position is sampled
+        self.samples = np.empty(0, dtype=np.int64)  # stream position of each sampled row, in row order
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.n_tokens = 0  # stream length, terminators included
+        self.path: Optional[str] = None
+        self.prefilter: Optional[NgramBloom] = None
+
+    @classmethod
+    def from_suffix_array(cls, index: SuffixArrayIndex, sample_rate: int = DEFAULT_SAMPLE_RATE) -> "FMIndex":
+        """Compress a built SuffixArrayIndex; it can be dropped afterwards"""
+        logger.info(f"Building FM-index over {len(index.tokens)} stream tokens (SA sample rate {sample_rate})...")
+        start = time.perf_counter()
+        fm = cls()
+        fm.vocab, fm.id_to_token, fm.doc_ids = index.vocab, index.id_to_token, index.doc_ids
+        fm.doc_offsets = index.doc_offsets
+        fm.sample_rate = sample_rate
+        fm.prefilter = index.prefilter
+        tokens = index.tokens
+        fm.n_tokens = n = len(tokens)
+        # terminator suffixes sort first, in document order
+        ends = np.append(np.asarray(index.doc_offsets[1:], dtype=np.int64) - 1, n - 1) if n else np.empty(0, dtype=np.int64)
+        full = np.concatenate([ends, np.asarray(index.suffix_array, dtype=np.int64)])
+        before = np.asarray(tokens, dtype=np.int64)[full - 1]  # position -1 wraps to the last terminator
+        symbols = np.where(before < 0, 0, before + 1)
+        sigma = len(fm.id_to_token) + 1
+        fm.counts = np.zeros(sigma + 1, dtype=np.int64)
+        np.cumsum(np.bincount(np.where(tokens < 0, 0, np.asarray(tokens, dtype=np.int64) + 1), minlength=sigma),
+                  out=fm.counts[1:])
+        fm.bwt = WaveletMatrix.from_symbols(symbols, sigma)
+        marks = (full % sample_rate == 0) | (symbols == 0)
+        fm.sampled = RankBits.from_bits(marks)
+        fm.samples = full[marks].astype(_sample_dtype(n))
+        logger.info(f"FM-index built in {time.perf_counter() - start:.2f}s: {fm.nbytes() / max(1, n):.2f} bytes per token.")
+        return fm
+
+    @classmethod
+    def from_token_stream(cls, path: str, sample_rate: int = DEFAULT_SAMPLE_RATE, method: str = "doubling",
+                          prefilter: Optional[Tuple[int, float]] = None) -> "FMIndex":
+        """Sort a token stream written by TokenStreamWriter and compress the result"""
+        index = SuffixArrayIndex.from_token_stream(path, method=method)
+        if prefilter is not None:
+            index.build_prefilter(*prefilter)
+        return cls.from_suffix_array(index, sample_rate)
+
+    def nbytes(self) -> int:
+        """Bytes held by the rank structures and samples (vocabulary and doc ids excluded)"""
+        bit_vectors = list(self.bwt.levels) + [self.sampled]
+        total = sum(b.words.nbytes + b.superblocks.nbytes + b.relative.nbytes for b in bit_vectors)
+        return total + self.samples.nbytes + self.counts.nbytes + self.doc_offsets.nbytes
+
+    def _bounds(self, query: List[int]) -> Tuple[int, int]:
+        """Rows [lo, hi) of suffixes starting with the encoded query, by backward search"""
+        if not query:
+            return len(self.doc_ids), self.n_tokens
+        c = query[-1] + 1
+        lo, hi = int(self.counts[c]), int(self.counts[c + 1])
+        for tid in reversed(query[:-1]):
+            if lo >= hi:
+                break
+            c = tid + 1
+            base = int(self.counts[c])
+            lo, hi = self.bwt.rank_pair(c, lo, hi)
+            lo, hi = base + lo, base + hi
+        return (lo, hi) if lo < hi else (lo, lo)
+
+    def position(self, row: int) -> int:
+        """Stream position of a row: LF steps back to a sampled row, then its sample plus the steps"""
+        steps = 0
+        while not self.sampled.bit(row):
+            c, r = self.bwt.access_rank(row)
+            row = int(self.counts[c]) + r
+            steps += 1
+        return int(self.samples[self.sampled.rank(row)]) + steps
+
+    def intervals(self, spans: List[List[str]], prefiltered: bool = False) -> List[Tuple[int, int]]:
+        """
+        interval() of many spans, aligned with the input (empty intervals are (0, 0)): duplicates
+        are searched once and all distinct queries take their backward-search steps in lockstep.
+        prefiltered skips the prefilter, for spans already checked against it.
+        """
+        padded, lengths = pad_queries(self.vocab, spans)
+        keep = np.flatnonzero((lengths > 0) & ~has_unknown(padded, lengths))
+        results = np.zeros((len(spans), 2), dtype=np.int64)
+        results[lengths == 0] = (len(self.doc_ids), self.n_tokens)
+        if not len(keep):
+            return list(map(tuple, results.tolist()))
+        queries, first, inverse = np.unique(padded[keep], axis=0, return_index=True, return_inverse=True)
+        lengths = lengths[keep][first]
+        c = queries[np.arange(len(queries)), lengths - 1] + 1
+        lo, hi = self.counts[c], self.counts[c + 1]
+        if self.prefilter is not None and not prefiltered:
+            hi = np.where(prefilter_spans(self.prefilter, queries, lengths), hi, lo)
+        for step in range(1, queries.shape[1]):
+            todo = np.flatnonzero((lengths > step) & (lo < hi))
+            if not len(todo):
+                break
+            c = queries[todo, lengths[todo] - 1 - step] + 1
+            lo[todo] = self.counts[c] + self.bwt.rank_many(c, lo[todo])
+            hi[todo] = self.counts[c] + self.bwt.rank_many(c, hi[todo])
+        found = lo < hi
+        results[keep, 0] = np.where(found, lo, 0)[inverse]
+        results[keep, 1] = np.where(found, hi, 0)[inverse]
+        return list(map(tuple, results.tolist()))
+
+    def positions(self, rows: np.ndarray) -> np.ndarray:
+        """position() of many rows, with the LF steps of all rows vectorized"""
+        rows = np.asarray(rows, dtype=np.int64)
+        steps = np.zeros(len(rows), dtype=np.int64)
+        todo = np.flatnonzero(self.sampled.bits_many(rows) == 0)
+        current = rows.copy()
+        while len(todo):
+            c, r = self.bwt.access_rank_many(current[todo])
+            current[todo] = self.counts[c] + r
+            steps[todo] += 1
+            todo = todo[self.sampled.bits_many(current[todo]) == 0]
+        return self.samples[self.sampled.rank_many(current)].astype(np.int64) + steps
+
+    def matching_statistics_ids(self, ids, cap: Optional[int] = None) -> np.ndarray:
+        """
+        Length of the longest corpus-attested prefix of ids[i:] (at most cap) for every i.
+        Backward searches from every end position run in lockstep, one vectorized step per
+        length: the search ending at r reaching start j means ids[j:r] occurs, and a span
+        occurs exactly when every search that ends with it survives that far.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        n = len(ids)
+        cap = n if cap is None else cap
+        stats = np.zeros(n, dtype=np.int64)
+        symbols = np.where((ids >= 0) & (ids < len(self.id_to_token)), ids + 1, -1)
+        start = np.flatnonzero(symbols >= 0)  # start of each live search's span
+        if cap <= 0 or not len(start):
+            return stats
+        lo, hi = self.counts[symbols[start]], self.counts[symbols[start] + 1]
+        length = 1
+        while True:
+            live = lo < hi
+            start, lo, hi = start[live], lo[live], hi[live]
+            stats[start] = np.maximum(stats[start], length)
+            if length == cap:
+                break
+            start -= 1
+            keep = start >= 0
+            keep[keep] = symbols[start[keep]] >= 0
+            start, lo, hi = start[keep], lo[keep], hi[keep]
+            if not len(start):
+                break
+            c = symbols[start]
+            lo = self.counts[c] + self.bwt.rank_many(c, lo)
+            hi = self.counts[c] + self.bwt.rank_many(c, hi)
+            length += 1
+        return stats
+
+    def iter_matching_statistics(self, tokens: List[str], cap: Optional[int] = None) -> Iterator[int]:
+        return iter(self.matching_statistics_ids([self.vocab.get(t, -1) for t in tokens], cap).tolist())
+
+    def window_prefilter(self, tokens: List[str], n: int) -> Optional[np.ndarray]:
+        """Same as SuffixArrayIndex.window_prefilter"""
+        if self.prefilter is None or self.prefilter.n != n:
+            return None
+        return self.prefilter.contains_windows(np.array([self.vocab.get(t, -1) for t in tokens], dtype=np.int64))
+
+    def suffix_matcher(self, cap: int) -> "FMSuffixMatcher":
+        return FMSuffixMatcher(self, cap)
+
+    def save(self, path: str):
+        """Write the index as a directory of raw little-endian arrays plus a JSON header"""
+        logger.info(f"Saving FM-index to {path}")
+        os.makedirs(path, exist_ok=True)
+        levels = self.bwt.levels
+        arrays = {
+            "wavelet_words": write_array(path, "wavelet_words", np.concatenate([b.words for b in levels]), "<u8"),
+            "wavelet_superblocks": write_array(path, "wavelet_superblocks", np.concatenate([b.superblocks for b in levels]), "<i8"),
+            "wavelet_relative": write_array(path, "wavelet_relative", np.concatenate([b.relative for b in levels]), "<u2"),
+            "sampled_words": write_array(path, "sampled_words", self.sampled.words, "<u8"),
+            "sampled_superblocks": write_array(path, "sampled_superblocks", self.sampled.superblocks, "<i8"),
+            "sampled_relative": write_array(path, "sampled_relative", self.sampled.relative, "<u2"),
+            "samples": write_array(path, "samples", self.samples, _sample_dtype(self.n_tokens)),
+            "counts": write_array(path, "counts", self.counts, "<i8"),
+            "doc_offsets": write_array(path, "doc_offsets", self.doc_offsets, "<i8")
+        }
+        write_index(path, FM_FORMAT, self.n_tokens - len(self.doc_ids), self.id_to_token, self.doc_ids, arrays, self.prefilter,
+                    sample_rate=self.sample_rate, wavelet_zeros=list(self.bwt.zeros))
+        logger.info("FM-index saved.")
+
+    def load(self, path: str):
+        """Memory-map an FM-index directory written by save()"""
+        logger.info(f"Loading FM-index from {path}")
+        header, self.id_to_token, self.doc_ids, self.prefilter = read_index(path, FM_FORMAT)
+        arrays = header["arrays"]
+        self.vocab = {t: i for i, t in enumerate(self.id_to_token)}
+        self.doc_offsets = open_array(path, arrays["doc_offsets"])
+        self.counts = open_array(path, arrays["counts"])
+        self.samples = open_array(path, arrays["samples"])
+        self.sample_rate = header["sample_rate"]
+        self.n_tokens = header["n_tokens"] + header["n_docs"]
+        self.sampled = RankBits(*(open_array(path, arrays[f"sampled_{name}"]) for name in ("words", "superblocks", "relative")))
+        zeros = header["wavelet_zeros"]
+        words, superblocks, relative = (open_array(path, arrays[f"wavelet_{name}"]).reshape(len(zeros), -1)
+                                        for name in ("words", "superblocks", "relative"))
+        self.bwt = WaveletMatrix([RankBits(*parts) for parts in zip(words, superblocks, relative)], zeros, len(self.id_to_token) + 1)
+        self.path = path
+        logger.info("FM-index loaded successfully.")
+
+
+class FMSuffixMatcher:
+    """
+    Online longest corpus-attested suffix (at most cap tokens) of a growing token stream: each
+    push re-runs the backward search from the newest token over the last cap tokens, stopping
+    at the first token whose extension does not occur.
+    """
+
+    def __init__(self, index: FMIndex, cap: int):
+        self.index = index
+        self.cap = cap
+        self.recent: Tuple[int, ...] = ()  # ids of the last pushed tokens, back to the last unknown one
+
+    def push(self, token: str) -> int:
+        """Append a token and return the length of the new longest matching suffix"""
+        tid = self.index.vocab.get(token)
+        if tid is None:
+            self.recent = ()
+            return 0
+        self.recent = (self.recent + (tid,))[-self.cap:]
+        index, counts = self.index, self.index.counts
+        c = tid + 1
+        lo, hi = int(counts[c]), int(counts[c + 1])
+        length = 0
+        while lo < hi:
+            length += 1
+            if length == len(self.recent):
+                break
+            c = self.recent[-length - 1] + 1
+            base = int(counts[c])
+            lo, hi = index.bwt.rank_pair(c, lo, hi)
+            lo, hi = base + lo, base + hi
+        return length
+
+    def state(self) -> Tuple:
+        return self.recent
+
+    def restore(self, state: Tuple):
+        self.recent = state
+
+
+def _sample_dtype(n_tokens: int) -> str:
+    return "<u4" if n_tokens < 2 ** 32 else "<i8"
+
+
+def is_fm_index(path: str) -> bool:
+    try:
+        read_header(path, FM_FORMAT)
+    except (OSError, ValueError):
+        return False
+    return True
@@ -0,0 +1,122 @@
+# tracealign/index_store.py — On-Disk Layout Shared by Index Directories: JSON Header Plus Raw Arrays
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign.prefilter import NgramBloom
+
+# Every directory format (suffix array, FM-index, token stream, token probabilities) is
+# HEADER_FILE plus one raw little-endian .bin file per array, described in header["arrays"]
+INDEX_VERSION = 1
+HEADER_FILE = "header.json"
+
+
+class StringTable:
+    """Read-only sequence of strings over a memory-mapped UTF-8 blob and its int64 offsets"""
+
+    def __init__(self, path: str, blob_meta: Dict, offsets_meta: Dict):
+        self.blob = open_array(path, blob_meta)
+        self.offsets = open_array(path, offsets_meta)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        data = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        for i in range(len(offsets) - 1):
+            yield data[offsets[i]:offsets[i + 1]].decode("utf-8")
+
+
+def write_header(path: str, header: Dict):
+    tmp = os.path.join(path, HEADER_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp, os.path.join(path, HEADER_FILE))
+
+
+def read_header(path: str, fmt: str) -> Dict:
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        header = json.load(f)
+    if header.get("format") != fmt or header.get("version", 0) > INDEX_VERSION:
+        raise ValueError(f"Unsupported index format {header.get('format')} v{header.get('version')} at {path}")
+    return header
+
+
+def write_array(path: str, name: str, values, dtype: str) -> Dict:
+    arr = np.ascontiguousarray(values, dtype=dtype)
+    filename = f"{name}.bin"
+    arr.tofile(os.path.join(path, filename))
+    return {"file": filename, "dtype": dtype, "length": int(len(arr))}
+
+
+def encode_strings(strings) -> Tuple[np.ndarray, np.ndarray]:
+    """A string table's UTF-8 blob and int64 offsets"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def strings_fingerprint(blob: np.ndarray, offsets: np.ndarray) -> str:
+    """Digest of a string table's blob and offsets, equal exactly when the string sequences are"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(offsets, dtype="<i8").tobytes())
+    digest.update(np.ascontiguousarray(blob, dtype=np.uint8).tobytes())
+    return digest.hexdigest()
+
+
+def write_strings(path: str, name: str, strings) -> Dict[str, Dict]:
+    blob, offsets = encode_strings(strings)
+    return {
+        name: write_array(path, name, blob, "|u1"),
+        f"{name}_offsets": write_array(path, f"{name}_offsets", offsets, "<i8")
+    }
+
+
+def open_array(path: str, meta: Dict) -> np.ndarray:
+    if meta["length"] == 0:
+        # np.memmap cannot map an empty file
+        return np.empty(0, dtype=meta["dtype"])
+    return np.memmap(os.path.join(path, meta["file"]), dtype=meta["dtype"], mode="r", shape=(meta["length"],))
+
+
+def write_index(path: str, fmt: str, n_tokens: int, id_to_token: List[str], doc_ids, arrays: Dict[str, Dict],
+                prefilter: Optional[NgramBloom] = None, **sections) -> Dict:
+    """
+    Complete a span index directory whose backend-specific arrays are already written: add the
+    vocabulary, doc ids and prefilter bits, then the header with any further sections.
+    """
+    arrays.update(write_strings(path, "vocab", id_to_token))
+    arrays.update(write_strings(path, "doc_ids", doc_ids))
+    if prefilter is not None:
+        arrays["prefilter"] = write_array(path, "prefilter", prefilter.bits, "|u1")
+        sections["prefilter"] = prefilter.meta()
+    header = {
+        "format": fmt,
+        "version": INDEX_VERSION,
+        "n_tokens": int(n_tokens),
+        "n_docs": len(doc_ids),
+        "vocab_size": len(id_to_token),
+        "arrays": arrays,
+        **sections
+    }
+    write_header(path, header)
+    return header
+
+
+def read_index(path: str, fmt: str) -> Tuple[Dict, List[str], StringTable, Optional[NgramBloom]]:
+    """Header, vocabulary, doc ids and prefilter of a directory written by write_index()"""
+    header = read_header(path, fmt)
+    arrays = header["arrays"]
+    id_to_token = list(StringTable(path, arrays["vocab"], arrays["vocab_offsets"]))
+    doc_ids = StringTable(path, arrays["doc_ids"], arrays["doc_ids_offsets"])
+    prefilter = NgramBloom.from_meta(header["prefilter"], open_array(path, arrays["prefilter"])) if "prefilter" in header else None
+    return header, id_to_token, doc_ids, prefilter
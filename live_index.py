@@ -0,0 +1,147 @@
+# tracealign/live_index.py — Incrementally Updatable Index with Delta Segments and Background Merge
+
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.sharded_index import ShardedIndex
+
+logger = logging.getLogger("tracealign.live")
+
+
+class LiveIndex(ShardedIndex):
+    """
+    LSM-style index: a large sorted base plus small delta segments. add_document puts a document
+    into the active delta, which is re-sorted right away (it holds at most delta_tokens tokens)
+    so the document is queryable immediately; a full delta is frozen and a new one started.
+    Once the deltas hold merge_tokens tokens they are merged into the base by
+    SuffixArrayIndex.merge, in a background thread unless background=False.
+
+    Segments are never mutated once queryable: every change swaps in a new segment list, so
+    queries (which fan out across segments like ShardedIndex) always see a consistent snapshot.
+    generation increases with every change, letting caches of query results notice staleness.
+    """
+
+    def __init__(self, base: SuffixArrayIndex, delta_tokens: int = 1 << 16, merge_tokens: int = 1 << 20,
+                 background: bool = True):
+        super().__init__([base])
+        self.delta_tokens = delta_tokens
+        self.merge_tokens = merge_tokens
+        self.background = background
+        self.generation = 0
+        self.merges = 0
+        self._active: Optional[SuffixArrayIndex] = None  # last segment, while it still takes documents
+        self._active_docs: List[Tuple[str, np.ndarray]] = []
+        self._lock = threading.RLock()
+        self._merge_thread: Optional[threading.Thread] = None
+
+    @property
+    def base(self) -> SuffixArrayIndex:
+        return self.shards[0]
+
+    @property
+    def delta_size(self) -> int:
+        """Stream tokens held in delta segments, waiting to be merged"""
+        return sum(len(s.tokens) for s in self.shards[1:])
+
+    def _map(self, fn, shards=None) -> list:
+        # deltas are small, so fanning out to threads costs more than it saves
+        return [fn(s) for s in (self.shards if shards is None else shards)]
+
+    def _intern(self, token: str) -> int:
+        tid = self.vocab.get(token)
+        if tid is None:
+            tid = self.vocab[token] = len(self.id_to_token)
+            self.id_to_token.append(token)
+        return tid
+
+    def _segment(self, docs: List[Tuple[str, np.ndarray]]) -> SuffixArrayIndex:
+        segment = SuffixArrayIndex()
+        segment.vocab, segment.id_to_token = self.vocab, self.id_to_token
+        for doc_id, ids in docs:
+            segment.add_document_ids(doc_id, ids)
+        segment.build()
+        if self.base.prefilter is not None:
+            segment.build_prefilter(self.base.prefilter.n, self.base.prefilter.fpr)
+        if self.base.lsh is not None:
+            lsh = self.base.lsh
+            segment.build_lsh(lsh.window, lsh.shingle, lsh.bands, lsh.rows)
+        if self.base.doc_listing is not None:
+            segment.build_doc_listing()
+        return segment
+
+    def add_document(self, doc_id: str, tokens: List[str]):
+        """Index a document; it is visible to queries when this returns"""
+        with self._lock:
+            ids = np.fromiter((self._intern(t) for t in tokens), dtype=np.int32, count=len(tokens))
+            self._active_docs.append((doc_id, ids))
+            segment = self._segment(self._active_docs)
+            shards = self.shards[:-1] if self._active is not None else list(self.shards)
+            self.shards = shards + [segment]
+            if len(segment.tokens) >= self.delta_tokens:
+                self._active, self._active_docs = None, []
+            else:
+                self._active = segment
+            self.generation += 1
+            full = self.delta_size >= self.merge_tokens
+        if full:
+            self.merge(wait=not self.background)
+
+    def merge(self, wait: bool = True):
+        """
+        Merge every delta segment present now into the base; with wait, also after a merge already
+        running. A waiting merge runs on the calling thread, holding the lock so no other merge
+        starts meanwhile; only a merge that does not wait gets a thread of its own.
+        """
+        while True:
+            with self._lock:
+                running = self._merge_thread is not None and self._merge_thread.is_alive()
+                if not running:
+                    self._active, self._active_docs = None, []
+                    deltas = self.shards[1:]
+                    if not deltas:
+                        return
+                    if wait:
+                        self._merge(self.shards[0], deltas)
+                        return
+                    self._merge_thread = threading.Thread(target=self._merge, args=(self.shards[0], deltas),
+                                                          name="tracealign-merge", daemon=True)
+                    self._merge_thread.start()
+                thread = self._merge_thread
+            if not wait:
+                return
+            thread.join()
+            if not running:
+                return
+
+    def _merge(self, base: SuffixArrayIndex, deltas: List[SuffixArrayIndex]):
+        logger.info(f"Merging {len(deltas)} delta segments into the base index...")
+        if len(deltas) == 1:
+            delta = deltas[0]
+        else:
+            docs = []
+            for segment in deltas:
+                ends = np.append(segment.doc_offsets[1:], len(segment.tokens))
+                docs.extend((doc_id, segment.tokens[start:end - 1])
+                            for doc_id, start, end in zip(segment.doc_ids, segment.doc_offsets.tolist(), ends.tolist()))
+            delta = self._segment(docs)
+        merged = base.merge(delta)
+        with self._lock:
+            merged_ids = {id(s) for s in deltas}
+            self.shards = [merged] + [s for s in self.shards[1:] if id(s) not in merged_ids]
+            self.generation += 1
+            self.merges += 1
+        logger.info(f"Merge complete: {len(merged.doc_ids)} documents in the base index.")
+
+    def wait_for_merge(self):
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def save(self, path: str):
+        """Merge all deltas and write the base index with SuffixArrayIndex.save"""
+        self.merge(wait=True)
+        self.base.save(path)
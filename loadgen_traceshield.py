@@ -0,0 +1,101 @@
+# scripts/loadgen_traceshield.py — Closed-Loop Load Generator for the TraceShield Service
+
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+from itertools import islice
+from typing import Dict, List, Optional
+from tracealign.utils import iter_jsonl
+from tracealign.traceshield_server import TraceShieldClient, TraceShieldServer
+
+async def run_load(completions: List[Dict], concurrency: int, requests: int, mode: str, host: str = "127.0.0.1",
+                   port: int = 8765, unix_socket: Optional[str] = None) -> Dict:
+    """
+    concurrency clients, each on its own keep-alive connection, send requests back to back
+    (cycling through completions) until `requests` have been sent; returns client-side latency
+    percentiles, throughput and the server's /stats.
+    """
+    latencies, statuses = [], {}
+    counter = iter(range(requests))
+
+    async def client():
+        conn = TraceShieldClient(host, port, unix_socket)
+        try:
+            for i in counter:
+                start = time.perf_counter()
+                status, _ = await conn.request("POST", f"/{mode}", completions[i % len(completions)])
+                latencies.append((time.perf_counter() - start) * 1e3)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            await conn.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    stats_conn = TraceShieldClient(host, port, unix_socket)
+    _, server_stats = await stats_conn.request("GET", "/stats")
+    await stats_conn.close()
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "requests_per_s": round(len(latencies) / seconds, 1),
+        "p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3),
+        "statuses": statuses,
+        "server": server_stats
+    }
+
+async def run_local(args, completions: List[Dict], concurrency: int) -> Dict:
+    """Stand up an in-process server on an ephemeral port and load it"""
+    from tracealign.serve_traceshield import build_shield
+    shield = build_shield(args.index, args.probs, args.threshold, args.window_size, args.cache_mb)
+    server = TraceShieldServer(shield, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, max_pending=args.max_pending)
+    await server.start(port=0)
+    try:
+        host, port = server.address()
+        return await run_load(completions, concurrency, args.requests, args.mode, host, port)
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure TraceShield service latency and throughput under concurrency")
+    parser.add_argument("--prompts", required=True, help="JSONL file with a 'completion' per line, sent as {'text': ...}")
+    parser.add_argument("--limit", type=int, default=10000, help="Distinct completions to cycle through")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64], help="Concurrent clients; one run per value")
+    parser.add_argument("--mode", choices=["check", "explain"], default="check")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix_socket", default=None)
+    parser.add_argument("--index", default=None, help="Instead of a running server, start one in-process on this index")
+    parser.add_argument("--probs", default=None, help="Token probability JSON or binary store for the in-process server")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--window_size", type=int, default=8)
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=2.0)
+    parser.add_argument("--max_pending", type=int, default=1024)
+    parser.add_argument("--cache_mb", type=float, default=0)
+    parser.add_argument("--output", default=None, help="Also write the results as JSON")
+    args = parser.parse_args()
+    if args.index and not args.probs:
+        parser.error("--index needs --probs")
+
+    completions = [{"text": r["completion"]} for r in islice(iter_jsonl(args.prompts), args.limit)]
+    results = []
+    for concurrency in args.concurrency:
+        if args.index:
+            result = asyncio.run(run_local(args, completions, concurrency))
+        else:
+            result = asyncio.run(run_load(completions, concurrency, args.requests, args.mode, args.host, args.port, args.unix_socket))
+        results.append(result)
+        print(f"concurrency {concurrency:>4}: {result['requests_per_s']:>8.1f} req/s  p50 {result['p50_ms']:.2f}ms  "
+              f"p95 {result['p95_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms  mean batch {result['server']['mean_batch']:.1f}  "
+              f"statuses {result['statuses']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
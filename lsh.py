@@ -0,0 +1,169 @@
+# tracealign/lsh.py — MinHash LSH Tables for Near-Duplicate Span Tracing
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from tracealign.prefilter import HASH_BASE, _mix
+
+PERMUTATION_SEED = 0x2545F4914F6CDD1D  # spreads the per-permutation seeds of the MinHash family
+MAX_BUCKET = 64  # candidates taken from one band bucket per query window
+
+
+def shingle_hashes(ids: np.ndarray, k: int) -> np.ndarray:
+    """Mixed hash of the k-token shingle starting at each position along the last axis of ids"""
+    count = ids.shape[-1] - k + 1
+    if count <= 0:
+        return np.empty(ids.shape[:-1] + (0,), dtype=np.uint64)
+    values = ids.astype(np.uint64)
+    h = np.zeros(ids.shape[:-1] + (count,), dtype=np.uint64)
+    for j in range(k):
+        h = h * np.uint64(HASH_BASE) + values[..., j:j + count]
+    return _mix(h)
+
+
+def _distinct(rows: np.ndarray) -> np.ndarray:
+    ordered = np.sort(rows, axis=1)
+    return 1 + (ordered[:, 1:] != ordered[:, :-1]).sum(axis=1)
+
+
+def shingle_jaccard(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Row-wise Jaccard similarity of the shingle sets of two (rows, shingles) hash matrices, from
+    distinct counts of sorted rows: |A & B| = |A| + |B| - |A | B|. Duplicates within a row count
+    once, as in a set.
+    """
+    union = _distinct(np.concatenate([a, b], axis=1))
+    return (_distinct(a) + _distinct(b) - union) / union
+
+
+class SpanLSH:
+    """
+    MinHash signatures of every `window`-token window of the corpus (windows never span a
+    document terminator), over the window's set of k-token shingles. Each signature is cut into
+    `bands` bands of `rows` MinHash values; a band is hashed to a 32-bit key and kept as one
+    key-sorted table per band. Two windows with Jaccard similarity J share at least one band key
+    with probability 1 - (1 - J^rows)^bands, so a query only binary-searches each band table for
+    its own keys instead of comparing against the corpus. Candidates are then verified exactly.
+    """
+
+    def __init__(self, window: int = 8, shingle: int = 1, bands: int = 10, rows: int = 3,
+                 keys: Optional[np.ndarray] = None, positions: Optional[np.ndarray] = None):
+        if shingle > window:
+            raise ValueError(f"Shingles of {shingle} tokens do not fit in a {window}-token window")
+        self.window = window
+        self.shingle = shingle
+        self.bands = bands
+        self.rows = rows
+        self.keys = keys if keys is not None else np.empty((bands, 0), dtype=np.uint32)  # per band, sorted
+        self.positions = positions if positions is not None else np.empty((bands, 0), dtype=np.uint32)  # window starts, aligned with keys
+        self._seeds = _mix(np.arange(1, bands * rows + 1, dtype=np.uint64) * np.uint64(PERMUTATION_SEED))
+
+    def threshold(self) -> float:
+        """Jaccard similarity at which a window becomes a candidate with probability about 1/2"""
+        return (1 - 0.5 ** (1 / self.bands)) ** (1 / self.rows)
+
+    def candidate_probability(self, jaccard: float) -> float:
+        return 1 - (1 - jaccard ** self.rows) ** self.bands
+
+    def band_keys(self, ids: np.ndarray) -> np.ndarray:
+        """(bands, windows) band keys of every window of ids; windows with a negative id get meaningless keys"""
+        count = len(ids) - self.window + 1
+        if count <= 0:
+            return np.empty((self.bands, 0), dtype=np.uint32)
+        shingles = shingle_hashes(ids, self.shingle)
+        # one row of 32-bit hashes per permutation; their sliding minimum over a window's shingles is its MinHash
+        hashes = (_mix(shingles[None, :] ^ self._seeds[:, None]) >> np.uint64(32)).astype(np.uint32)
+        minimum = hashes[:, :count].copy()
+        for j in range(1, self.window - self.shingle + 1):
+            np.minimum(minimum, hashes[:, j:j + count], out=minimum)
+        minimum = minimum.reshape(self.bands, self.rows, count)
+        key = np.zeros((self.bands, count), dtype=np.uint64)
+        for row in range(self.rows):
+            key = key * np.uint64(HASH_BASE) + minimum[:, row]
+        return (_mix(key) >> np.uint64(32)).astype(np.uint32)
+
+    def _valid_windows(self, ids: np.ndarray) -> np.ndarray:
+        negative = np.concatenate([[0], np.cumsum(ids < 0)])
+        return negative[self.window:] == negative[:len(ids) - self.window + 1]
+
+    def _tables(self, stream: np.ndarray, offset: int, chunk: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Unsorted (bands, windows) keys and stream positions of every valid window of a stream"""
+        keys, positions = [], []
+        for start in range(0, max(1, len(stream) - self.window + 1), chunk):
+            ids = np.asarray(stream[start:start + chunk + self.window - 1], dtype=np.int64)
+            if len(ids) < self.window:
+                break
+            valid = np.flatnonzero(self._valid_windows(ids))
+            keys.append(self.band_keys(ids)[:, valid])
+            positions.append(valid + (offset + start))
+        if not keys:
+            return np.empty((self.bands, 0), dtype=np.uint32), np.empty(0, dtype=np.int64)
+        return np.concatenate(keys, axis=1), np.concatenate(positions)
+
+    def add_stream(self, stream: np.ndarray, offset: int = 0, chunk: int = 1 << 18):
+        """Index every window of an id stream whose first token sits at stream position offset"""
+        keys, positions = self._tables(stream, offset, chunk)
+        merged_keys = np.empty((self.bands, self.keys.shape[1] + keys.shape[1]), dtype=np.uint32)
+        # 32-bit positions while the stream allows, as the position tables dominate the size
+        dtype = self.positions.dtype if offset + len(stream) < 2 ** 32 else np.int64
+        merged_positions = np.empty(merged_keys.shape, dtype=dtype)
+        for band in range(self.bands):
+            order = np.argsort(keys[band], kind="stable")
+            new_keys = keys[band][order]
+            at = np.searchsorted(self.keys[band], new_keys, side="right")
+            merged_keys[band] = np.insert(self.keys[band], at, new_keys)
+            merged_positions[band] = np.insert(self.positions[band], at, positions[order])
+        self.keys, self.positions = merged_keys, merged_positions
+
+    def candidates(self, ids: np.ndarray, max_bucket: int = MAX_BUCKET) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (query window start, corpus window start) pairs sharing a band key, deduplicated. Each
+        band bucket contributes at most max_bucket corpus windows per query window, so windows
+        repeated throughout the corpus cannot flood the verification step.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        keys = self.band_keys(ids)
+        if keys.shape[1] == 0 or self.keys.shape[1] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        queries, found = [], []
+        for band in range(self.bands):
+            lo = np.searchsorted(self.keys[band], keys[band], side="left")
+            sizes = np.minimum(np.searchsorted(self.keys[band], keys[band], side="right") - lo, max_bucket)
+            total = int(sizes.sum())
+            if not total:
+                continue
+            owner = np.repeat(np.arange(len(sizes)), sizes)
+            rank = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            queries.append(owner)
+            found.append(self.positions[band][lo[owner] + rank])
+        if not queries:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        found = np.concatenate(found).astype(np.int64)
+        span = int(found.max()) + 1
+        pairs = np.unique(np.concatenate(queries) * span + found)
+        return pairs // span, pairs % span
+
+    def copy(self) -> "SpanLSH":
+        return SpanLSH(self.window, self.shingle, self.bands, self.rows, np.array(self.keys), np.array(self.positions))
+
+    def stats(self) -> Dict:
+        return {
+            "window": self.window,
+            "shingle": self.shingle,
+            "bands": self.bands,
+            "rows": self.rows,
+            "windows": int(self.keys.shape[1]),
+            "threshold": self.threshold(),
+            "bytes": int(self.keys.nbytes + self.positions.nbytes)
+        }
+
+    def meta(self) -> Dict:
+        return {"window": self.window, "shingle": self.shingle, "bands": self.bands, "rows": self.rows, "windows": int(self.keys.shape[1])}
+
+    @classmethod
+    def from_meta(cls, meta: Dict, keys: np.ndarray, positions: np.ndarray) -> "SpanLSH":
+        """Reattach the flat band tables written by save() to their (bands, windows) shape"""
+        shape = (meta["bands"], meta["windows"])
+        return cls(meta["window"], meta["shingle"], meta["bands"], meta["rows"], keys.reshape(shape), positions.reshape(shape))
+
@@ -0,0 +1,414 @@
+# tracealign/metrics.py — Opt-In Hot-Path Metrics, Prometheus Export and Sampling Profiler
+
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+from collections import Counter as TallyCounter
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("tracealign.metrics")
+
+# seconds; index lookups take tens of microseconds, batched checks and training penalties up to seconds
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# per-call counts such as vetoed tokens per decoding step
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# tracer calls InstrumentedTracer times, with the batch calls also counting their spans
+TIMED_TRACER_OPS = ("trace_span", "match_span", "count_span", "trace_spans", "match_spans", "count_spans", "interval",
+                    "trace_similar", "trace_similar_windows", "trace_documents", "trace_documents_many")
+BATCH_TRACER_OPS = ("trace_spans", "match_spans", "count_spans", "trace_documents_many")
+
+Labels = Tuple[Tuple[str, str], ...]
+INF_BUCKET = 'le="+Inf"'
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, value: float = 1):
+        self.value += value
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts[i] holds observations <= buckets[i], the last slot the rest"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (the largest bound for the overflow bucket)"""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def _series(name: str, labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return f"{name}{{{','.join(parts)}}}" if parts else name
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms keyed by name and labels, plus collectors: callables returning a
+    dict of gauge values read at export time (e.g. SpanCache.stats), so caches that already
+    count their hits cost nothing extra per lookup. Metric objects are created under a lock;
+    updates are plain increments, as each hot path records from one thread.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], Counter] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.collectors: Dict[str, Callable[[], Dict]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, **labels) -> Counter:
+        key = (name, tuple(sorted(labels.items())))
+        counter = self.counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self.counters.setdefault(key, Counter())
+        return counter
+
+    def histogram(self, name: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counter(name, **labels).inc(value)
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def timer(self, name: str, **labels) -> _Timer:
+        """Context manager observing its wall time (seconds) into a latency histogram"""
+        return _Timer(self.histogram(name, **labels))
+
+    def add_collector(self, prefix: str, fn: Callable[[], Dict]):
+        """Export the numeric values of fn() as gauges named prefix_<key>"""
+        self.collectors[prefix] = fn
+
+    def gauges(self) -> Dict[str, float]:
+        values = {}
+        for prefix, fn in list(self.collectors.items()):
+            try:
+                stats = fn()
+            except Exception:
+                logger.exception("Metrics collector %s failed", prefix)
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{prefix}_{key}"] = value
+        return values
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Plain-dict view of every metric, as handed to export callbacks"""
+        return {
+            "counters": {_series(name, labels): c.value for (name, labels), c in list(self.counters.items())},
+            "histograms": {_series(name, labels): {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                           for (name, labels), h in list(self.histograms.items())},
+            "gauges": self.gauges()
+        }
+
+    def to_prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines, typed = [], set()
+        for (name, labels), counter in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{_series(name, labels)} {_format_value(counter.value)}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(histogram.buckets, histogram.counts):
+                cumulative += n
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{_series(name + '_bucket', labels, le)} {cumulative}")
+            lines.append(f"{_series(name + '_bucket', labels, INF_BUCKET)} {histogram.count}")
+            lines.append(f"{_series(name + '_sum', labels)} {_format_value(histogram.sum)}")
+            lines.append(f"{_series(name + '_count', labels)} {histogram.count}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write to_prometheus() atomically, for the node exporter's textfile collector"""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def drain(self) -> Dict:
+        """
+        Picklable counter/histogram state, resetting it; merge() adds it to another registry.
+        Metrics are zeroed in place, since instrumented code may hold on to them.
+        """
+        with self._lock:
+            state = {
+                "counters": {key: c.value for key, c in self.counters.items() if c.value},
+                "histograms": {key: (h.buckets, list(h.counts), h.sum, h.count) for key, h in self.histograms.items() if h.count}
+            }
+            for counter in self.counters.values():
+                counter.value = 0.0
+            for histogram in self.histograms.values():
+                histogram.counts = [0] * len(histogram.counts)
+                histogram.sum, histogram.count = 0.0, 0
+        return state
+
+    def merge(self, state: Dict):
+        for (name, labels), value in state["counters"].items():
+            self.counter(name, **dict(labels)).inc(value)
+        for (name, labels), (buckets, counts, total, count) in state["histograms"].items():
+            histogram = self.histogram(name, buckets, **dict(labels))
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+
+class _NullMetric:
+    __slots__ = ()
+
+    def inc(self, value: float = 1):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_METRIC = _NullMetric()
+
+
+class NullRegistry:
+    """The registry while metrics are disabled: every call is a no-op returning shared objects"""
+    enabled = False
+
+    def counter(self, name: str, **labels) -> _NullMetric:
+        return _NULL_METRIC
+
+    def histogram(self, name: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels) -> _NullMetric:
+        return _NULL_METRIC
+
+    def inc(self, name: str, value: float = 1, **labels):
+        pass
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        pass
+
+    def timer(self, name: str, **labels) -> _NullMetric:
+        return _NULL_METRIC
+
+    def add_collector(self, prefix: str, fn: Callable[[], Dict]):
+        pass
+
+
+# instrumented code reads metrics.registry on every call, so enable()/disable() take effect at once
+registry = NullRegistry()
+
+
+def enable(new_registry: Optional[MetricsRegistry] = None) -> MetricsRegistry:
+    """Start recording into new_registry (default: the current one if enabled, else a fresh one)"""
+    global registry
+    if new_registry is None:
+        new_registry = registry if registry.enabled else MetricsRegistry()
+    registry = new_registry
+    return registry
+
+
+def disable():
+    global registry
+    registry = NullRegistry()
+
+
+class InstrumentedTracer:
+    """
+    A tracer whose lookups record tracer_call_seconds{op=...} latency histograms (and
+    tracer_spans_total for batch calls) in a registry. Only the methods the wrapped tracer has
+    are wrapped, so hasattr-based dispatch in TraceShield and ProvDecode is unchanged; every
+    other attribute is the wrapped tracer's. Wraps a CachedTracer to time cached lookups.
+    """
+
+    def __init__(self, tracer, metrics_registry: Optional[MetricsRegistry] = None):
+        self.tracer = tracer
+        self.registry = metrics_registry if metrics_registry is not None else registry
+
+    def __getattr__(self, name):
+        attr = getattr(self.__dict__["tracer"], name)
+        if name not in TIMED_TRACER_OPS or not callable(attr):
+            return attr
+        histogram = self.registry.histogram("tracer_call_seconds", op=name)
+        spans = self.registry.counter("tracer_spans_total", op=name) if name in BATCH_TRACER_OPS else None
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            histogram.observe(time.perf_counter() - start)
+            if spans is not None:
+                spans.inc(len(args[0]))
+            return result
+
+        self.__dict__[name] = timed  # later lookups skip __getattr__
+        return timed
+
+
+class MetricsExporter:
+    """
+    Background thread exporting a registry every `interval` seconds, as a Prometheus text file
+    and/or by calling callback(snapshot); stop() exports once more so the last interval is kept.
+    """
+
+    def __init__(self, metrics_registry: MetricsRegistry, path: Optional[str] = None,
+                 callback: Optional[Callable[[Dict], None]] = None, interval: float = 10.0):
+        self.registry = metrics_registry
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self):
+        if self.path:
+            self.registry.write_prometheus(self.path)
+        if self.callback is not None:
+            self.callback(self.registry.snapshot())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except Exception:
+                logger.exception("Metrics export failed")
+
+    def start(self) -> "MetricsExporter":
+        self._thread = threading.Thread(target=self._run, name="tracealign-metrics", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+
+class SamplingProfiler:
+    """
+    Opt-in statistical profiler: a daemon thread samples the Python stack of the profiled
+    threads every `interval` seconds through sys._current_frames, so the profiled code runs
+    untouched (no tracing hooks). Stacks are tallied as collapsed "outer;...;inner" lines, the
+    input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_ids: Optional[List[int]] = None, max_depth: int = 64):
+        self.interval = interval
+        self.thread_ids = thread_ids  # None: every thread but the profiler's own
+        self.max_depth = max_depth
+        self.stacks: TallyCounter = TallyCounter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> "SamplingProfiler":
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tracealign-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def top(self, n: int = 20) -> List[Tuple[str, float]]:
+        """Functions with the largest share of samples on top of the stack (self time)"""
+        self_counts: TallyCounter = TallyCounter()
+        for stack, count in self.stacks.items():
+            self_counts[stack.rsplit(";", 1)[-1]] += count
+        total = max(1, sum(self_counts.values()))
+        return [(name, count / total) for name, count in self_counts.most_common(n)]
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
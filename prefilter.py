@@ -0,0 +1,139 @@
+# tracealign/prefilter.py — Hashed N-gram Bloom Prefilter for Suffix Array Lookups
+
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+MASK64 = (1 << 64) - 1
+HASH_BASE = 0x100000001B3  # polynomial base of the n-gram hash (the 64-bit FNV prime)
+PROBE_SEED = 0x9E3779B97F4A7C15  # decorrelates the second probe hash from the first
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer over uint64 arrays (wrapping arithmetic)"""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def _mix_scalar(h: int) -> int:
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK64
+    return h ^ (h >> 31)
+
+
+class NgramBloom:
+    """
+    Bloom filter over the polynomial hashes of every n-token window of the corpus (windows never
+    span a document terminator). A window that is not in the filter does not occur in the corpus;
+    one that is occurs with probability 1 - expected_fpr(). Lookups hash the window once and test
+    k bits chosen by double hashing, so a negative usually stops after the first probe or two.
+    """
+
+    def __init__(self, n: int, m: int, k: int, bits: Optional[np.ndarray] = None, items: int = 0, fpr: float = 0.01):
+        self.n = n
+        self.m = m  # bits
+        self.k = k  # probes per window
+        self.bits = bits if bits is not None else np.zeros((m + 7) // 8, dtype=np.uint8)
+        self.items = items  # windows added, duplicates included
+        self.fpr = fpr  # target false-positive rate the filter was sized for
+        self._view = memoryview(self.bits).cast("B")  # plain int indexing for the scalar path, same buffer
+        self._powers = np.array([pow(HASH_BASE, n - 1 - j, 1 << 64) for j in range(n)], dtype=np.uint64)
+
+    @classmethod
+    def for_capacity(cls, n: int, capacity: int, fpr: float = 0.01) -> "NgramBloom":
+        """Size a filter for capacity windows at the target false-positive rate"""
+        capacity = max(1, capacity)
+        m = max(64, int(math.ceil(-capacity * math.log(fpr) / math.log(2) ** 2)))
+        k = max(1, int(round(m / capacity * math.log(2))))
+        return cls(n, m, k, fpr=fpr)
+
+    def window_hashes(self, ids: np.ndarray) -> np.ndarray:
+        """Hash of the window starting at each position of ids (len(ids) - n + 1 of them)"""
+        count = len(ids) - self.n + 1
+        if count <= 0:
+            return np.empty(0, dtype=np.uint64)
+        values = ids.astype(np.uint64)
+        h = np.zeros(count, dtype=np.uint64)
+        for j in range(self.n):
+            h += values[j:j + count] * self._powers[j]
+        return h
+
+    def _valid_windows(self, ids: np.ndarray) -> np.ndarray:
+        """Windows without a negative id (terminator or unknown token)"""
+        negative = np.concatenate([[0], np.cumsum(ids < 0)])
+        return negative[self.n:] == negative[:len(ids) - self.n + 1]
+
+    def _probes(self, hashes: np.ndarray) -> np.ndarray:
+        h1 = _mix(hashes)
+        h2 = _mix(hashes ^ np.uint64(PROBE_SEED)) | np.uint64(1)
+        steps = np.arange(self.k, dtype=np.uint64)[:, None]
+        return (h1 + steps * h2) % np.uint64(self.m)
+
+    def add(self, ids: np.ndarray):
+        """Add every window of an id stream (terminators and negative ids break windows)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) < self.n:
+            return
+        hashes = self.window_hashes(ids)[self._valid_windows(ids)]
+        probes = self._probes(hashes).ravel()
+        np.bitwise_or.at(self.bits, (probes >> np.uint64(3)).astype(np.int64),
+                         np.left_shift(1, (probes & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+        self.items += len(hashes)
+
+    def add_stream(self, stream: np.ndarray, chunk: int = 1 << 22):
+        """add() over a large (memory-mapped) stream in overlapping chunks"""
+        for start in range(0, max(1, len(stream) - self.n + 1), chunk):
+            self.add(np.asarray(stream[start:start + chunk + self.n - 1]))
+
+    def contains_windows(self, ids: np.ndarray) -> np.ndarray:
+        """For each window start of ids, whether the window may occur; False is exact"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) < self.n:
+            return np.zeros(0, dtype=bool)
+        probes = self._probes(self.window_hashes(ids))
+        hit = (self.bits[(probes >> np.uint64(3)).astype(np.int64)] >> (probes & np.uint64(7)).astype(np.uint8)) & 1
+        return hit.all(axis=0) & self._valid_windows(ids)
+
+    def may_contain(self, ids: List[int]) -> bool:
+        """Whether a span of ids may occur: all of its windows must pass. Spans shorter than n always may"""
+        n, m, bits = self.n, self.m, self._view
+        for start in range(len(ids) - n + 1):
+            h = 0
+            for tid in ids[start:start + n]:
+                h = (h * HASH_BASE + tid) & MASK64
+            h1, h2 = _mix_scalar(h), _mix_scalar(h ^ PROBE_SEED) | 1
+            for i in range(self.k):
+                p = ((h1 + i * h2) & MASK64) % m
+                if not (bits[p >> 3] >> (p & 7)) & 1:
+                    return False
+        return True
+
+    def copy(self) -> "NgramBloom":
+        return NgramBloom(self.n, self.m, self.k, np.array(self.bits), self.items, self.fpr)
+
+    def expected_fpr(self) -> float:
+        """False-positive rate implied by the fraction of bits set"""
+        chunk = 1 << 24
+        ones = sum(int(POPCOUNT[self.bits[i:i + chunk]].sum(dtype=np.int64)) for i in range(0, len(self.bits), chunk))
+        return (ones / self.m) ** self.k if self.m else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "n": self.n,
+            "bits": self.m,
+            "probes": self.k,
+            "items": self.items,
+            "bits_per_item": self.m / max(1, self.items),
+            "target_fpr": self.fpr,
+            "expected_fpr": self.expected_fpr()
+        }
+
+    def meta(self) -> Dict:
+        return {"n": self.n, "m": self.m, "k": self.k, "items": self.items, "fpr": self.fpr}
+
+    @classmethod
+    def from_meta(cls, meta: Dict, bits: np.ndarray) -> "NgramBloom":
+        return cls(meta["n"], meta["m"], meta["k"], bits, meta["items"], meta["fpr"])
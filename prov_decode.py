@@ -1,60 +1,299 @@
 # tracealign/prov_decode.py — Provenance-Aware Logit Filtering for Safer Decoding
- 
+
+import time
 import logging
-from typing import List
- 
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign import metrics
+
+try:
+    from transformers import LogitsProcessor
+except ImportError:  # transformers is only needed for ProvLogitsProcessor inside model.generate
+    LogitsProcessor = object
+
 logger = logging.getLogger("tracealign.prov")
-logger.setLevel(logging.INFO)
- 
+
+class ContextCache:
+    """
+    Bounded LRU of suffix array intervals and successor risks keyed by context window, for one
+    decoding sequence. Entries only depend on the context, so fork() can hand a copy to each
+    beam that splits off; forks share the hit/miss counters of their lineage. previous is the
+    context resolved last, which the next step's window usually slides from.
+    """
+
+    def __init__(self, capacity: int = 4096, counters: Optional[Dict[str, int]] = None):
+        self.capacity = capacity
+        # context -> [interval, risks, (vocab, risky positions), intervals of context[-1:], context[-2:], ...]
+        self.entries: "OrderedDict[Tuple[str, ...], list]" = OrderedDict()
+        self.counters = counters if counters is not None else {"hits": 0, "misses": 0, "extended": 0, "evictions": 0}
+        self.generation = None  # tracer generation the entries were computed against, for indexes that change
+        self.previous: Optional[Tuple[str, ...]] = None
+
+    def get(self, key: Tuple[str, ...]) -> Optional[list]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple[str, ...], entry: list):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def fork(self) -> "ContextCache":
+        clone = ContextCache(self.capacity, self.counters)
+        clone.entries = OrderedDict(self.entries)
+        clone.generation = self.generation
+        clone.previous = self.previous
+        return clone
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return dict(self.counters, size=len(self.entries), hit_rate=self.counters["hits"] / lookups if lookups else 0.0)
+
+
+def _record_step(op: str, vetoed: int, start: float, counters: Optional[Dict[str, int]], before: Optional[Dict[str, int]]):
+    """Latency, vetoed candidates and context cache activity of one decoding step (metrics enabled only)"""
+    registry = metrics.registry
+    registry.observe("prov_step_seconds", time.perf_counter() - start, op=op)
+    registry.observe("prov_vetoed_tokens", vetoed, metrics.COUNT_BUCKETS, op=op)
+    if counters is not None:
+        for name in ("hits", "misses", "extended"):
+            registry.inc(f"prov_context_cache_{name}_total", counters[name] - before[name])
+
+
 class ProvDecode:
-	def __init__(self, tracer, bci_model, bci_threshold: float, gamma: float = 1.0, context_window: int = 8):
-  	  self.tracer = tracer
-    	self.bci = bci_model
-    	self.threshold = bci_threshold
-    	self.gamma = gamma
-    	self.window = context_window
- 
-	def extract_span(self, prefix: List[str], candidate: str) -> List[str]:
-    	"""Combine prefix window and candidate token to form a traceable span"""
-    	context = prefix[-self.window:] if len(prefix) >= self.window else prefix
-    	return context + [candidate]
- 
-	def compute_risk(self, span: List[str]) -> float:
-    	matches = self.tracer.trace_span(span)
-    	if not matches:
-        	return 0.0
-    	risk_scores = [self.bci.compute_bci(m['span']) for m in matches if 'span' in m]
-    	return max(risk_scores) if risk_scores else 0.0
- 
-	def veto(self, prefix: List[str], token: str) -> bool:
-    	span = self.extract_span(prefix, token)
-    	risk = self.compute_risk(span)
-    	if risk > self.threshold:
-        	logger.debug(f"Token '{token}' vetoed due to BCI={risk:.2f} > {self.threshold:.2f}")
-        	return True
-    	return False
- 
-	def adjust_logits(self, prefix: List[str], vocab: List[str], logits: List[float]) -> List[float]:
-    	"""
-    	Penalize logits for high-risk tokens during decoding.
-       
-    	Parameters:
-        	prefix: Current generation context
-        	vocab: List of candidate tokens
-        	logits: List of original token logits
- 
-    	Returns:
-        	Modified logits penalizing unsafe tokens
-    	"""
-    	adjusted = []
-    	for i, tok in enumerate(vocab):
-        	span = self.extract_span(prefix, tok)
-        	risk = self.compute_risk(span)
-        	penalty = self.gamma if risk > self.threshold else 0.0
-        	adjusted.append(logits[i] - penalty)
-    	return adjusted
- 
-	def rank_tokens(self, prefix: List[str], vocab: List[str]) -> List[tuple]:
-    	"""Sort tokens by their provenance risk score"""
-    	scores = [(tok, self.compute_risk(self.extract_span(prefix, tok))) for tok in vocab]
-    	return sorted(scores, key=lambda x: -x[1])
+    def __init__(self, tracer, bci_model, bci_threshold: float, gamma: float = 1.0, context_window: int = 8,
+                 cache_size: int = 4096):
+        self.tracer = tracer
+        self.bci = bci_model
+        self.threshold = bci_threshold
+        self.gamma = gamma
+        self.window = context_window
+        self.cache_size = cache_size
+        self.cache = ContextCache(cache_size) if cache_size > 0 else None
+        self._vocab_ref = None
+        self._vocab_positions: Dict[str, List[int]] = {}
+
+    def context(self, prefix: List[str]) -> List[str]:
+        """Trailing window of the prefix that every candidate span extends"""
+        return prefix[-self.window:] if len(prefix) >= self.window else prefix
+
+    def extract_span(self, prefix: List[str], candidate: str) -> List[str]:
+        """Combine prefix window and candidate token to form a traceable span"""
+        return self.context(prefix) + [candidate]
+
+    def compute_risk(self, span: List[str]) -> float:
+        matches = self.tracer.trace_span(span)
+        if not matches:
+            return 0.0
+        risk_scores = [self.bci.compute_bci(m['span']) for m in matches if 'span' in m]
+        return max(risk_scores) if risk_scores else 0.0
+
+    def compute_risks(self, spans: List[List[str]]) -> List[float]:
+        """compute_risk of many spans, traced in one batch when the tracer supports it"""
+        if not hasattr(self.tracer, "trace_spans"):
+            return [self.compute_risk(span) for span in spans]
+        return [max((self.bci.compute_bci(m['span']) for m in matches if 'span' in m), default=0.0)
+                for matches in self.tracer.trace_spans(spans)]
+
+    def veto(self, prefix: List[str], token: str) -> bool:
+        if hasattr(self.tracer, "successors"):
+            risk = self.successor_risks(prefix).get(token, 0.0)
+        else:
+            risk = self.compute_risk(self.extract_span(prefix, token))
+        if risk > self.threshold:
+            logger.debug("Token '%s' vetoed due to BCI=%.2f > %.2f", token, risk, self.threshold)
+            if metrics.registry.enabled:
+                metrics.registry.inc("prov_vetoes_total")
+            return True
+        return False
+
+    def _context_entry(self, context: List[str], cache: Optional[ContextCache]) -> list:
+        """
+        Cache entry for a context window. A miss whose context[:-1] ends a cached context (the
+        context one token shorter during warm-up, or the previous window once it slides) extends
+        each of that entry's suffix intervals by the new token instead of searching from scratch.
+        """
+        key = tuple(context)
+        if cache is None:
+            return [self.tracer.interval(context), None, None, None]
+        generation = getattr(self.tracer, "generation", None)
+        if cache.generation != generation:
+            # documents were added to (or merged into) a LiveIndex since these entries were computed
+            cache.entries.clear()
+            cache.generation, cache.previous = generation, None
+        entry = cache.get(key)
+        if entry is not None:
+            cache.counters["hits"] += 1
+            cache.previous = key
+            return entry
+        parent = self._parent_entry(key, cache)
+        token_id = self.tracer.vocab.get(key[-1]) if key else None
+        if parent is not None and token_id is not None:
+            # parent[3][l - 1] is the interval of key[-l - 1:-1]; one more token makes key[-l - 1:]
+            suffixes = [self.tracer.interval(list(key[-1:]))]
+            suffixes += [self.tracer.extend_interval(parent[3][l - 1], l, token_id) for l in range(1, len(key))]
+            cache.counters["extended"] += 1
+        else:
+            suffixes = self._suffix_intervals(key)
+        entry = [suffixes[-1] if suffixes else self.tracer.interval(context), None, None, suffixes]
+        cache.counters["misses"] += 1
+        cache.put(key, entry)
+        cache.previous = key
+        return entry
+
+    @staticmethod
+    def _parent_entry(key: Tuple[str, ...], cache: ContextCache) -> Optional[list]:
+        """A cached entry whose context ends with key[:-1], so its suffix intervals cover key[:-1]'s"""
+        if len(key) < 2:
+            return None
+        parent = cache.entries.get(key[:-1])
+        if parent is not None:
+            return parent
+        previous = cache.previous
+        if previous is not None and len(previous) >= len(key) - 1 and previous[len(previous) - len(key) + 1:] == key[:-1]:
+            return cache.entries.get(previous)
+        return None
+
+    def _suffix_intervals(self, key: Tuple[str, ...]) -> list:
+        """Intervals of key[-1:], key[-2:], ..., key, in one batch when the tracer supports it"""
+        suffixes = [list(key[len(key) - l:]) for l in range(1, len(key) + 1)]
+        if hasattr(self.tracer, "intervals"):
+            return list(self.tracer.intervals(suffixes))
+        return [self.tracer.interval(span) for span in suffixes]
+
+    def _entry_risks(self, entry: list, context: List[str]) -> Dict[str, float]:
+        if entry[1] is None:
+            id_to_token = self.tracer.id_to_token
+            following = self.tracer.interval_successors(entry[0], len(context)).tolist()
+            entry[1] = {tok: self.bci.compute_bci(context + [tok]) for tok in (id_to_token[i] for i in following)}
+        return entry[1]
+
+    def successor_risks(self, prefix: List[str], cache: Optional[ContextCache] = None) -> Dict[str, float]:
+        """
+        Risk of every token that follows the context window somewhere in the corpus, from one
+        (cached) interval lookup. Any other candidate forms an unattested span and has risk 0.
+        """
+        context = self.context(prefix)
+        entry = self._context_entry(context, cache if cache is not None else self.cache)
+        return self._entry_risks(entry, context)
+
+    def _positions(self, vocab: List[str]) -> Dict[str, List[int]]:
+        # vocab lists are treated as immutable and indexed once per list object
+        if self._vocab_ref is not vocab:
+            positions: Dict[str, List[int]] = {}
+            for i, tok in enumerate(vocab):
+                positions.setdefault(tok, []).append(i)
+            self._vocab_ref, self._vocab_positions = vocab, positions
+        return self._vocab_positions
+
+    def risky_positions(self, prefix: List[str], vocab: List[str], cache: Optional[ContextCache] = None) -> List[int]:
+        """Indices into vocab of the candidates whose span risk exceeds the threshold"""
+        if not hasattr(self.tracer, "successors"):
+            risks = self.compute_risks([self.extract_span(prefix, tok) for tok in vocab])
+            return [i for i, risk in enumerate(risks) if risk > self.threshold]
+        context = self.context(prefix)
+        entry = self._context_entry(context, cache if cache is not None else self.cache)
+        if entry[2] is not None and entry[2][0] is vocab:
+            return entry[2][1]
+        positions = self._positions(vocab)
+        risky = []
+        for tok, risk in self._entry_risks(entry, context).items():
+            if risk > self.threshold:
+                risky.extend(positions.get(tok, ()))
+        risky.sort()
+        entry[2] = (vocab, risky)
+        return risky
+
+    def adjust_logits(self, prefix: List[str], vocab: List[str], logits: List[float]) -> List[float]:
+        """
+        Penalize logits for high-risk tokens during decoding.
+
+        Parameters:
+            prefix: Current generation context
+            vocab: List of candidate tokens
+            logits: List of original token logits
+
+        Returns:
+            Modified logits penalizing unsafe tokens
+        """
+        start = time.perf_counter() if metrics.registry.enabled else None
+        before = dict(self.cache.counters) if start is not None and self.cache is not None else None
+        risky = self.risky_positions(prefix, vocab)
+        mask = np.zeros(len(vocab), dtype=bool)
+        mask[risky] = True
+        scores = np.asarray(logits, dtype=np.float64)
+        adjusted = np.where(mask, scores - self.gamma, scores).tolist()
+        if start is not None:
+            _record_step("adjust_logits", len(risky), start, self.cache.counters if self.cache is not None else None, before)
+        return adjusted
+
+    def rank_tokens(self, prefix: List[str], vocab: List[str]) -> List[tuple]:
+        """Sort tokens by their provenance risk score"""
+        if not hasattr(self.tracer, "successors"):
+            scores = list(zip(vocab, self.compute_risks([self.extract_span(prefix, tok) for tok in vocab])))
+        else:
+            risks = self.successor_risks(prefix)
+            scores = [(tok, risks.get(tok, 0.0)) for tok in vocab]
+        return sorted(scores, key=lambda x: -x[1])
+
+
+class ProvLogitsProcessor(LogitsProcessor):
+    """
+    ProvDecode as a transformers LogitsProcessor for model.generate: every row of the scores
+    (batch × beams) is penalized from its own last context_window tokens. Each row keeps its own
+    ContextCache, inherited from the row it was extended from and forked when beams split.
+    """
+
+    def __init__(self, prov: ProvDecode, vocab: List[str]):
+        self.prov = prov
+        self.vocab = vocab  # decoded string of every model token id, see decode_vocab
+        self.counters = {"hits": 0, "misses": 0, "extended": 0, "evictions": 0}
+        self._caches: Dict[Tuple[int, ...], ContextCache] = {}  # last context_window + 1 ids of a row -> its cache
+
+    def _row_cache(self, ids: List[int], claimed: set) -> Optional[ContextCache]:
+        if self.prov.cache_size <= 0:
+            return None
+        parent = tuple(ids[-self.prov.window - 2:-1])
+        cache = self._caches.get(parent)
+        if cache is None:
+            return ContextCache(self.prov.cache_size, self.counters)
+        if parent in claimed:
+            return cache.fork()
+        claimed.add(parent)
+        return cache
+
+    def __call__(self, input_ids, scores):
+        start = time.perf_counter() if metrics.registry.enabled else None
+        before = dict(self.counters) if start is not None else None
+        vetoed = 0
+        caches: Dict[Tuple[int, ...], ContextCache] = {}
+        claimed: set = set()
+        for row, ids in enumerate(input_ids[:, -self.prov.window - 2:].tolist()):
+            cache = self._row_cache(ids, claimed)
+            if cache is not None:
+                caches[tuple(ids[-self.prov.window - 1:])] = cache
+            prefix = [self.vocab[i] for i in ids[-self.prov.window:] if i < len(self.vocab)]
+            risky = self.prov.risky_positions(prefix, self.vocab, cache)
+            if risky:
+                scores[row, risky] -= self.prov.gamma
+                vetoed += len(risky)
+        self._caches = caches
+        if start is not None:
+            _record_step("logits_processor", vetoed, start, self.counters, before)
+        return scores
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return dict(self.counters, sequences=len(self._caches), hit_rate=self.counters["hits"] / lookups if lookups else 0.0)
+
+
+def decode_vocab(tokenizer, size: Optional[int] = None) -> List[str]:
+    """Decode every token id once; reuse the list across adjust_logits calls and the processor"""
+    return [tokenizer.decode([i]) for i in range(size if size is not None else len(tokenizer))]
@@ -1,52 +1,69 @@
 # scripts/run_cbd_training.py — Finetune a Model with CBD Loss
- 
+
 import argparse
 from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments
 from trl import DPOConfig
 from tracealign.cbd_loss import CBDDPOTrainer
-from tracealign.traceindex import SuffixArrayIndex
+from tracealign.sharded_index import open_index
 from tracealign.bci import BeliefConflictIndex
- 
+from tracealign import metrics
+from tracealign.metrics import MetricsExporter
+from tracealign.utils import setup_logging
+
 def main():
-	parser = argparse.ArgumentParser()
-	parser.add_argument("--model", type=str, required=True)
-	parser.add_argument("--ref_model", type=str, required=True)
-	parser.add_argument("--token_probs", type=str, required=True)
-	parser.add_argument("--suffix_index", type=str, required=True)
-	parser.add_argument("--dataset", type=str, required=True)
-	parser.add_argument("--output", type=str, required=True)
-	parser.add_argument("--threshold", type=float, default=10.0)
-	args = parser.parse_args()
- 
-	tokenizer = AutoTokenizer.from_pretrained(args.model)
-	model = AutoModelForCausalLM.from_pretrained(args.model)
-	ref_model = AutoModelForCausalLM.from_pretrained(args.ref_model)
- 
-	token_probs = BeliefConflictIndex.load_token_probs(args.token_probs)
-	bci = BeliefConflictIndex(token_probs)
-	index = SuffixArrayIndex()
-	index.load(args.suffix_index)
- 
-	trainer = CBDDPOTrainer(
-    	model=model,
-    	ref_model=ref_model,
-    	tokenizer=tokenizer,
-    	args=TrainingArguments(
-        	output_dir=args.output,
-        	per_device_train_batch_size=2,
-        	evaluation_strategy="no",
-        	save_strategy="epoch",
-        	num_train_epochs=3,
-        	learning_rate=5e-5
-    	),
-    	tracer=index,
-    	bci_model=bci,
-    	bci_threshold=args.threshold,
-    	lambda_penalty=0.01
-	)
- 
-	trainer.train()
-	trainer.save_model(args.output)
- 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--ref_model", type=str, required=True)
+    parser.add_argument("--token_probs", type=str, required=True)
+    parser.add_argument("--suffix_index", type=str, required=True)
+    parser.add_argument("--dataset", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--window_size", type=int, default=8)
+    parser.add_argument("--penalty_workers", type=int, default=0, help="Worker pool size for CBD tracing (0 = in-process)")
+    parser.add_argument("--async_penalty", action="store_true", help="Trace the CBD penalty while backward() runs")
+    parser.add_argument("--metrics_file", default=None, help="Write per-step and CBD penalty time histograms here in Prometheus text format")
+    parser.add_argument("--metrics_interval", type=float, default=30.0, help="Seconds between metrics file updates")
+    args = parser.parse_args()
+    setup_logging()
+    exporter = MetricsExporter(metrics.enable(), args.metrics_file, interval=args.metrics_interval).start() if args.metrics_file else None
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model)
+    ref_model = AutoModelForCausalLM.from_pretrained(args.ref_model)
+
+    index = open_index(args.suffix_index)
+    bci = BeliefConflictIndex.load(args.token_probs, index.vocab)
+
+    trainer = CBDDPOTrainer(
+        model=model,
+        ref_model=ref_model,
+        tokenizer=tokenizer,
+        args=TrainingArguments(
+            output_dir=args.output,
+            per_device_train_batch_size=2,
+            evaluation_strategy="no",
+            save_strategy="epoch",
+            num_train_epochs=3,
+            learning_rate=5e-5
+        ),
+        tracer=index,
+        bci_model=bci,
+        bci_threshold=args.threshold,
+        lambda_penalty=0.01,
+        window_size=args.window_size,
+        penalty_workers=args.penalty_workers,
+        async_penalty=args.async_penalty
+    )
+
+    trainer.train()
+    trainer.close_penalty_pool()
+    if exporter is not None:
+        exporter.stop()
+    report = trainer.timing_report()
+    print(f"Mean step time: {report['step_seconds']:.3f}s with CBD penalty, "
+          f"{report['step_seconds_without_penalty']:.3f}s without")
+    trainer.save_model(args.output)
+
 if __name__ == "__main__":
-	main()
+    main()
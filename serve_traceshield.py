@@ -0,0 +1,79 @@
+# scripts/serve_traceshield.py — Run TraceShield as a Local Micro-Batching Service
+
+import argparse
+import asyncio
+from typing import Optional
+from tracealign import metrics
+from tracealign.utils import soft_tokenize, HFTokenizerFn, setup_logging
+from tracealign.sharded_index import open_index
+from tracealign.bci import BeliefConflictIndex
+from tracealign.traceshield import TraceShield
+from tracealign.span_cache import SpanCache, CachedTracer, CachedBCI
+from tracealign.traceshield_server import TraceShieldServer
+from tracealign.metrics import InstrumentedTracer, MetricsExporter, SamplingProfiler
+
+def build_shield(index_path: str, probs_path: str, threshold: float, window_size: int, cache_mb: float = 0,
+                 cache_policy: str = "lru", instrument: bool = False, fuzzy_jaccard: Optional[float] = None) -> TraceShield:
+    """instrument times the tracer's lookups into the metrics registry (enable metrics first)"""
+    tracer = open_index(index_path)
+    bci = BeliefConflictIndex.load(probs_path, getattr(tracer, "vocab", None))
+    if cache_mb > 0:
+        cache = SpanCache(int(cache_mb * (1 << 20)), cache_policy)
+        tracer, bci = CachedTracer(tracer, cache), CachedBCI(bci, cache)
+        metrics.registry.add_collector("span_cache", cache.stats)
+    if instrument:
+        tracer = InstrumentedTracer(tracer)
+    return TraceShield(tracer, bci, threshold, window_size=window_size, fuzzy_jaccard=fuzzy_jaccard)
+
+async def serve(server: TraceShieldServer, host: str, port: int, unix_socket: str = None):
+    listener = await server.start(host, port, unix_socket)
+    try:
+        await listener.serve_forever()
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve TraceShield check/explain requests over HTTP, sharing one loaded index")
+    parser.add_argument("--index", required=True, help="Path to the suffix array, FM or sharded index")
+    parser.add_argument("--probs", required=True, help="Token probability JSON or binary store")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--window_size", type=int, default=8, help="TraceShield window in tokens")
+    parser.add_argument("--fuzzy_jaccard", type=float, default=None,
+                        help="Also refuse windows this similar to a high-BCI corpus window (index built with --lsh_window)")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer for {'text': ...} requests (default: soft_tokenize)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix_socket", default=None, help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--max_batch", type=int, default=64, help="Requests coalesced into one batched lookup")
+    parser.add_argument("--max_wait_ms", type=float, default=2.0, help="Longest a request waits for its batch to fill")
+    parser.add_argument("--max_pending", type=int, default=1024, help="Queued requests before answering 503")
+    parser.add_argument("--cache_mb", type=float, default=0, help="Span-result cache budget (0 = no cache)")
+    parser.add_argument("--cache_policy", choices=["lru", "tinylfu"], default="lru")
+    parser.add_argument("--metrics", action="store_true", help="Record latency histograms and counters, served on GET /metrics")
+    parser.add_argument("--metrics_file", default=None, help="Also write the metrics here in Prometheus text format (implies --metrics)")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between metrics file updates")
+    parser.add_argument("--profile", default=None, help="Write sampling-profiler stacks (collapsed, for flame graphs) here on shutdown")
+    args = parser.parse_args()
+    setup_logging()
+
+    instrument = args.metrics or args.metrics_file is not None
+    registry = metrics.enable() if instrument else None
+    shield = build_shield(args.index, args.probs, args.threshold, args.window_size, args.cache_mb, args.cache_policy, instrument,
+                          args.fuzzy_jaccard)
+    tokenizer_fn = HFTokenizerFn(args.tokenizer) if args.tokenizer else soft_tokenize
+    server = TraceShieldServer(shield, tokenizer_fn, args.max_batch, args.max_wait_ms, args.max_pending)
+    exporter = MetricsExporter(registry, args.metrics_file, interval=args.metrics_interval).start() if args.metrics_file else None
+    profiler = SamplingProfiler().start() if args.profile else None
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_collapsed(args.profile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+# tracealign/sharded_index.py — Sharded Suffix Array Index with Parallel Build and Fan-Out Queries
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign.traceindex import SuffixArrayIndex, read_stream_offsets
+from tracealign.fm_index import FMIndex, is_fm_index
+
+logger = logging.getLogger("tracealign.sharded")
+
+# A sharded index is a directory of SuffixArrayIndex directories listed in MANIFEST_FILE. All
+# shards share one id space: each shard's vocabulary is a prefix of the newest shard's.
+SHARDED_FORMAT = "tracealign-sharded-index"
+SHARDED_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+def plan_shards(offsets: np.ndarray, shard_tokens: int) -> List[Tuple[int, int]]:
+    """
+    Split documents into consecutive (first, last) ranges of at most shard_tokens stream tokens;
+    offsets are document start offsets followed by the stream length (read_stream_offsets).
+    A document longer than shard_tokens gets a shard of its own.
+    """
+    n_docs = len(offsets) - 1
+    shards = []
+    first = 0
+    while first < n_docs:
+        last = int(np.searchsorted(offsets, offsets[first] + shard_tokens, side="right")) - 1
+        last = min(max(last, first + 1), n_docs)
+        shards.append((first, last))
+        first = last
+    return shards
+
+
+def _build_shard(stream_dir: str, docs: Tuple[int, int], shard_path: str, method: str,
+                 prefilter: Optional[Tuple[int, float]], lsh: Optional[Tuple[int, int, int, int]] = None,
+                 doc_listing: bool = False) -> Dict:
+    index = SuffixArrayIndex.from_token_stream(stream_dir, method=method, docs=docs)
+    if prefilter is not None:
+        index.build_prefilter(*prefilter)
+    if lsh is not None:
+        index.build_lsh(*lsh)
+    if doc_listing:
+        index.build_doc_listing()
+    index.save(shard_path)
+    return {
+        "path": os.path.basename(shard_path),
+        "n_docs": len(index.doc_ids),
+        "n_tokens": int(len(index.suffix_array)),
+        "vocab_size": len(index.id_to_token)
+    }
+
+
+def read_manifest(path: str) -> Dict:
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SHARDED_FORMAT or manifest.get("version", 0) > SHARDED_VERSION:
+        raise ValueError(f"Unsupported sharded index format {manifest.get('format')} v{manifest.get('version')} at {path}")
+    return manifest
+
+
+def _write_manifest(path: str, manifest: Dict):
+    tmp = os.path.join(path, MANIFEST_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(path, MANIFEST_FILE))
+
+
+def is_sharded(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def manifest_vocab(path: str) -> List[str]:
+    """Vocabulary of the newest shard, i.e. the id space new shards must extend"""
+    manifest = read_manifest(path)
+    if not manifest["shards"]:
+        return []
+    newest = max(manifest["shards"], key=lambda s: s["vocab_size"])
+    shard = SuffixArrayIndex()
+    shard.load(os.path.join(path, newest["path"]))
+    return list(shard.id_to_token)
+
+
+def build_sharded_index(stream_dir: str, output_dir: str, shard_tokens: int, workers: Optional[int] = None,
+                        method: str = "doubling", append: bool = False, prefilter: Optional[Tuple[int, float]] = None,
+                        lsh: Optional[Tuple[int, int, int, int]] = None, doc_listing: bool = False) -> Dict:
+    """
+    Partition an ingested token stream into shards of at most shard_tokens tokens and build them
+    in parallel worker processes; each worker only holds its own shard in memory. append=True adds
+    the shards after the ones already listed in output_dir's manifest, so new corpus data never
+    re-indexes the old shards (ingest it with manifest_vocab(output_dir) to keep ids aligned).
+    prefilter=(n, fpr) gives every shard an n-gram Bloom prefilter, and lsh=(window, shingle,
+    bands, rows) MinHash LSH tables for trace_similar(); doc_listing=True builds each shard's
+    document listing.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = read_manifest(output_dir) if append and is_sharded(output_dir) else {
+        "format": SHARDED_FORMAT, "version": SHARDED_VERSION, "shards": []}
+    ranges = plan_shards(read_stream_offsets(stream_dir), shard_tokens)
+    start = len(manifest["shards"])
+    paths = [os.path.join(output_dir, f"shard-{start + i:05d}") for i in range(len(ranges))]
+    logger.info(f"Building {len(ranges)} shards of at most {shard_tokens} tokens with {workers or os.cpu_count()} workers...")
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_build_shard, stream_dir, docs, path, method, prefilter, lsh, doc_listing) for docs, path in zip(ranges, paths)]
+        for future in futures:
+            entry = future.result()
+            manifest["shards"].append(entry)
+            logger.info(f"Shard {entry['path']}: {entry['n_docs']} documents, {entry['n_tokens']} tokens")
+    manifest["n_docs"] = sum(s["n_docs"] for s in manifest["shards"])
+    manifest["n_tokens"] = sum(s["n_tokens"] for s in manifest["shards"])
+    _write_manifest(output_dir, manifest)
+    logger.info(f"Sharded index written to {output_dir} ({len(manifest['shards'])} shards).")
+    return manifest
+
+
+class ShardedIndex:
+    """
+    Tracer over several memory-mapped SuffixArrayIndex shards with the same query interface.
+    Span lookups fan out over a thread pool and merge deterministically: counts add up, and
+    match_span fills top_k from the shards holding the most occurrences first (ties in shard
+    order), each in its own suffix order. Documents never cross shards, so a span occurs in
+    the corpus exactly when it occurs in some shard.
+    """
+
+    def __init__(self, shards: Optional[List[SuffixArrayIndex]] = None, workers: Optional[int] = None):
+        self.shards: List[SuffixArrayIndex] = []
+        self.vocab: Dict[str, int] = {}
+        self.id_to_token: List[str] = []
+        self.workers = workers
+        self.path: Optional[str] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+        for shard in shards or ():
+            self.add_shard(shard)
+
+    def add_shard(self, shard: SuffixArrayIndex):
+        small, large = sorted([self.id_to_token, shard.id_to_token], key=len)
+        if list(large[:len(small)]) != list(small):
+            raise ValueError("Shard vocabularies must share one id space (each a prefix of the largest)")
+        if len(shard.id_to_token) > len(self.id_to_token):
+            self.vocab, self.id_to_token = shard.vocab, shard.id_to_token
+        self.shards.append(shard)
+        for s in self.shards:
+            # one vocabulary in memory; ids past a shard's own vocabulary simply never match there
+            s.vocab, s.id_to_token = self.vocab, self.id_to_token
+
+    def load(self, path: str):
+        """Memory-map every shard listed in path's manifest"""
+        logger.info(f"Loading sharded index from {path}")
+        for entry in read_manifest(path)["shards"]:
+            shard = SuffixArrayIndex()
+            shard.load(os.path.join(path, entry["path"]))
+            self.add_shard(shard)
+        self.path = path
+        logger.info(f"Loaded {len(self.shards)} shards.")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _map(self, fn: Callable[[SuffixArrayIndex], object], shards: Optional[List[SuffixArrayIndex]] = None) -> list:
+        shards = self.shards if shards is None else shards
+        if len(shards) <= 1:
+            return [fn(s) for s in shards]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers or min(len(shards), os.cpu_count() or 1))
+        return list(self._pool.map(fn, shards))
+
+    def encode(self, tokens: List[str]) -> Optional[List[int]]:
+        ids = [self.vocab.get(t) for t in tokens]
+        return None if None in ids else ids
+
+    def count_span(self, span: List[str]) -> int:
+        return sum(self._map(lambda s: s.count_span(span)))
+
+    def match_span(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        intervals = self._map(lambda s: s.interval(span))
+        order = sorted(range(len(self.shards)), key=lambda i: (intervals[i][0] - intervals[i][1], i))
+        matches = []
+        for i in order:
+            lo, hi = intervals[i]
+            if lo == hi or len(matches) >= top_k:
+                break
+            shard = self.shards[i]
+            for p in shard.suffix_array[lo:min(hi, lo + top_k - len(matches))].tolist():
+                doc_id, offset = shard.locate(p)
+                matches.append({"doc_id": doc_id, "position": offset, "span": list(span)})
+        return matches
+
+    def trace_span(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        """Tracer interface used by TraceShield and ProvDecode"""
+        return self.match_span(span, top_k)
+
+    def count_spans(self, spans: List[List[str]], prefiltered: bool = False) -> List[int]:
+        """
+        count_span() of many spans, each shard answering the whole batch at once. prefiltered
+        spans passed window_prefilter(), which only says they may occur in some shard, so with
+        several shards each one still consults its own filter.
+        """
+        if not self.shards:
+            return [0] * len(spans)
+        prefiltered = prefiltered and len(self.shards) == 1
+        return np.sum(self._map(lambda s: s.count_spans(spans, prefiltered)), axis=0).tolist()
+
+    def match_spans(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        """match_span() of many spans, aligned with the input and merged in the same shard order"""
+        shards = list(self.shards)
+        intervals = self._map(lambda s: s.intervals(spans), shards)
+        located = [s.locate_intervals(spans, iv, top_k) for s, iv in zip(shards, intervals)]
+        results = []
+        for j in range(len(spans)):
+            order = sorted(range(len(shards)), key=lambda i: (intervals[i][j][0] - intervals[i][j][1], i))
+            matches = []
+            for i in order:
+                if len(matches) >= top_k or not located[i][j]:
+                    break
+                matches.extend(located[i][j][:top_k - len(matches)])
+            results.append(matches)
+        return results
+
+    def trace_spans(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        return self.match_spans(spans, top_k)
+
+    def matching_statistics_ids(self, ids, cap: Optional[int] = None) -> np.ndarray:
+        """Matching statistics over the union of shards: the per-position maximum over shards"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not self.shards:
+            return np.zeros(len(ids), dtype=np.int64)
+        return np.maximum.reduce(self._map(lambda s: s.matching_statistics_ids(ids, cap)))
+
+    def iter_matching_statistics(self, tokens: List[str], cap: Optional[int] = None) -> Iterator[int]:
+        return iter(self.matching_statistics_ids([self.vocab.get(t, -1) for t in tokens], cap).tolist())
+
+    def trace_completion(self, tokens: List[str], window_size: int = 8) -> List[Dict]:
+        """First corpus match of every window_size window of a completion that occurs in the corpus"""
+        matches = []
+        for i, length in enumerate(self.iter_matching_statistics(tokens, cap=window_size)):
+            if length == window_size:
+                matches.extend(self.match_span(tokens[i:i + window_size], top_k=1))
+        return matches
+
+    def document_frequencies(self, span: List[str]) -> List[Dict]:
+        """Documents containing span over every shard, most occurrences first (ties in shard order)"""
+        found = [f for shard_found in self._map(lambda s: s.document_frequencies(span)) for f in shard_found]
+        return sorted(found, key=lambda f: -f["count"])
+
+    def trace_documents_many(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        """trace_documents_many() over every shard; documents never cross shards, so their counts add up"""
+        per_shard = self._map(lambda s: s.trace_documents_many(spans, top_k))
+        results = []
+        for j in range(len(spans)):
+            matches = sorted((m for found in per_shard for m in found[j]), key=lambda m: -m["count"])[:top_k]
+            documents = sum(found[j][0]["documents"] for found in per_shard if found[j])
+            results.append([dict(m, documents=documents) for m in matches])
+        return results
+
+    def trace_documents(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        return self.trace_documents_many([span], top_k)[0]
+
+    def similarity_window(self) -> Optional[int]:
+        """Shortest window every shard's trace_similar_windows() accepts; None unless every shard has LSH tables"""
+        windows = [s.similarity_window() for s in self.shards]
+        if not windows or any(window is None for window in windows):
+            return None
+        return max(windows)
+
+    def trace_similar_windows(self, tokens: List[str], window_size: int, min_jaccard: float = 0.5, top_k: int = 5) -> Dict[int, List[Dict]]:
+        """trace_similar_windows() over every shard, keeping the top_k most similar matches per window"""
+        merged: Dict[int, List[Dict]] = {}
+        for found in self._map(lambda s: s.trace_similar_windows(tokens, window_size, min_jaccard, top_k)):
+            for i, matches in found.items():
+                merged.setdefault(i, []).extend(matches)
+        return {i: sorted(matches, key=lambda m: -m["jaccard"])[:top_k] for i, matches in sorted(merged.items())}
+
+    def trace_similar(self, span: List[str], min_jaccard: float = 0.5, top_k: int = 5) -> List[Dict]:
+        return self.trace_similar_windows(span, len(span), min_jaccard, top_k).get(0, [])
+
+    def window_prefilter(self, tokens: List[str], n: int) -> Optional[np.ndarray]:
+        """Windows that may occur in some shard; None unless every shard has an n-gram prefilter"""
+        masks = [s.window_prefilter(tokens, n) for s in self.shards]
+        if not masks or any(mask is None for mask in masks):
+            return None
+        return np.logical_or.reduce(masks)
+
+    def interval(self, span: List[str]) -> Tuple[Tuple[int, int], ...]:
+        """Per-shard suffix array intervals of span"""
+        return tuple(self._map(lambda s: s.interval(span)))
+
+    def extend_interval(self, interval: Tuple[Tuple[int, int], ...], depth: int, token_id: int) -> Tuple[Tuple[int, int], ...]:
+        # one O(log n) narrowing per shard: cheaper inline than a pool round trip
+        return tuple(s.extend_interval(iv, depth, token_id) for s, iv in zip(self.shards, interval))
+
+    def interval_successors(self, interval: Tuple[Tuple[int, int], ...], depth: int) -> np.ndarray:
+        found = [s.interval_successors(iv, depth) for s, iv in zip(self.shards, interval)]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def successors(self, context: List[str]) -> np.ndarray:
+        """Distinct token ids that follow context in any shard"""
+        return self.interval_successors(self.interval(context), len(context))
+
+    def suffix_matcher(self, cap: int) -> "ShardedMatcher":
+        return ShardedMatcher(self, cap)
+
+
+class ShardedMatcher:
+    """SuffixMatcher over every shard; the longest matching suffix is the longest of any shard"""
+
+    def __init__(self, index: ShardedIndex, cap: int):
+        self.matchers = [s.suffix_matcher(cap) for s in index.shards]
+
+    def push(self, token: str) -> int:
+        return max((m.push(token) for m in self.matchers), default=0)
+
+    def state(self) -> Tuple:
+        return tuple(m.state() for m in self.matchers)
+
+    def restore(self, state: Tuple):
+        for m, s in zip(self.matchers, state):
+            m.restore(s)
+
+
+def open_index(path: str, workers: Optional[int] = None):
+    """Load a sharded index (manifest present), an FMIndex or a single SuffixArrayIndex directory"""
+    if is_sharded(path):
+        index = ShardedIndex(workers=workers)
+    elif is_fm_index(path):
+        index = FMIndex()
+    else:
+        index = SuffixArrayIndex()
+    index.load(path)
+    return index
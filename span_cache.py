@@ -0,0 +1,359 @@
+# tracealign/span_cache.py — Bounded Span-Result Cache Shared by Tracers and BCI Scoring
+
+import sys
+import zlib
+import pickle
+import struct
+import hashlib
+import logging
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger("tracealign.span_cache")
+
+MISSING = object()  # returned by get() on a miss; cached values may be any object
+
+# TinyLFU count-min sketch: 4 rows of 4-bit-style counters (capped at 15), halved every
+# SKETCH_SAMPLE_FACTOR * width recorded accesses so old popularity fades
+SKETCH_ROWS = 4
+SKETCH_MAX_COUNT = 15
+SKETCH_SAMPLE_FACTOR = 10
+HALVE = bytes(c >> 1 for c in range(256))
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+# rough size of an entry for sizing the sketch from a byte budget
+TYPICAL_ENTRY_BYTES = 512
+
+MASK64 = (1 << 64) - 1
+SLOT_HEADER = struct.Struct("<IIQI4x")  # version, payload length, key hash, payload crc32
+TABLE_HEADER = struct.Struct("<QQ")  # slots, slot bytes
+
+
+def _approx_nbytes(obj) -> int:
+    """
+    Size of a cached key or value, counting containers only: the scalars and strings in spans,
+    matches and reports are small or shared with the index vocabulary. Lists (of matches, of
+    reports) are homogeneous, so their elements are sized from the first one.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, list):
+        if obj and isinstance(obj[0], (dict, list, tuple)):
+            size += len(obj) * _approx_nbytes(obj[0])
+        return size
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, tuple):
+        return size
+    for v in obj:
+        if isinstance(v, (dict, list, tuple)):
+            size += _approx_nbytes(v)
+    return size
+
+
+class FrequencySketch:
+    """Count-min sketch of recent access frequencies, the admission filter of TinyLFU"""
+
+    def __init__(self, width: int):
+        self.bits = max(10, (width - 1).bit_length())
+        self.width = 1 << self.bits
+        self.rows = [bytearray(self.width) for _ in range(SKETCH_ROWS)]
+        self.sample_size = SKETCH_SAMPLE_FACTOR * self.width
+        self.additions = 0
+
+    def _slots(self, key: Hashable):
+        h = hash(key) & MASK64
+        shift = 64 - self.bits
+        return [((h * seed) & MASK64) >> shift for seed in SKETCH_SEEDS]
+
+    def add(self, key: Hashable):
+        for row, slot in zip(self.rows, self._slots(key)):
+            if row[slot] < SKETCH_MAX_COUNT:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.additions //= 2
+            for row in self.rows:
+                row[:] = row.translate(HALVE)
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
+
+
+class SharedSpanTable:
+    """
+    Direct-mapped table of pickled (key, value) pairs in a shared-memory segment, visible to every
+    process that attaches it by name. Writers overwrite the slot their key hashes to; each slot
+    carries a version (odd while being written) and a crc32, so a torn or concurrently
+    overwritten slot reads as a miss instead of a wrong value. Values larger than a slot are
+    simply not shared. Pickles as a reference by name, so it can be handed to pool workers.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.slots, self.slot_bytes = TABLE_HEADER.unpack_from(shm.buf, 0)
+        self.payload_bytes = self.slot_bytes - SLOT_HEADER.size
+
+    @classmethod
+    def create(cls, nbytes: int, slot_bytes: int = 1024) -> "SharedSpanTable":
+        slots = max(1, (nbytes - TABLE_HEADER.size) // slot_bytes)
+        shm = shared_memory.SharedMemory(create=True, size=TABLE_HEADER.size + slots * slot_bytes)
+        TABLE_HEADER.pack_into(shm.buf, 0, slots, slot_bytes)
+        logger.info(f"Created shared span table {shm.name}: {slots} slots of {slot_bytes} bytes")
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedSpanTable":
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __reduce__(self):
+        return SharedSpanTable.attach, (self.name,)
+
+    def _slot(self, key_bytes: bytes) -> Tuple[int, int]:
+        h = int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+        return TABLE_HEADER.size + (h % self.slots) * self.slot_bytes, h
+
+    def get(self, key: Hashable):
+        offset, h = self._slot(pickle.dumps(key))
+        buf = self.shm.buf
+        version, length, stored_hash, crc = SLOT_HEADER.unpack_from(buf, offset)
+        if version & 1 or stored_hash != h or not 0 < length <= self.payload_bytes:
+            return MISSING
+        start = offset + SLOT_HEADER.size
+        payload = bytes(buf[start:start + length])
+        if SLOT_HEADER.unpack_from(buf, offset)[0] != version or zlib.crc32(payload) != crc:
+            return MISSING
+        try:
+            stored_key, value = pickle.loads(payload)
+        except Exception:
+            return MISSING
+        return value if stored_key == key else MISSING
+
+    def put(self, key: Hashable, value) -> bool:
+        payload = pickle.dumps((key, value))
+        if len(payload) > self.payload_bytes:
+            return False
+        offset, h = self._slot(pickle.dumps(key))
+        buf = self.shm.buf
+        version = SLOT_HEADER.unpack_from(buf, offset)[0]
+        version = ((version | 1) + 2) & 0xFFFFFFFF  # odd: being written
+        struct.pack_into("<I", buf, offset, version)
+        start = offset + SLOT_HEADER.size
+        buf[start:start + len(payload)] = payload
+        SLOT_HEADER.pack_into(buf, offset, (version + 1) & 0xFFFFFFFF, len(payload), h, zlib.crc32(payload))
+        return True
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SpanCache:
+    """
+    Bounded in-process cache of span results with a byte budget. policy="lru" evicts the least
+    recently used entry; policy="tinylfu" additionally refuses to admit a new entry whose recent
+    access frequency is not above the entry it would evict, which keeps one-off spans from
+    flushing hot templated ones. With a SharedSpanTable, misses fall through to it and new
+    results are published to it, so pool workers reuse each other's work.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20, policy: str = "lru", shared: Optional[SharedSpanTable] = None):
+        if policy not in ("lru", "tinylfu"):
+            raise ValueError(f"Unknown cache policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.shared = shared
+        self.entries: "OrderedDict[Hashable, Tuple[object, int]]" = OrderedDict()  # key -> (value, approx bytes)
+        self.nbytes = 0
+        self.sketch = FrequencySketch(max_bytes // TYPICAL_ENTRY_BYTES) if policy == "tinylfu" else None
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0, "rejections": 0}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable):
+        if self.sketch is not None:
+            self.sketch.add(key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0]
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.counters["shared_hits"] += 1
+                self._admit(key, value)
+                return value
+        self.counters["misses"] += 1
+        return MISSING
+
+    def put(self, key: Hashable, value):
+        if self.shared is not None:
+            self.shared.put(key, value)
+        self._admit(key, value)
+
+    def _admit(self, key: Hashable, value):
+        size = _approx_nbytes(key) + _approx_nbytes(value)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        if size > self.max_bytes:
+            self.counters["rejections"] += 1
+            return
+        if self.sketch is not None and self.nbytes + size > self.max_bytes:
+            victim = next(iter(self.entries))
+            if self.sketch.estimate(key) <= self.sketch.estimate(victim):
+                self.counters["rejections"] += 1
+                return
+        while self.nbytes + size > self.max_bytes:
+            _, (_, freed) = self.entries.popitem(last=False)
+            self.nbytes -= freed
+            self.counters["evictions"] += 1
+        self.entries[key] = (value, size)
+        self.nbytes += size
+
+    def get_or_compute(self, key: Optional[Hashable], compute: Callable):
+        """Cached value of key, computing and storing it on a miss; key=None bypasses the cache"""
+        if key is None:
+            return compute()
+        value = self.get(key)
+        if value is MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def get_or_compute_many(self, keys: List[Optional[Hashable]], compute_many: Callable[[List[int]], list]) -> list:
+        """
+        Values of many keys. compute_many(positions) is called once with the positions whose
+        values are missing (duplicates within the batch are computed once) and returns their
+        values in that order.
+        """
+        values = [MISSING] * len(keys)
+        pending: Dict[Hashable, List[int]] = {}
+        uncached = []
+        for i, key in enumerate(keys):
+            if key is None:
+                uncached.append(i)
+                continue
+            if key in pending:
+                pending[key].append(i)
+                continue
+            values[i] = self.get(key)
+            if values[i] is MISSING:
+                pending[key] = [i]
+        todo = uncached + [positions[0] for positions in pending.values()]
+        if todo:
+            for i, value in zip(todo, compute_many(todo)):
+                values[i] = value
+            for key, positions in pending.items():
+                self.put(key, values[positions[0]])
+                for i in positions[1:]:
+                    values[i] = values[positions[0]]
+        return values
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        hits = self.counters["hits"] + self.counters["shared_hits"]
+        lookups = hits + self.counters["misses"]
+        return dict(self.counters, size=len(self.entries), nbytes=self.nbytes,
+                    hit_rate=hits / lookups if lookups else 0.0)
+
+
+class CachedTracer:
+    """
+    Any tracer with its trace/match/count results (scalar and batch) served from a SpanCache,
+    keyed by the span's token-ID tuple and the tracer's generation, so LiveIndex updates never
+    serve stale results. Every other attribute is the wrapped tracer's, so TraceShield and
+    ProvDecode take the same code paths as without the cache. Cached results are shared between
+    callers and must not be mutated.
+    """
+
+    def __init__(self, tracer, cache: SpanCache, scope: str = "tracer"):
+        self.tracer = tracer
+        self.cache = cache
+        self.scope = scope  # tells apart tracers sharing one cache (and one shared table)
+        self._ids: Dict[str, int] = {}  # interned ids for tracers without a vocabulary
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["tracer"], name)
+
+    def _key(self, op: str, span: List[str], args: tuple, kwargs: dict) -> Optional[tuple]:
+        vocab = getattr(self.tracer, "vocab", None)
+        if vocab is None:
+            ids = tuple(self._ids.setdefault(t, len(self._ids)) for t in span)
+        else:
+            ids = tuple(map(vocab.get, span))
+            if None in ids:
+                return None  # an out-of-vocabulary span never matches; not worth a slot
+        options = (args, tuple(sorted(kwargs.items()))) if args or kwargs else ()
+        return (self.scope, op, getattr(self.tracer, "generation", 0), options, ids)
+
+    def _cached(self, op: str, span: List[str], args: tuple, kwargs: dict):
+        return self.cache.get_or_compute(self._key(op, span, args, kwargs),
+                                         lambda: getattr(self.tracer, op)(span, *args, **kwargs))
+
+    def _cached_many(self, op: str, single_op: str, spans: List[List[str]], args: tuple, kwargs: dict) -> list:
+        keys = [self._key(single_op, span, args, kwargs) for span in spans]  # batch and scalar calls share entries
+
+        def compute_many(positions: List[int]) -> list:
+            todo = [spans[i] for i in positions]
+            if hasattr(self.tracer, op):
+                return getattr(self.tracer, op)(todo, *args, **kwargs)
+            return [getattr(self.tracer, single_op)(span, *args, **kwargs) for span in todo]
+
+        return self.cache.get_or_compute_many(keys, compute_many)
+
+    def trace_span(self, span: List[str], *args, **kwargs) -> List[Dict]:
+        return self._cached("trace_span", span, args, kwargs)
+
+    def match_span(self, span: List[str], *args, **kwargs) -> List[Dict]:
+        return self._cached("match_span", span, args, kwargs)
+
+    def count_span(self, span: List[str]) -> int:
+        return self._cached("count_span", span, (), {})
+
+    def trace_spans(self, spans: List[List[str]], *args, **kwargs) -> List[List[Dict]]:
+        return self._cached_many("trace_spans", "trace_span", spans, args, kwargs)
+
+    def match_spans(self, spans: List[List[str]], *args, **kwargs) -> List[List[Dict]]:
+        return self._cached_many("match_spans", "match_span", spans, args, kwargs)
+
+    def count_spans(self, spans: List[List[str]]) -> List[int]:
+        return self._cached_many("count_spans", "count_span", spans, (), {})
+
+
+class CachedBCI:
+    """
+    BeliefConflictIndex with explain_span and compute_kl_divergence served from a SpanCache,
+    keyed by BCI token ids. compute_bci and high_risk are a few dict lookups, cheaper than
+    building a key, so they (and everything else) go straight to the wrapped model. Spans with
+    tokens outside token_probs bypass the cache, since KL tells distinct unknown tokens apart.
+    """
+
+    def __init__(self, bci, cache: SpanCache, scope: str = "bci"):
+        self.bci = bci
+        self.cache = cache
+        self.scope = scope
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["bci"], name)
+
+    def _key(self, op: str, span: List[str]) -> Optional[tuple]:
+        ids = tuple(map(self.bci.token_ids.get, span))
+        return None if None in ids else (self.scope, op, ids)
+
+    def compute_kl_divergence(self, span: List[str]) -> float:
+        return self.cache.get_or_compute(self._key("kl", span), lambda: self.bci.compute_kl_divergence(span))
+
+    def explain_span(self, span: List[str]) -> Dict:
+        report = self.cache.get_or_compute(self._key("explain", span), lambda: self.bci.explain_span(span))
+        return dict(report, span=span)  # callers annotate the report in place
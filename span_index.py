@@ -0,0 +1,107 @@
+# tracealign/span_index.py — Span Queries Shared by the Suffix Array and FM-Index Backends
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign.prefilter import NgramBloom
+
+
+class SpanIndex:
+    """
+    Tracer interface over one sorted corpus. A backend holds vocab, id_to_token, doc_ids,
+    doc_offsets and prefilter, and answers in suffix array rows: _bounds() of an encoded
+    query, intervals() of many spans and positions() (stream positions) of many rows.
+    """
+
+    def encode(self, tokens: List[str]) -> Optional[List[int]]:
+        """Map tokens to interned ids, or None if any token never occurs in the corpus"""
+        ids = [self.vocab.get(t) for t in tokens]
+        return None if None in ids else ids
+
+    def locate(self, pos: int) -> Tuple[str, int]:
+        """Resolve a stream position to (doc_id, offset within document)"""
+        d = int(np.searchsorted(self.doc_offsets, pos, side="right")) - 1
+        return self.doc_ids[d], pos - int(self.doc_offsets[d])
+
+    def interval(self, span: List[str]) -> Tuple[int, int]:
+        """Rows [lo, hi) of all occurrences of span; empty when lo == hi"""
+        query = self.encode(span)
+        if query is None:
+            return 0, 0
+        if self.prefilter is not None and not self.prefilter.may_contain(query):
+            return 0, 0
+        return self._bounds(query)
+
+    def count_span(self, span: List[str]) -> int:
+        """Number of corpus occurrences of span, from its interval bounds without enumeration"""
+        lo, hi = self.interval(span)
+        return hi - lo
+
+    def count_spans(self, spans: List[List[str]], prefiltered: bool = False) -> List[int]:
+        """count_span() of many spans, aligned with the input; prefiltered spans already passed the prefilter"""
+        return [hi - lo for lo, hi in self.intervals(spans, prefiltered)]
+
+    def locate_intervals(self, spans: List[List[str]], intervals: List[Tuple[int, int]], top_k: int) -> List[List[Dict]]:
+        """Matches of the first top_k rows of each span's interval, all located in one vectorized pass"""
+        rows = [np.arange(lo, min(hi, lo + top_k)) for lo, hi in intervals]
+        flat = self.positions(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+        docs = np.searchsorted(self.doc_offsets, flat, side="right") - 1
+        offsets = (flat - np.asarray(self.doc_offsets)[docs]).tolist()
+        docs = docs.tolist()
+        results, k = [], 0
+        for span, found in zip(spans, rows):
+            results.append([{"doc_id": self.doc_ids[docs[j]], "position": offsets[j], "span": list(span)}
+                            for j in range(k, k + len(found))])
+            k += len(found)
+        return results
+
+    def match_span(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        return self.locate_intervals([span], [self.interval(span)], top_k)[0]
+
+    def match_spans(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        """match_span() of many spans, aligned with the input"""
+        return self.locate_intervals(spans, self.intervals(spans), top_k)
+
+    def trace_span(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        """Tracer interface used by TraceShield and ProvDecode"""
+        return self.match_span(span, top_k)
+
+    def trace_spans(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        """Batched trace_span, used by TraceShield and ProvDecode when tracing many spans at once"""
+        return self.match_spans(spans, top_k)
+
+    def trace_completion(self, tokens: List[str], window_size: int = 8) -> List[Dict]:
+        """First corpus match of every window_size window of a completion that occurs in the corpus"""
+        matches = []
+        for i, length in enumerate(self.iter_matching_statistics(tokens, cap=window_size)):
+            if length == window_size:
+                matches.extend(self.match_span(tokens[i:i + window_size], top_k=1))
+        return matches
+
+
+def pad_queries(vocab: Dict[str, int], spans: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Spans as a matrix of token ids padded with -1 (unknown tokens are -1 too) and their lengths"""
+    get = vocab.get
+    lengths = np.fromiter((len(span) for span in spans), dtype=np.int64, count=len(spans))
+    width = int(lengths.max()) if len(spans) else 0
+    padded = np.full((len(spans), width), -1, dtype=np.int64)  # -1 sorts a prefix before its extensions
+    padded[np.arange(width) < lengths[:, None]] = np.array([get(t, -1) for span in spans for t in span], dtype=np.int64)
+    return padded, lengths
+
+
+def has_unknown(padded: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    return (padded < 0).sum(axis=1) > padded.shape[1] - lengths
+
+
+def prefilter_spans(prefilter: NgramBloom, queries: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Per padded query, whether every n-gram window passes the prefilter (spans shorter than n always do)"""
+    n = prefilter.n
+    width = queries.shape[1]
+    if width < n:
+        return np.ones(len(queries), dtype=bool)
+    # one stream of the queries, each closed by -1 so no window spans two of them
+    stream = np.concatenate([queries, np.full((len(queries), 1), -1, dtype=np.int64)], axis=1).ravel()
+    windows = np.append(prefilter.contains_windows(stream), np.zeros(n - 1, dtype=bool)).reshape(len(queries), width + 1)
+    needed = np.arange(width + 1) <= (lengths - n)[:, None]
+    return ~(needed & ~windows).any(axis=1)
@@ -0,0 +1,115 @@
+# tracealign/suffix_sort.py — Suffix Array Construction Engines (Vectorized Prefix Doubling and Naive Reference)
+
+import time
+from functools import cmp_to_key
+from typing import Callable, List, Optional
+
+import numpy as np
+
+# progress(h, resolved, total, elapsed_seconds) is called after every doubling round
+ProgressFn = Callable[[int, int, int, float], None]
+
+
+def prefix_doubling(stream: np.ndarray, progress: Optional[ProgressFn] = None, return_lcp: bool = False):
+    """
+    Sort all suffixes of an integer stream by vectorized prefix doubling (Manber–Myers).
+
+    Each round ranks suffixes by their first 2h symbols from the (rank[i], rank[i + h]) pairs
+    of the previous round, so the number of rounds is log2 of the longest repeated substring.
+    On a terminator-separated corpus that is bounded by the longest document. Returns an
+    int64 array of start positions in lexicographic suffix order, or (sa, lcp) with
+    return_lcp=True. The LCP pass keeps every round's ranks (4 bytes per token per round
+    for streams under 2^31 tokens) until the LCP array is filled.
+    """
+    n = len(stream)
+    start = time.perf_counter()
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return (empty, np.empty(0, dtype=np.int32)) if return_lcp else empty
+    level_dtype = np.int32 if n < 2 ** 31 else np.int64
+    _, rank = np.unique(stream, return_inverse=True)
+    rank = rank.astype(np.int64).reshape(-1)
+    sa = np.argsort(rank)
+    resolved = int(rank.max()) + 1
+    levels = []
+    h = 1
+    while resolved < n:
+        if return_lcp:
+            levels.append(rank.astype(level_dtype))
+        # second key is the rank h symbols ahead, 0 for suffixes that end before it
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - h] = rank[h:] + 1
+        key = rank * (n + 1) + second
+        sa = np.argsort(key)
+        sorted_key = key[sa]
+        sorted_rank = np.empty(n, dtype=np.int64)
+        sorted_rank[0] = 0
+        np.cumsum(sorted_key[1:] != sorted_key[:-1], out=sorted_rank[1:])
+        rank[sa] = sorted_rank
+        resolved = int(sorted_rank[-1]) + 1
+        if progress is not None:
+            progress(h, resolved, n, time.perf_counter() - start)
+        h *= 2
+    sa = sa.astype(np.int64, copy=False)
+    if not return_lcp:
+        return sa
+    return sa, _lcp_from_levels(sa, levels)
+
+
+def _lcp_from_levels(sa: np.ndarray, levels: List[np.ndarray], chunk: int = 1 << 22) -> np.ndarray:
+    """
+    LCP of adjacent suffixes by binary lifting over the doubling ranks: levels[j] ranks suffixes
+    by their first 2^j symbols, so equal ranks at offset l extend a common prefix by 2^j.
+    """
+    n = len(sa)
+    lcp = np.zeros(n, dtype=np.int32)
+    for lo in range(1, n, chunk):
+        hi = min(n, lo + chunk)
+        a, b = sa[lo - 1:hi - 1], sa[lo:hi]
+        length = np.zeros(hi - lo, dtype=np.int64)
+        for j in range(len(levels) - 1, -1, -1):
+            pa, pb = a + length, b + length
+            ok = (pa < n) & (pb < n)
+            equal = np.zeros(hi - lo, dtype=bool)
+            equal[ok] = levels[j][pa[ok]] == levels[j][pb[ok]]
+            length[equal] += 1 << j
+        lcp[lo:hi] = length
+    return lcp
+
+
+def naive_suffix_array(stream: np.ndarray) -> np.ndarray:
+    """Reference comparison sort over all suffixes; only meant for small inputs"""
+    values = stream.tolist()
+    n = len(values)
+
+    def compare(p: int, q: int) -> int:
+        while p < n and q < n and values[p] == values[q]:
+            p += 1
+            q += 1
+        if p == n or q == n:
+            return -1 if p == n else 1
+        return -1 if values[p] < values[q] else 1
+
+    return np.array(sorted(range(n), key=cmp_to_key(compare)), dtype=np.int64)
+
+
+def naive_lcp(stream: np.ndarray, sa: np.ndarray) -> np.ndarray:
+    """Reference LCP by direct comparison of adjacent suffixes; lcp[0] is 0"""
+    values = stream.tolist()
+    n = len(values)
+    lcp = np.zeros(len(sa), dtype=np.int32)
+    for i in range(1, len(sa)):
+        p, q, length = int(sa[i - 1]), int(sa[i]), 0
+        while p + length < n and q + length < n and values[p + length] == values[q + length]:
+            length += 1
+        lcp[i] = length
+    return lcp
+
+
+def check_suffix_array(stream: np.ndarray, max_len: int = 20000) -> bool:
+    """Cross-check prefix doubling (SA and LCP) against the naive sort; inputs above max_len are skipped"""
+    if len(stream) > max_len:
+        return True
+    sa, lcp = prefix_doubling(stream, return_lcp=True)
+    naive_sa = naive_suffix_array(stream)
+    return bool(np.array_equal(sa, naive_sa) and np.array_equal(lcp, naive_lcp(stream, naive_sa)))
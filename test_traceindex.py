@@ -1,22 +1,116 @@
 # tests/test_traceindex.py — Unit Tests for SuffixArrayIndex
- 
+
+import os
+import pickle
+import tempfile
 import unittest
-from tracealign.traceindex import SuffixArrayIndex
- 
+import numpy as np
+from tracealign.traceindex import SuffixArrayIndex, convert_pickle_index
+
 class TestSuffixArrayIndex(unittest.TestCase):
-	def setUp(self):
-    	self.index = SuffixArrayIndex()
-    	self.index.add_document("doc1", ["this", "is", "a", "test"])
-    	self.index.add_document("doc2", ["this", "is", "another", "example"])
-    	self.index.build()
- 
-	def test_match_basic(self):
-    	result = self.index.match_span(["this", "is"])
-    	self.assertTrue(any(r["doc_id"] == "doc1" for r in result))
- 
-	def test_match_no_result(self):
-    	result = self.index.match_span(["nonexistent"])
-    	self.assertEqual(len(result), 0)
- 
+    def setUp(self):
+        self.index = SuffixArrayIndex()
+        self.index.add_document("doc1", ["this", "is", "a", "test"])
+        self.index.add_document("doc2", ["this", "is", "another", "example"])
+        self.index.build()
+
+    def test_match_basic(self):
+        result = self.index.match_span(["this", "is"])
+        self.assertTrue(any(r["doc_id"] == "doc1" for r in result))
+
+    def test_match_no_result(self):
+        result = self.index.match_span(["nonexistent"])
+        self.assertEqual(len(result), 0)
+
+    def test_match_positions(self):
+        result = self.index.match_span(["is", "a"])
+        self.assertEqual(result, [{"doc_id": "doc1", "position": 1, "span": ["is", "a"]}])
+
+    def test_match_does_not_cross_documents(self):
+        self.assertEqual(self.index.match_span(["test", "this"]), [])
+
+    def test_top_k(self):
+        self.assertEqual(len(self.index.match_span(["this"], top_k=1)), 1)
+        self.assertEqual(len(self.index.match_span(["this"], top_k=5)), 2)
+
+    def test_count_and_interval(self):
+        self.assertEqual(self.index.count_span(["this", "is"]), 2)
+        self.assertEqual(self.index.count_span(["is", "a"]), 1)
+        self.assertEqual(self.index.count_span(["nonexistent"]), 0)
+        lo, hi = self.index.interval(["this"])
+        self.assertEqual(hi - lo, 2)
+
+    def test_longest_match(self):
+        length, (lo, hi) = self.index.longest_match(["x", "this", "is", "a", "secret"], start=1)
+        self.assertEqual(length, 3)
+        self.assertEqual(hi - lo, 1)
+        self.assertEqual(self.index.longest_match(["x", "this"])[0], 0)
+
+    def test_matching_statistics(self):
+        tokens = ["x", "this", "is", "a", "test", "this", "is"]
+        expected = [self.index.longest_match(tokens, i)[0] for i in range(len(tokens))]
+        self.assertEqual(list(self.index.iter_matching_statistics(tokens)), expected)
+        self.assertEqual(list(self.index.iter_matching_statistics(tokens, cap=2)), [min(2, n) for n in expected])
+
+    def test_lcp(self):
+        self.assertEqual(len(self.index.lcp), len(self.index.suffix_array))
+        lo, hi = self.index.interval(["this", "is"])
+        self.assertGreaterEqual(int(self.index.lcp[lo + 1]), 2)
+
+    def test_save_load_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.index.save(tmp)
+            loaded = SuffixArrayIndex()
+            loaded.load(tmp)
+            self.assertIsInstance(loaded.suffix_array, np.memmap)
+            self.assertEqual(loaded.match_span(["this", "is"]), self.index.match_span(["this", "is"]))
+            self.assertEqual(loaded.doc_lengths, {"doc1": 4, "doc2": 4})
+
+    def test_load_rejects_pickle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.pkl")
+            with open(path, "wb") as f:
+                pickle.dump({}, f)
+            with self.assertRaises(ValueError):
+                SuffixArrayIndex().load(path)
+
+    def test_convert_legacy_pickle(self):
+        docs = {"doc1": ["this", "is", "a", "test"], "doc2": ["this", "is", "another", "example"]}
+        suffixes = sorted(((toks[i:], d, i) for d, toks in docs.items() for i in range(len(toks))), key=lambda x: x[0])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "legacy.pkl")
+            with open(path, "wb") as f:
+                pickle.dump({"suffix_array": suffixes, "lexicon": {}, "doc_lengths": {d: len(t) for d, t in docs.items()}}, f)
+            convert_pickle_index(path, os.path.join(tmp, "index"))
+            loaded = SuffixArrayIndex()
+            loaded.load(os.path.join(tmp, "index"))
+            self.assertEqual(loaded.match_span(["this", "is"]), self.index.match_span(["this", "is"]))
+
+    def test_id_aligned_index_and_trace_completion(self):
+        vocab = ["<pad>", "this", "is", "a", "test"]
+        index = SuffixArrayIndex(vocab)
+        index.add_document_ids("doc1", [1, 2, 3, 4])
+        index.add_document_ids("doc2", [2, 3, 1])
+        index.build()
+        self.assertEqual(index.id_to_token, vocab)
+        self.assertEqual(index.matching_statistics_ids([2, 3, 4, -100, 1, 2]).tolist(), [3, 2, 1, 0, 2, 1])
+        matches = index.trace_completion(["x", "is", "a", "test", "this"], window_size=2)
+        self.assertEqual([(m["doc_id"], m["position"]) for m in matches], [("doc2", 0), ("doc1", 2)])
+
+    def test_batched_match_spans(self):
+        rng = np.random.default_rng(0)
+        vocab = [f"t{i}" for i in range(12)]
+        index = SuffixArrayIndex(vocab)
+        for d in range(30):
+            index.add_document_ids(f"d{d}", rng.integers(0, 12, size=int(rng.integers(1, 40))))
+        index.build()
+        spans = [[vocab[i] for i in rng.integers(0, 12, size=int(rng.integers(1, 5)))] for _ in range(400)]
+        spans += [[], ["missing"], ["t1", "missing"], spans[0], spans[0][:1]]
+        self.assertEqual(index.count_spans(spans), [index.count_span(span) for span in spans])
+        self.assertEqual(index.match_spans(spans, top_k=3), [index.match_span(span, top_k=3) for span in spans])
+        index.build_prefilter(n=2)
+        self.assertEqual(index.count_spans(spans), [index.count_span(span) for span in spans])
+        self.assertEqual(index.match_spans([]), [])
+
 if __name__ == '__main__':
-	unittest.main()
+    unittest.main()
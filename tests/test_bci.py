@@ -1,23 +1,127 @@
 # tests/test_bci.py — Unit Tests for BeliefConflictIndex
- 
+
+import os
+import json
+import tempfile
 import unittest
-from tracealign.bci import BeliefConflictIndex
- 
+import numpy as np
+from tracealign.bci import BeliefConflictIndex, save_token_probs, save_stream_token_probs
+from tracealign.traceindex import SuffixArrayIndex, TokenStreamWriter, read_stream_counts
+from tracealign.utils import normalize_token_frequencies
+
 class TestBeliefConflictIndex(unittest.TestCase):
-	def setUp(self):
-    	self.bci = BeliefConflictIndex({"a": 0.1, "b": 0.01, "c": 0.001})
- 
-	def test_compute_bci(self):
-    	score = self.bci.compute_bci(["a", "b"])
-    	self.assertGreater(score, 0)
- 
-	def test_normalized(self):
-    	density = self.bci.normalized_bci(["a", "b"])
-    	self.assertLess(density, 100)
- 
-	def test_high_risk(self):
-    	risky = self.bci.high_risk(["b", "c"], threshold=10.0)
-    	self.assertTrue(risky)
- 
+    def setUp(self):
+        self.bci = BeliefConflictIndex({"a": 0.1, "b": 0.01, "c": 0.001})
+
+    def test_compute_bci(self):
+        score = self.bci.compute_bci(["a", "b"])
+        self.assertGreater(score, 0)
+
+    def test_normalized(self):
+        density = self.bci.normalized_bci(["a", "b"])
+        self.assertLess(density, 100)
+
+    def test_high_risk(self):
+        risky = self.bci.high_risk(["b", "c"], threshold=10.0)
+        self.assertTrue(risky)
+
+    def test_score_batch_matches_scalar(self):
+        spans = [["a", "b"], ["c"], [], ["a", "zz", "a"]]
+        ragged = [self.bci.encode(s) for s in spans]
+        self.assertEqual(self.bci.score_batch(ragged).tolist(), [self.bci.compute_bci(s) for s in spans])
+        padded = np.full((len(spans), 3), -1)
+        for i, ids in enumerate(ragged):
+            padded[i, :len(ids)] = ids
+        self.assertEqual(self.bci.density_batch(padded).tolist(), [self.bci.normalized_bci(s) for s in spans])
+        self.assertTrue(np.allclose(self.bci.kl_batch(ragged), [self.bci.compute_kl_divergence(s) for s in spans]))
+
+    def test_window_scores(self):
+        tokens = ["a", "b", "c", "zz", "a"]
+        scores = self.bci.window_scores(self.bci.encode(tokens), 2)
+        self.assertTrue(np.allclose(scores, [self.bci.compute_bci(tokens[i:i + 2]) for i in range(4)]))
+
+    def test_rank_spans_top_k(self):
+        spans = [["a"], ["c"], ["b"], ["c"], ["zz"]]
+        full = self.bci.rank_spans(spans)
+        self.assertEqual([i for i, _ in full], [4, 1, 3, 2, 0])
+        self.assertEqual(self.bci.rank_spans(spans, top_k=3), full[:3])
+        self.assertEqual(self.bci.rank_spans(spans, top_k=2), full[:2])
+
+class TestTokenProbStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stream_dir = os.path.join(self.tmp.name, "stream")
+        # "never" is in the vocabulary but not in the corpus
+        writer = TokenStreamWriter(self.stream_dir, vocab=["the", "never"])
+        docs = [["the", "cat", "sat", "on", "the", "mat"], ["a", "rare", "cat"]]
+        chunk_vocab = sorted({t for doc in docs for t in doc})
+        ids = np.array([chunk_vocab.index(t) for doc in docs for t in doc], dtype=np.int32)
+        writer.write_chunk(["d1", "d2"], chunk_vocab, ids, [len(doc) for doc in docs])
+        writer.close()
+        self.store = os.path.join(self.tmp.name, "probs")
+        save_stream_token_probs(self.stream_dir, self.store)
+        counts = {t: c for t, c in read_stream_counts(self.stream_dir).items() if c}
+        self.json_path = os.path.join(self.tmp.name, "probs.json")
+        with open(self.json_path, "w") as f:
+            json.dump(normalize_token_frequencies(counts), f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_store_matches_json(self):
+        reference = BeliefConflictIndex.load(self.json_path)
+        index = SuffixArrayIndex.from_token_stream(self.stream_dir)
+        for vocab in [None, index.vocab]:
+            bci = BeliefConflictIndex.load(self.store, vocab)
+            spans = [["the", "cat"], ["rare", "never", "zz"], ["a", "a", "mat"], []]
+            for span in spans:
+                self.assertEqual(bci.compute_bci(span), reference.compute_bci(span))
+                self.assertEqual(bci.compute_kl_divergence(span), reference.compute_kl_divergence(span))
+                if span:
+                    self.assertEqual(bci.explain_span(span), reference.explain_span(span))
+            self.assertEqual(bci.score_batch([bci.encode(s) for s in spans]).tolist(),
+                             reference.score_batch([reference.encode(s) for s in spans]).tolist())
+            self.assertTrue(np.allclose(bci.entropy_batch([bci.encode(s) for s in spans]),
+                                        [reference.compute_entropy(s) for s in spans]))
+            self.assertEqual(bci.token_probs["cat"], reference.token_probs["cat"])
+            self.assertEqual(bci.token_probs.get("never", bci.default_prob), reference.token_probs.get("never", reference.default_prob))
+        self.assertIs(bci.token_ids, index.vocab)
+        self.assertEqual(bci.surprisal_array(index.id_to_token).tolist(),
+                         reference.surprisal_array(index.id_to_token).tolist())
+
+    def test_misaligned_vocab_is_not_shared(self):
+        index = SuffixArrayIndex()
+        index.add_document("d", ["mat", "cat", "the"])
+        index.build()
+        bci = BeliefConflictIndex.load(self.store, index.vocab)
+        self.assertIsNot(bci.token_ids, index.vocab)
+        self.assertEqual(bci.compute_bci(["the"]), BeliefConflictIndex.load(self.json_path).compute_bci(["the"]))
+
+    def test_alignment_checks_whole_vocab(self):
+        tokens = [f"t{i}" for i in range(200)]
+        path = os.path.join(self.tmp.name, "wide_probs")
+        save_token_probs(path, tokens, np.full(len(tokens), 1.0 / len(tokens)))
+        vocab = {t: i for i, t in enumerate(tokens)}
+        self.assertIs(BeliefConflictIndex.load(path, vocab).token_ids, vocab)
+        # two ids swap their tokens; a spot check of spread-out ids would miss it
+        swapped = dict(vocab, t1=2, t2=1)
+        self.assertIsNot(BeliefConflictIndex.load(path, swapped).token_ids, swapped)
+
+    def test_grown_vocab_maps_new_tokens_to_default(self):
+        index = SuffixArrayIndex.from_token_stream(self.stream_dir)
+        bci = BeliefConflictIndex.load(self.store, index.vocab)
+        index.vocab["brand_new"] = len(index.vocab)
+        self.assertEqual(bci.encode(["brand_new"]).tolist(), [bci.unk_id])
+        self.assertEqual(bci.compute_bci(["brand_new"]), bci.default_surprisal)
+
+    def test_save_token_probs_from_dict(self):
+        probs = {"x": 0.5, "y": 0.25, "z": 0.25}
+        path = os.path.join(self.tmp.name, "dict_probs")
+        save_token_probs(path, list(probs), list(probs.values()))
+        bci, reference = BeliefConflictIndex.load(path), BeliefConflictIndex(probs)
+        self.assertEqual(bci.window_scores(bci.encode(["x", "y", "q", "z"]), 2).tolist(),
+                         reference.window_scores(reference.encode(["x", "y", "q", "z"]), 2).tolist())
+        self.assertEqual(dict(bci.token_probs), probs)
+
 if __name__ == '__main__':
-	unittest.main()
+    unittest.main()
@@ -0,0 +1,42 @@
+# tests/test_benchmark_suite.py — Unit Tests for the Benchmark Corpus Generator and Regression Gate
+
+import tempfile
+import unittest
+import numpy as np
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.benchmark_suite import parse_size, format_size, write_zipf_stream, measure, compare
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_sizes(self):
+        self.assertEqual(parse_size("1M"), 1_000_000)
+        self.assertEqual(parse_size("2.5B"), 2_500_000_000)
+        self.assertEqual(parse_size("1234"), 1234)
+        self.assertEqual(format_size(10_000_000), "10M")
+
+    def test_zipf_stream_is_deterministic_and_prefix_stable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            small = write_zipf_stream(f"{tmp}/small", 5000, vocab_size=100, doc_length=300, seed=3)
+            write_zipf_stream(f"{tmp}/again", 5000, vocab_size=100, doc_length=300, seed=3)
+            write_zipf_stream(f"{tmp}/large", 9000, vocab_size=100, doc_length=300, seed=3)
+            self.assertEqual(small["n_tokens"], 5000)
+            streams = [SuffixArrayIndex.from_token_stream(f"{tmp}/{name}").tokens for name in ("small", "again", "large")]
+            streams = [s[s >= 0] for s in streams]  # the last document of a smaller corpus ends early
+            self.assertTrue(np.array_equal(streams[0], streams[1]))
+            self.assertTrue(np.array_equal(streams[0], streams[2][:len(streams[0])]))
+
+    def test_measure_and_compare(self):
+        measured = measure(lambda: sum(range(1000)), calls=10)
+        self.assertEqual(measured["calls"], 10)
+        self.assertGreater(measured["peak_rss_mb"], 0)
+        baseline = {"results": [{"size": 10, "op": "a", "per_call_us": 100.0, "peak_rss_mb": 50.0},
+                                {"size": 10, "op": "b", "per_call_us": 0.5, "peak_rss_mb": 50.0}]}
+        current = {"results": [{"size": 10, "op": "a", "per_call_us": 130.0, "peak_rss_mb": 50.0},
+                               {"size": 10, "op": "b", "per_call_us": 0.9, "peak_rss_mb": 80.0},
+                               {"size": 10, "op": "new", "per_call_us": 1.0, "peak_rss_mb": 1.0}]}
+        rows = compare(baseline, current, threshold=0.15, rss_threshold=0.25, min_us=1.0)
+        self.assertEqual([(r["op"], r["regressed"]) for r in rows], [("a", True), ("b", True)])
+        rows = compare(baseline, current, threshold=0.5, rss_threshold=1.0, min_us=1.0)
+        self.assertFalse(any(r["regressed"] for r in rows))
+
+if __name__ == "__main__":
+    unittest.main()
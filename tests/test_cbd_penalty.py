@@ -0,0 +1,53 @@
+# tests/test_cbd_penalty.py — Unit Tests for the Id-Based CBD Penalty
+
+import unittest
+import numpy as np
+from tracealign.cbd_penalty import cbd_penalties, completion_penalty
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.bci import BeliefConflictIndex
+
+class TestCBDPenalty(unittest.TestCase):
+    def random_case(self, seed: int, window_size: int):
+        rng = np.random.default_rng(seed)
+        vocab = [f"t{i}" for i in range(int(rng.integers(3, 8)))]
+        index = SuffixArrayIndex()
+        for d in range(int(rng.integers(1, 5))):
+            index.add_document(f"doc{d}", [vocab[i] for i in rng.integers(0, len(vocab), int(rng.integers(1, 40)))])
+        index.build()
+        bci = BeliefConflictIndex(dict(zip(vocab, rng.uniform(0.01, 1.0, len(vocab)).tolist())))
+        surprisal = np.append(bci.surprisal_array(index.id_to_token), bci.default_surprisal)
+
+        corpus = np.asarray(index.tokens)
+        rows = []
+        for _ in range(12):
+            length = int(rng.integers(0, 3 * window_size))
+            if rng.random() < 0.5 and len(corpus) > length:
+                # copy a corpus stretch so that some windows occur
+                start = int(rng.integers(0, len(corpus) - length))
+                ids = corpus[start:start + length].copy()
+            else:
+                ids = rng.integers(0, len(index.id_to_token), length)
+            ids[(ids < 0) | (rng.random(length) < 0.1)] = -1  # document separators read as unknown tokens
+            rows.append(ids.astype(np.int64))
+        threshold = float(rng.uniform(0, window_size * surprisal[:-1].mean()))
+        return index, bci, surprisal, rows, threshold
+
+    def test_matches_string_penalty(self):
+        for seed in range(40):
+            window_size = 1 + seed % 4
+            index, bci, surprisal, rows, threshold = self.random_case(seed, window_size)
+            penalties = cbd_penalties(index, surprisal, rows, threshold, window_size)
+            for ids, penalty in zip(rows, penalties):
+                tokens = [index.id_to_token[i] if i >= 0 else "<unk>" for i in ids]
+                expected = completion_penalty(index, bci, tokens, threshold, window_size)
+                self.assertAlmostEqual(penalty, expected, places=9, msg=f"seed {seed}: {tokens}")
+
+    def test_short_completion(self):
+        index, bci, surprisal, _, _ = self.random_case(0, 4)
+        row = np.asarray(index.tokens[:3], dtype=np.int64)
+        self.assertEqual(cbd_penalties(index, surprisal, [row], -1.0, 4).tolist(), [0.0])
+        tokens = [index.id_to_token[i] for i in row]
+        self.assertEqual(completion_penalty(index, bci, tokens, -1.0, 4), 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# tests/test_doc_listing.py — Unit Tests for Distinct-Document Listing and Per-Document Counts
+
+import tempfile
+import unittest
+import numpy as np
+from tracealign.doc_listing import scan_intervals
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.sharded_index import ShardedIndex
+from tracealign.traceshield import TraceShield
+from tracealign.bci import BeliefConflictIndex
+
+def sorted_by_doc(listed):
+    docs, counts, ranks = listed
+    order = np.argsort(docs)
+    return docs[order].tolist(), counts[order].tolist(), ranks[order].tolist()
+
+class TestDocumentListing(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocab = [f"t{i}" for i in range(6)]
+        self.index = SuffixArrayIndex(self.vocab)
+        for d in range(200):
+            self.index.add_document_ids(f"d{d}", rng.integers(0, 6, size=int(rng.integers(1, 40))))
+        self.index.build()
+        self.index.build_doc_listing()
+        self.rng = rng
+
+    def test_listing_agrees_with_scan(self):
+        n = len(self.index.suffix_array)
+        intervals = [tuple(sorted(self.rng.integers(0, n + 1, 2).tolist())) for _ in range(300)] + [(0, n), (5, 5)]
+        listed = self.index.doc_listing.list_intervals(intervals)
+        scanned = scan_intervals(self.index.suffix_array, self.index.doc_offsets, intervals)
+        self.assertEqual(len(listed), len(intervals))
+        for a, b in zip(listed, scanned):
+            self.assertEqual(sorted_by_doc(a), sorted_by_doc(b))
+
+    def test_document_frequencies(self):
+        span = ["t1", "t2"]
+        expected = {}
+        for match in self.index.match_span(span, top_k=10 ** 6):
+            expected[match["doc_id"]] = expected.get(match["doc_id"], 0) + 1
+        frequencies = self.index.document_frequencies(span)
+        self.assertEqual({f["doc_id"]: f["count"] for f in frequencies}, expected)
+        counts = [f["count"] for f in frequencies]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(self.index.document_frequencies(["t1", "unknown"]), [])
+
+    def test_trace_documents_are_distinct_and_located(self):
+        span = ["t3"]
+        matches = self.index.trace_documents(span, top_k=5)
+        self.assertEqual(len({m["doc_id"] for m in matches}), 5)
+        frequencies = self.index.document_frequencies(span)
+        self.assertEqual([m["count"] for m in matches], [f["count"] for f in frequencies[:5]])
+        self.assertTrue(all(m["documents"] == len(frequencies) for m in matches))
+        for m in matches:
+            d = self.index.doc_ids.index(m["doc_id"])
+            self.assertEqual(self.vocab[int(self.index.tokens[self.index.doc_offsets[d] + m["position"]])], "t3")
+
+    def test_listing_matches_scan_fallback(self):
+        spans = [["t0"], ["t1", "t2", "t3"], ["t5", "t5"]]
+        with_listing = self.index.trace_documents_many(spans)
+        self.index.doc_listing = None
+        self.assertEqual(with_listing, self.index.trace_documents_many(spans))
+
+    def test_persisted_and_merged(self):
+        span = ["t2", "t4"]
+        with tempfile.TemporaryDirectory() as tmp:
+            self.index.save(tmp)
+            loaded = SuffixArrayIndex()
+            loaded.load(tmp)
+            self.assertIsNotNone(loaded.doc_listing)
+            self.assertEqual(loaded.trace_documents(span), self.index.trace_documents(span))
+        delta = SuffixArrayIndex()
+        delta.vocab, delta.id_to_token = self.index.vocab, self.index.id_to_token
+        delta.add_document("new", ["t2", "t4"] * 50)
+        delta.build()
+        merged = self.index.merge(delta)
+        self.assertEqual(merged.document_frequencies(span)[0], {"doc_id": "new", "count": 50})
+
+    def test_sharded_counts_add_up(self):
+        other = SuffixArrayIndex()
+        other.vocab, other.id_to_token = self.index.vocab, self.index.id_to_token
+        other.add_document("extra", ["t1", "t1", "t1"] * 30)
+        other.build()
+        sharded = ShardedIndex([self.index, other])
+        matches = sharded.trace_documents(["t1"], top_k=3)
+        self.assertEqual(matches[0]["doc_id"], "extra")
+        self.assertEqual(matches[0]["documents"], len(self.index.document_frequencies(["t1"])) + 1)
+        self.assertEqual(sharded.document_frequencies(["t1", "t1"])[0], {"doc_id": "extra", "count": 89})
+
+class TestSourceAttribution(unittest.TestCase):
+    def test_refusal_report_lists_distinct_sources(self):
+        index = SuffixArrayIndex()
+        index.add_document("spam", ["make", "bad", "stuff"] * 20)
+        index.add_document("guide", ["how", "to", "make", "bad", "stuff", "here"])
+        index.build()
+        index.build_doc_listing()
+        bci = BeliefConflictIndex({"bad": 0.00001, "stuff": 0.0001, "make": 0.01})
+        shield = TraceShield(index, bci, threshold=10.0, window_size=3, max_matches=2)
+        tokens = ["make", "bad", "stuff"]
+        self.assertEqual({r["match_doc"] for r in shield.detect_risky_spans(tokens)}, {"spam"})
+        reports = shield.detect_risky_spans(tokens, by_document=True)
+        self.assertEqual([(r["match_doc"], r["match_count"], r["source_docs"]) for r in reports], [("spam", 20, 2), ("guide", 1, 2)])
+        self.assertIn("guide @ 2 (1x; 2 source docs)", shield.refusal_report(tokens))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# tests/test_eval_traceshield.py — Unit Tests for Batch TraceShield Evaluation
+
+import os
+import json
+import tempfile
+import unittest
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.eval_traceshield import evaluate
+
+class TestEvalTraceShield(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.tmp.name, "index")
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        index.build()
+        index.save(self.index_path)
+        self.probs_path = os.path.join(self.tmp.name, "probs.json")
+        with open(self.probs_path, "w") as f:
+            json.dump({"bad": 0.00001, "stuff": 0.0001, "safe": 0.9}, f)
+        self.prompts_path = os.path.join(self.tmp.name, "prompts.jsonl")
+        completions = ["So, how to make bad stuff?", "safe and sound", "safe bad stuff safe"] * 5
+        with open(self.prompts_path, "w") as f:
+            for i, text in enumerate(completions):
+                f.write(json.dumps({"id": f"p{i}", "completion": text}) + "\n")
+        self.output_path = os.path.join(self.tmp.name, "results.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_eval(self, **kwargs):
+        return evaluate(self.prompts_path, self.index_path, self.probs_path, self.output_path,
+                        threshold=10.0, window_size=2, chunk_size=4, **kwargs)
+
+    def read_results(self):
+        with open(self.output_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_writes_jsonl_results_in_order(self):
+        summary = self.run_eval()
+        results = self.read_results()
+        self.assertEqual([r["id"] for r in results], [f"p{i}" for i in range(15)])
+        self.assertEqual([r["refused"] for r in results[:3]], [True, False, True])
+        self.assertEqual(results[0]["n_tokens"], 8)
+        self.assertEqual(summary["completions"], 15)
+        self.assertEqual(summary["refused"], 10)
+        self.assertLessEqual(summary["p50_ms"], summary["p99_ms"])
+
+    def test_resume_skips_done_and_drops_partial_line(self):
+        self.run_eval()
+        with open(self.output_path) as f:
+            lines = f.readlines()
+        with open(self.output_path, "w") as f:
+            f.writelines(lines[:6])
+            f.write(lines[6][:10])
+        summary = self.run_eval(workers=2)
+        self.assertEqual(summary["skipped"], 6)
+        self.assertEqual(summary["completions"], 9)
+        self.assertEqual([r["id"] for r in self.read_results()], [f"p{i}" for i in range(15)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# tests/test_fm_index.py — Unit Tests for the Compressed FM-Index Backend
+
+import tempfile
+import unittest
+import numpy as np
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.fm_index import FMIndex, RankBits
+from tracealign.sharded_index import open_index
+
+class TestFMIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocab = [f"t{i}" for i in range(70)]
+        self.index = SuffixArrayIndex(self.vocab)
+        weights = 1.0 / np.arange(1, 71)
+        for d in range(60):
+            self.index.add_document_ids(f"d{d}", rng.choice(70, size=int(rng.integers(1, 80)), p=weights / weights.sum()))
+        self.index.build()
+        self.spans = []
+        tokens = self.index.tokens
+        while len(self.spans) < 200:
+            start, length = int(rng.integers(0, len(tokens) - 5)), int(rng.integers(1, 6))
+            ids = tokens[start:start + length]
+            if (ids >= 0).all():
+                self.spans.append([self.vocab[i] for i in ids.tolist()])
+        self.spans += [[self.vocab[i] for i in ids] for ids in rng.integers(0, 70, size=(100, 3)).tolist()]
+
+    def test_rank_bits(self):
+        bits = np.random.default_rng(1).integers(0, 2, size=5000)
+        rb = RankBits.from_bits(bits)
+        ranks = np.concatenate([[0], np.cumsum(bits)])
+        for i in (0, 1, 63, 64, 65, 4999, 5000):
+            self.assertEqual(rb.rank(i), ranks[i])
+        self.assertEqual(rb.rank_many(np.arange(5001)).tolist(), ranks.tolist())
+        self.assertEqual(rb.bits_many(np.arange(5000)).tolist(), bits.tolist())
+
+    def test_matches_plain_index_at_every_sample_rate(self):
+        for rate in (1, 3, 16):
+            fm = FMIndex.from_suffix_array(self.index, sample_rate=rate)
+            for span in self.spans:
+                self.assertEqual(fm.count_span(span), self.index.count_span(span))
+                self.assertEqual(fm.match_span(span, top_k=4), self.index.match_span(span, top_k=4))
+            self.assertEqual(fm.count_span(["missing"]), 0)
+
+    def test_batched_match_spans(self):
+        fm = FMIndex.from_suffix_array(self.index, sample_rate=4)
+        spans = self.spans + [[], ["missing"], self.spans[0]]
+        self.assertEqual(fm.count_spans(spans), [self.index.count_span(span) for span in spans])
+        self.assertEqual(fm.match_spans(spans, top_k=3), [self.index.match_span(span, top_k=3) for span in spans])
+
+    def test_matching_statistics_and_suffix_matcher(self):
+        fm = FMIndex.from_suffix_array(self.index)
+        tokens = [self.vocab[i] for i in np.random.default_rng(2).integers(0, 8, size=300).tolist()] + ["missing", "t0", "t1"]
+        for cap in (1, 4, None):
+            self.assertEqual(list(fm.iter_matching_statistics(tokens, cap)), list(self.index.iter_matching_statistics(tokens, cap)))
+        self.assertEqual(fm.trace_completion(tokens, 3), self.index.trace_completion(tokens, 3))
+        fm_matcher, plain_matcher = fm.suffix_matcher(5), self.index.suffix_matcher(5)
+        for token in tokens:
+            self.assertEqual(fm_matcher.push(token), plain_matcher.push(token))
+
+    def test_save_load_and_open_index(self):
+        self.index.build_prefilter(n=3)
+        fm = FMIndex.from_suffix_array(self.index, sample_rate=8)
+        with tempfile.TemporaryDirectory() as tmp:
+            fm.save(tmp)
+            loaded = open_index(tmp)
+            self.assertIsInstance(loaded, FMIndex)
+            self.assertEqual(loaded.sample_rate, 8)
+            self.assertIsNotNone(loaded.prefilter)
+            for span in self.spans[:50]:
+                self.assertEqual(loaded.match_span(span), self.index.match_span(span))
+        self.assertLess(fm.nbytes(), len(self.index.tokens) * 16)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# tests/test_live_index.py — Unit Tests for LiveIndex Delta Segments and Merging
+
+import random
+import threading
+import unittest
+import numpy as np
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.live_index import LiveIndex
+from tracealign.prov_decode import ProvDecode
+from tracealign.bci import BeliefConflictIndex
+
+def build(docs):
+    index = SuffixArrayIndex()
+    for doc_id, tokens in docs:
+        index.add_document(doc_id, tokens)
+    index.build()
+    return index
+
+class TestLiveIndex(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        words = ["this", "is", "a", "test", "another", "example"]
+        self.base_docs = [(f"b{i}", [rng.choice(words) for _ in range(rng.randrange(1, 12))]) for i in range(20)]
+        self.new_docs = [(f"n{i}", [rng.choice(words + ["flagged", "span"]) for _ in range(rng.randrange(1, 12))])
+                         for i in range(15)]
+
+    def test_merge_equals_full_rebuild(self):
+        base = build(self.base_docs)
+        delta = SuffixArrayIndex()
+        delta.vocab, delta.id_to_token = base.vocab, base.id_to_token
+        for doc_id, tokens in self.new_docs:
+            delta.add_document(doc_id, tokens)
+        delta.build()
+        merged = base.merge(delta)
+        full = build(self.base_docs + self.new_docs)
+        self.assertTrue(np.array_equal(merged.suffix_array, full.suffix_array))
+        self.assertTrue(np.array_equal(merged.lcp, full.lcp))
+        self.assertEqual(merged.doc_ids, full.doc_ids)
+
+    def test_added_documents_are_queryable_before_and_after_merge(self):
+        live = LiveIndex(build(self.base_docs), delta_tokens=30, merge_tokens=10 ** 9)
+        for doc_id, tokens in self.new_docs:
+            live.add_document(doc_id, tokens)
+            self.assertIn({"doc_id": doc_id, "position": 0, "span": tokens}, live.match_span(tokens, top_k=100))
+        self.assertGreater(len(live.shards), 2)
+        full = build(self.base_docs + self.new_docs)
+        spans = [["flagged", "span"], ["this", "is"], ["a"], ["span", "test", "flagged"]]
+        before = [live.count_span(span) for span in spans]
+        live.merge(wait=True)
+        self.assertEqual(len(live.shards), 1)
+        self.assertEqual(before, [full.count_span(span) for span in spans])
+        self.assertTrue(np.array_equal(live.base.suffix_array, full.suffix_array))
+
+    def test_background_merge(self):
+        live = LiveIndex(build(self.base_docs), delta_tokens=20, merge_tokens=40, background=True)
+        for doc_id, tokens in self.new_docs:
+            live.add_document(doc_id, tokens)
+        live.merge(wait=True)
+        self.assertGreater(live.merges, 1)
+        self.assertEqual(list(live.base.doc_ids), [d for d, _ in self.base_docs + self.new_docs])
+
+    def test_synchronous_merge(self):
+        live = LiveIndex(build(self.base_docs), delta_tokens=4, merge_tokens=4, background=False)
+
+        def add_all():
+            for doc_id, tokens in self.new_docs:
+                live.add_document(doc_id, tokens)
+
+        worker = threading.Thread(target=add_all, daemon=True)  # a deadlock fails the test instead of hanging it
+        worker.start()
+        worker.join(timeout=30)
+        self.assertFalse(worker.is_alive())
+        self.assertGreater(live.merges, 1)
+        live.merge(wait=True)
+        self.assertEqual(len(live.shards), 1)
+        self.assertEqual(list(live.base.doc_ids), [d for d, _ in self.base_docs + self.new_docs])
+
+    def test_prov_decode_cache_follows_generation(self):
+        live = LiveIndex(build(self.base_docs))
+        bci = BeliefConflictIndex({"this": 0.3, "is": 0.3, "a": 0.2, "test": 0.2})
+        prov = ProvDecode(live, bci, bci_threshold=10.0, context_window=2)
+        self.assertNotIn("flagged", prov.successor_risks(["a", "test"]))
+        live.add_document("n", ["a", "test", "flagged"])
+        self.assertIn("flagged", prov.successor_risks(["a", "test"]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# tests/test_lsh.py — Unit Tests for MinHash LSH Near-Duplicate Span Tracing
+
+import tempfile
+import unittest
+import numpy as np
+from tracealign.lsh import SpanLSH, shingle_hashes, shingle_jaccard
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.sharded_index import ShardedIndex
+from tracealign.traceshield import TraceShield
+from tracealign.bci import BeliefConflictIndex
+from tracealign.benchmark_lsh import perturb, perturbation_sets, benchmark
+
+def brute_force_similar(index, span, min_jaccard):
+    """(doc_id, position) of every corpus window of len(span) tokens at least min_jaccard similar to span"""
+    query = set(span)
+    found = set()
+    for doc_id, start, end in zip(index.doc_ids, index.doc_offsets.tolist(), np.append(index.doc_offsets[1:], len(index.tokens)).tolist()):
+        doc = [index.id_to_token[t] for t in index.tokens[start:end - 1].tolist()]
+        for p in range(len(doc) - len(span) + 1):
+            window = set(doc[p:p + len(span)])
+            if len(query & window) / len(query | window) >= min_jaccard:
+                found.add((doc_id, p))
+    return found
+
+class TestSpanLSH(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocab = [f"t{i}" for i in range(500)]
+        self.index = SuffixArrayIndex(self.vocab)
+        for d in range(30):
+            self.index.add_document_ids(f"d{d}", rng.integers(0, 500, size=int(rng.integers(5, 80))))
+        self.index.build()
+        self.index.build_lsh(window=6)
+        self.rng = rng
+
+    def perturbed_window(self, substitutions):
+        tokens = self.index.tokens
+        while True:
+            start = int(self.rng.integers(0, len(tokens) - 6))
+            window = np.array(tokens[start:start + 6])
+            if (window >= 0).all():
+                break
+        window[self.rng.choice(6, substitutions, replace=False)] = self.rng.integers(0, 500, substitutions)
+        return [self.vocab[i] for i in window.tolist()]
+
+    def test_shingle_jaccard_counts_sets(self):
+        a = shingle_hashes(np.array([[1, 2, 2, 3]]), 1)
+        b = shingle_hashes(np.array([[2, 3, 4, 4]]), 1)
+        self.assertAlmostEqual(shingle_jaccard(a, b)[0], 2 / 4)
+        self.assertAlmostEqual(shingle_jaccard(a, a)[0], 1.0)
+
+    def test_windows_across_documents_are_excluded(self):
+        lsh = SpanLSH(window=2)
+        lsh.add_stream(np.array([1, 2, -5, 3, 4, 5]))
+        self.assertEqual(sorted(lsh.positions[0].tolist()), [0, 3, 4])
+
+    def test_exact_windows_are_found(self):
+        for _ in range(20):
+            span = self.perturbed_window(0)
+            matches = self.index.trace_similar(span, min_jaccard=1.0)
+            self.assertTrue(matches)
+            self.assertEqual(matches[0]["span"], span)
+            self.assertEqual(matches[0]["jaccard"], 1.0)
+
+    def test_verified_matches_agree_with_brute_force(self):
+        recalled = total = 0
+        for _ in range(30):
+            span = self.perturbed_window(1)
+            expected = brute_force_similar(self.index, span, 0.6)
+            matches = self.index.trace_similar(span, min_jaccard=0.6, top_k=100)
+            found = {(m["doc_id"], m["position"]) for m in matches}
+            self.assertTrue(found <= expected)
+            self.assertTrue(all(m["jaccard"] >= 0.6 for m in matches))
+            recalled += len(found)
+            total += len(expected)
+        self.assertGreater(recalled, 0.9 * total)
+
+    def test_benchmark_perturbations_and_recall(self):
+        rng = np.random.default_rng(1)
+        ids = list(range(12))
+        swapped = perturb(ids, "swap", 4, 500, rng)
+        self.assertEqual(len(swapped), 12)
+        self.assertLessEqual(sum(a != b for a, b in zip(ids, swapped)), 3)
+        self.assertEqual(perturb(ids, "insert", 4, 500, rng)[:4], [0, 1, 2, 3])
+        self.assertEqual(len(perturb(ids, "insert", 4, 500, rng)), 15)
+        sets = perturbation_sets(self.index, 10, 12, seed=2)
+        rows = {r["set"]: r for r in benchmark(self.index, sets, window_size=6, min_jaccard=0.5)}
+        self.assertEqual((rows["verbatim"]["exact_recall"], rows["verbatim"]["fuzzy_recall"]), (1.0, 1.0))
+        self.assertGreaterEqual(rows["swap 1 in 6"]["fuzzy_recall"], rows["swap 1 in 6"]["exact_recall"])
+
+    def test_short_spans_and_missing_tables_raise(self):
+        with self.assertRaises(ValueError):
+            self.index.trace_similar(["t1", "t2"])
+        self.index.lsh = None
+        with self.assertRaises(ValueError):
+            self.index.trace_similar(self.perturbed_window(0))
+
+    def test_persisted_and_merged(self):
+        span = self.perturbed_window(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.index.save(tmp)
+            loaded = SuffixArrayIndex()
+            loaded.load(tmp)
+            self.assertEqual(loaded.lsh.meta(), self.index.lsh.meta())
+            self.assertEqual(loaded.trace_similar(span, 0.5), self.index.trace_similar(span, 0.5))
+        delta = SuffixArrayIndex()
+        delta.vocab, delta.id_to_token = self.index.vocab, self.index.id_to_token
+        delta.add_document("new", ["x1", "x2", "x3", "x4", "x5", "x6", "x7"])
+        delta.build()
+        merged = self.index.merge(delta)
+        matches = merged.trace_similar(["x1", "x2", "x3", "x4", "x5", "zz"], 0.5)
+        self.assertEqual([(m["doc_id"], m["position"]) for m in matches[:1]], [("new", 0)])
+
+    def test_sharded_fan_out(self):
+        other = SuffixArrayIndex()
+        other.vocab, other.id_to_token = self.index.vocab, self.index.id_to_token
+        other.add_document("copy", self.perturbed_window(0))
+        other.build()
+        other.build_lsh(window=6)
+        sharded = ShardedIndex([self.index, other])
+        span = [other.id_to_token[t] for t in other.tokens[:6].tolist()]
+        matches = sharded.trace_similar(span, 1.0, top_k=50)
+        self.assertIn(("copy", 0), {(m["doc_id"], m["position"]) for m in matches})
+        self.assertEqual(len(matches), len(self.index.trace_similar(span, 1.0, top_k=50)) + 1)
+
+class TestFuzzyTraceShield(unittest.TestCase):
+    def setUp(self):
+        self.index = SuffixArrayIndex()
+        self.index.add_document("unsafe", "first mix the rare reagent with acid then heat it slowly".split())
+        self.index.add_document("safe", "the weather is nice and the sun is out today".split())
+        self.index.build()
+        self.index.build_lsh(window=4)
+        self.bci = BeliefConflictIndex({"rare": 1e-6, "reagent": 1e-6, "acid": 1e-5, "the": 0.2, "is": 0.2})
+        self.exact = TraceShield(self.index, self.bci, threshold=20.0, window_size=4)
+        self.fuzzy = TraceShield(self.index, self.bci, threshold=20.0, window_size=4, fuzzy_jaccard=0.6)
+        self.paraphrase = "mix the rare chemical reagent with strong acid".split()  # insertions leave no exact 4-token window
+
+    def test_fuzzy_mode_catches_swapped_token(self):
+        self.assertFalse(self.exact.refuse(self.paraphrase))
+        self.assertTrue(self.fuzzy.refuse(self.paraphrase))
+        self.assertEqual(self.fuzzy.refuse_many([self.paraphrase, "the is the is".split()]), [True, False])
+
+    def test_fuzzy_reports_carry_similarity(self):
+        explanation = self.fuzzy.explain(self.paraphrase)
+        self.assertTrue(explanation["refused"])
+        report = explanation["risky_spans"][0]
+        self.assertEqual(report["match_doc"], "unsafe")
+        self.assertGreaterEqual(report["jaccard"], 0.6)
+        self.assertEqual(self.fuzzy.explain_many([self.paraphrase])[0]["risky_count"], explanation["risky_count"])
+        self.assertIn("Jaccard", self.fuzzy.refusal_report(self.paraphrase))
+
+    def test_exact_matches_are_not_reported_twice(self):
+        copied = "mix the rare reagent".split()
+        reports = self.fuzzy.detect_risky_spans(copied)
+        self.assertEqual([r.get("jaccard") for r in reports if r["span"] == copied], [None])
+
+    def test_session_matches_refuse(self):
+        session = self.fuzzy.session()
+        verdicts = [session.push(token).refuse for token in self.paraphrase]
+        self.assertEqual(verdicts[-1], self.fuzzy.refuse(self.paraphrase))
+        self.assertFalse(verdicts[0])
+
+    def test_fuzzy_needs_similarity_tracer(self):
+        with self.assertRaises(ValueError):
+            TraceShield(object(), self.bci, threshold=20.0, fuzzy_jaccard=0.6)
+
+    def test_fuzzy_needs_lsh_tables(self):
+        plain = SuffixArrayIndex(list(self.index.id_to_token))
+        plain.add_document("safe", "the weather is nice and the sun is out today".split())
+        plain.build()
+        with self.assertRaises(ValueError):
+            TraceShield(plain, self.bci, threshold=20.0, window_size=4, fuzzy_jaccard=0.6)
+        with self.assertRaises(ValueError):
+            TraceShield(ShardedIndex([self.index, plain]), self.bci, threshold=20.0, window_size=4, fuzzy_jaccard=0.6)
+        plain.build_lsh(window=4)
+        sharded = TraceShield(ShardedIndex([self.index, plain]), self.bci, threshold=20.0, window_size=4, fuzzy_jaccard=0.6)
+        self.assertFalse(sharded.refuse("the is the is".split()))
+
+    def test_fuzzy_needs_lsh_window_within_window_size(self):
+        with self.assertRaises(ValueError):
+            TraceShield(self.index, self.bci, threshold=20.0, window_size=3, fuzzy_jaccard=0.6)
+        self.index.build_lsh(window=3)
+        shield = TraceShield(self.index, self.bci, threshold=20.0, window_size=3, fuzzy_jaccard=0.6)
+        self.assertTrue(shield.refuse(self.paraphrase))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# tests/test_metrics.py — Unit Tests for the Metrics Registry, Instrumentation and Profiler
+
+import os
+import time
+import logging
+import tempfile
+import unittest
+from tracealign import metrics
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.bci import BeliefConflictIndex
+from tracealign.traceshield import TraceShield
+from tracealign.prov_decode import ProvDecode
+from tracealign.metrics import MetricsRegistry, Histogram, InstrumentedTracer, MetricsExporter, SamplingProfiler
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.index = SuffixArrayIndex()
+        self.index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        self.index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        self.index.build()
+        self.bci = BeliefConflictIndex({"bad": 0.00001, "stuff": 0.0001, "safe": 0.9, "how": 0.1})
+        self.registry = metrics.enable(MetricsRegistry())
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_disabled_by_default(self):
+        metrics.disable()
+        self.assertFalse(metrics.registry.enabled)
+        with metrics.registry.timer("noop_seconds"):
+            metrics.registry.inc("noop_total")
+        shield = TraceShield(self.index, self.bci, threshold=5.0, window_size=2)
+        self.assertTrue(shield.refuse(["make", "bad", "stuff"]))
+        self.assertEqual(self.registry.counters, {})
+
+    def test_prometheus_text(self):
+        self.registry.inc("requests_total", 3, route="check")
+        self.registry.observe("latency_seconds", 0.002)
+        self.registry.observe("latency_seconds", 20.0)
+        self.registry.add_collector("cache", lambda: {"hits": 4, "hit_rate": 0.5, "policy": "lru"})
+        text = self.registry.to_prometheus()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{route="check"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.0025"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn("latency_seconds_count 2", text)
+        self.assertIn("cache_hit_rate 0.5", text)
+        self.assertNotIn("policy", text)
+
+    def test_histogram_quantile(self):
+        histogram = Histogram((1, 2, 4, 8))
+        for value in (0.5, 1.5, 1.5, 3, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        self.assertEqual(histogram.quantile(1.0), 8)
+
+    def test_traceshield_records_windows_and_refusals(self):
+        shield = TraceShield(self.index, self.bci, threshold=5.0, window_size=2)
+        completions = [["make", "bad", "stuff"], ["safe", "safe", "safe", "safe"]]
+        self.assertEqual(shield.refuse_many(completions), [True, False])
+        self.assertTrue(shield.refuse(completions[0]))
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot["counters"]['traceshield_windows_total{op="refuse_many"}'], 5)
+        self.assertEqual(snapshot["counters"]['traceshield_refusals_total{op="refuse_many"}'], 1)
+        self.assertEqual(snapshot["counters"]['traceshield_refusals_total{op="refuse"}'], 1)
+        self.assertEqual(snapshot["histograms"]['traceshield_check_seconds{op="refuse"}']["count"], 1)
+
+    def test_instrumented_tracer_times_lookups(self):
+        tracer = InstrumentedTracer(self.index, self.registry)
+        spans = [["bad", "stuff"], ["how", "to"]]
+        self.assertEqual(tracer.trace_spans(spans), self.index.trace_spans(spans))
+        self.assertEqual(tracer.trace_span(["bad", "stuff"]), self.index.trace_span(["bad", "stuff"]))
+        self.assertIs(tracer.vocab, self.index.vocab)
+        self.assertFalse(hasattr(InstrumentedTracer(object(), self.registry), "trace_spans"))
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot["counters"]['tracer_spans_total{op="trace_spans"}'], 2)
+        self.assertEqual(snapshot["histograms"]['tracer_call_seconds{op="trace_span"}']["count"], 1)
+
+    def test_prov_decode_records_vetoes_per_step(self):
+        prov = ProvDecode(self.index, self.bci, bci_threshold=5.0, context_window=1)
+        vocab = ["stuff", "safe", "bad"]
+        prov.adjust_logits(["bad"], vocab, [1.0, 1.0, 1.0])
+        prov.adjust_logits(["bad"], vocab, [1.0, 1.0, 1.0])
+        histogram = self.registry.histograms[("prov_vetoed_tokens", (("op", "adjust_logits"),))]
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.sum, 2)
+        self.assertEqual(self.registry.counters[("prov_context_cache_hits_total", ())].value, 1)
+
+    def test_drain_and_merge(self):
+        worker = MetricsRegistry()
+        worker.inc("spans_total", 2)
+        worker.observe("latency_seconds", 0.001)
+        latency = worker.histogram("latency_seconds")
+        state = worker.drain()
+        self.assertEqual(worker.counters[("spans_total", ())].value, 0)
+        latency.observe(0.001)
+        self.assertEqual(worker.drain()["histograms"][("latency_seconds", ())][3], 1)
+        self.registry.merge(state)
+        self.registry.merge(state)
+        self.assertEqual(self.registry.counters[("spans_total", ())].value, 4)
+        self.assertEqual(self.registry.histograms[("latency_seconds", ())].count, 2)
+
+    def test_exporter_callback_and_file(self):
+        snapshots = []
+        self.registry.inc("requests_total")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tracealign.prom")
+            MetricsExporter(self.registry, path, snapshots.append, interval=60).start().stop()
+            with open(path) as f:
+                self.assertIn("requests_total 1", f.read())
+        self.assertEqual(snapshots[0]["counters"]["requests_total"], 1)
+
+    def test_sampling_profiler_sees_hot_function(self):
+        with SamplingProfiler(interval=0.001) as profiler:
+            busy_loop(0.2)
+        self.assertGreater(profiler.samples, 0)
+        self.assertTrue(any("busy_loop" in stack for stack in profiler.stacks))
+
+    def test_library_does_not_configure_logging(self):
+        from tracealign import utils  # noqa: F401
+        self.assertEqual(logging.getLogger("tracealign.utils").handlers, [])
+        self.assertFalse(logging.getLogger("tracealign.prov").isEnabledFor(logging.DEBUG))
+
+if __name__ == "__main__":
+    unittest.main()
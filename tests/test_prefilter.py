@@ -0,0 +1,78 @@
+# tests/test_prefilter.py — Unit Tests for the N-gram Bloom Prefilter
+
+import tempfile
+import unittest
+import numpy as np
+from tracealign.prefilter import NgramBloom
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.traceshield import TraceShield
+from tracealign.bci import BeliefConflictIndex
+
+class TestNgramBloom(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vocab = [f"t{i}" for i in range(50)]
+        self.index = SuffixArrayIndex(self.vocab)
+        for d in range(40):
+            self.index.add_document_ids(f"d{d}", rng.integers(0, 50, size=int(rng.integers(1, 60))))
+        self.index.build()
+        self.index.build_prefilter(n=3, fpr=0.01)
+
+    def test_no_false_negatives(self):
+        tokens = self.index.tokens
+        for start in range(len(tokens) - 3):
+            window = np.asarray(tokens[start:start + 3], dtype=np.int64)
+            if (window >= 0).all():
+                self.assertTrue(self.index.prefilter.contains_windows(window)[0])
+                self.assertTrue(self.index.prefilter.may_contain(window.tolist()))
+
+    def test_windows_across_documents_are_excluded(self):
+        bloom = NgramBloom.for_capacity(2, 10)
+        bloom.add(np.array([1, 2, -5, 3, 4]))
+        self.assertEqual(bloom.items, 2)
+        self.assertEqual(bloom.contains_windows(np.array([1, 2, -1, 3, 4])).tolist(), [True, False, False, True])
+
+    def test_counts_unchanged_and_fpr_reported(self):
+        plain = SuffixArrayIndex(self.vocab)
+        plain.__dict__.update(self.index.__dict__)
+        plain.prefilter = None
+        rng = np.random.default_rng(1)
+        for ids in rng.integers(0, 50, size=(300, 4)).tolist():
+            span = [self.vocab[i] for i in ids]
+            self.assertEqual(self.index.count_span(span), plain.count_span(span))
+        stats = self.index.prefilter.stats()
+        self.assertLess(stats["expected_fpr"], 0.05)
+
+    def test_persisted_with_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.index.save(tmp)
+            loaded = SuffixArrayIndex()
+            loaded.load(tmp)
+            self.assertEqual(loaded.prefilter.meta(), self.index.prefilter.meta())
+            self.assertTrue(np.array_equal(loaded.prefilter.bits, self.index.prefilter.bits))
+
+    def test_shield_results_match_without_prefilter(self):
+        bci = BeliefConflictIndex({t: 1 / 50 for t in self.vocab})
+        shield = TraceShield(self.index, bci, threshold=3 * np.log(50) - 1, window_size=3)
+        tokens = [self.vocab[i] for i in self.index.tokens[:200].tolist() if i >= 0]
+        with_prefilter = shield.detect_risky_spans(tokens)
+        self.index.prefilter = None
+        self.assertEqual(with_prefilter, shield.detect_risky_spans(tokens))
+        self.assertTrue(with_prefilter)
+
+    def test_passed_windows_are_not_probed_again(self):
+        bci = BeliefConflictIndex({t: 1.0 / 50 for t in self.vocab})
+        shield = TraceShield(self.index, bci, threshold=-1.0, window_size=3)
+        # few windows pass, so the shield counts them instead of scanning
+        tokens = [self.vocab[i] for i in self.index.tokens[:5].tolist() if i >= 0] + ["zz"] * 30
+        spans = [tokens[i:i + 3] for i in range(len(tokens) - 2)]
+        counts = [self.index.count_span(span) for span in spans]
+
+        def probe(ids):
+            raise AssertionError("window probed again")
+        self.index.prefilter.may_contain = probe
+        self.assertEqual(list(shield._occurring_windows(tokens)), [span for span, c in zip(spans, counts) if c])
+        self.assertEqual(self.index.count_spans(spans, prefiltered=True), counts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# tests/test_prov_decode.py — Unit Tests for ProvDecode Logit Filtering
+
+import unittest
+import numpy as np
+from tracealign.prov_decode import ProvDecode, ProvLogitsProcessor, ContextCache
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.bci import BeliefConflictIndex
+
+class PlainTracer:
+    """Hides successor enumeration so ProvDecode scores every candidate"""
+    def __init__(self, index):
+        self.index = index
+
+    def trace_span(self, span):
+        return self.index.trace_span(span)
+
+class TestProvDecode(unittest.TestCase):
+    def setUp(self):
+        self.index = SuffixArrayIndex()
+        self.index.add_document("doc1", ["how", "to", "make", "bad", "stuff"])
+        self.index.add_document("doc2", ["how", "to", "make", "tea"])
+        self.index.build()
+        self.bci = BeliefConflictIndex({"how": 0.1, "to": 0.1, "make": 0.1, "tea": 0.1, "bad": 1e-6, "stuff": 0.1})
+        self.vocab = ["tea", "bad", "stuff", "how", "bad"]
+        self.prov = ProvDecode(self.index, self.bci, bci_threshold=15.0, gamma=2.0, context_window=2)
+
+    def test_successors(self):
+        ids = self.index.successors(["to", "make"])
+        self.assertEqual(sorted(self.index.id_to_token[i] for i in ids), ["bad", "tea"])
+
+    def test_adjust_logits_matches_per_token_scoring(self):
+        logits = [1.0, 2.0, 3.0, 4.0, 5.0]
+        plain = ProvDecode(PlainTracer(self.index), self.bci, bci_threshold=15.0, gamma=2.0, context_window=2)
+        prefix = ["how", "to", "make"]
+        adjusted = self.prov.adjust_logits(prefix, self.vocab, logits)
+        self.assertEqual(adjusted, plain.adjust_logits(prefix, self.vocab, logits))
+        self.assertEqual(adjusted, [1.0, 0.0, 3.0, 4.0, 3.0])
+        self.assertEqual(self.prov.rank_tokens(prefix, self.vocab), plain.rank_tokens(prefix, self.vocab))
+
+    def test_logits_processor_rows(self):
+        processor = ProvLogitsProcessor(self.prov, ["how", "to", "make", "tea", "bad"])
+        input_ids = np.array([[0, 1, 2], [2, 3, 0]])
+        scores = processor(input_ids, np.zeros((2, 5)))
+        self.assertEqual(scores[0].tolist(), [0.0, 0.0, 0.0, 0.0, -2.0])
+        self.assertEqual(scores[1].tolist(), [0.0] * 5)
+
+    def test_context_cache_hits_and_extension(self):
+        prefix = ["how", "to", "make"]
+        self.prov.risky_positions(prefix[:1], self.vocab)
+        self.prov.risky_positions(prefix[:2], self.vocab)
+        self.prov.risky_positions(prefix[:2], self.vocab)
+        stats = self.prov.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["extended"]), (1, 2, 1))
+
+    def test_context_cache_slides_with_full_window(self):
+        rng = np.random.default_rng(0)
+        vocab = [f"t{i}" for i in range(20)]
+        index = SuffixArrayIndex(vocab)
+        for d in range(50):
+            index.add_document_ids(f"d{d}", rng.integers(0, 20, size=200))
+        index.build()
+        bci = BeliefConflictIndex({tok: 0.05 for tok in vocab})
+        prov = ProvDecode(index, bci, bci_threshold=5.0, context_window=8)
+        plain = ProvDecode(index, bci, bci_threshold=5.0, context_window=8, cache_size=0)
+        prefix = [vocab[i] for i in index.tokens[300:308].tolist()]
+        for step in range(40):
+            self.assertEqual(prov.successor_risks(prefix), plain.successor_risks(prefix))
+            if step == 0:
+                warm = dict(prov.cache.counters)
+            prefix.append(vocab[int(index.tokens[308 + step])] if step % 2 else vocab[int(rng.integers(0, 20))])
+        self.assertEqual(prov.cache.counters["extended"] - warm["extended"], 39)
+        self.assertEqual(prov.cache.counters["misses"] - warm["misses"], 39)
+
+    def test_context_cache_lru_and_fork(self):
+        cache = ContextCache(capacity=2)
+        for key in [("a",), ("b",), ("a",), ("c",)]:
+            if cache.get(key) is None:
+                cache.put(key, [(0, 0), None, None])
+        self.assertEqual(list(cache.entries), [("a",), ("c",)])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        child = cache.fork()
+        child.put(("d",), [(0, 0), None, None])
+        self.assertNotIn(("d",), cache.entries)
+        self.assertIs(child.counters, cache.counters)
+
+    def test_logits_processor_shares_cache_across_beams(self):
+        processor = ProvLogitsProcessor(self.prov, ["how", "to", "make", "tea", "bad"])
+        processor(np.array([[0, 1], [0, 1]]), np.zeros((2, 5)))
+        scores = processor(np.array([[0, 1, 2], [0, 1, 2]]), np.zeros((2, 5)))
+        self.assertEqual(scores[1].tolist(), [0.0, 0.0, 0.0, 0.0, -2.0])
+        self.assertGreater(processor.stats()["hits"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
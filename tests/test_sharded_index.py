@@ -0,0 +1,87 @@
+# tests/test_sharded_index.py — Unit Tests for ShardedIndex
+
+import os
+import json
+import tempfile
+import unittest
+import numpy as np
+from tracealign.utils import ingest_corpus
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.sharded_index import ShardedIndex, build_sharded_index, manifest_vocab, open_index, plan_shards
+
+DOCS = [
+    "this is a test",
+    "this is another example",
+    "a test is a test",
+    "another example of a test",
+    "is this the end"
+]
+
+class TestShardedIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_corpus(self, name, docs):
+        corpus_dir = os.path.join(self.tmp.name, name)
+        os.makedirs(corpus_dir)
+        with open(os.path.join(corpus_dir, "docs.jsonl"), "w") as f:
+            for i, text in enumerate(docs):
+                f.write(json.dumps({"id": f"{name}{i}", "text": text}) + "\n")
+        return corpus_dir
+
+    def build(self, name, docs, output, shard_tokens, append=False):
+        stream = os.path.join(self.tmp.name, name + ".stream")
+        vocab = manifest_vocab(output) if append else None
+        ingest_corpus(self.write_corpus(name, docs), stream, workers=1, vocab=vocab)
+        build_sharded_index(stream, output, shard_tokens, workers=2, append=append)
+
+    def reference(self, docs):
+        index = SuffixArrayIndex()
+        for i, text in enumerate(docs):
+            index.add_document(str(i), text.split())
+        index.build()
+        return index
+
+    def assert_same_queries(self, sharded, single):
+        for span in [["a", "test"], ["this", "is"], ["test"], ["of", "a", "test"], ["missing"], []]:
+            self.assertEqual(sharded.count_span(span), single.count_span(span))
+            self.assertEqual(len(sharded.match_span(span, top_k=100)), len(single.match_span(span, top_k=100)))
+            self.assertEqual(set(sharded.successors(span).tolist()), set(single.successors(span).tolist()))
+        spans = [["a", "test"], ["this", "is"], ["test"], ["of", "a", "test"], ["missing"], [], ["a", "test"]]
+        self.assertEqual(sharded.count_spans(spans), [single.count_span(span) for span in spans])
+        self.assertEqual(sharded.match_spans(spans, top_k=3), [sharded.match_span(span, top_k=3) for span in spans])
+        tokens = "is a test is this the end of another example".split()
+        self.assertEqual(list(sharded.iter_matching_statistics(tokens, cap=4)),
+                         list(single.iter_matching_statistics(tokens, cap=4)))
+
+    def test_plan_shards(self):
+        offsets = np.array([0, 5, 7, 20, 22])
+        self.assertEqual(plan_shards(offsets, 8), [(0, 2), (2, 3), (3, 4)])
+
+    def test_sharded_matches_single_index(self):
+        output = os.path.join(self.tmp.name, "index")
+        self.build("a", DOCS, output, shard_tokens=10)
+        sharded = open_index(output)
+        self.assertIsInstance(sharded, ShardedIndex)
+        self.assertEqual(len(sharded.shards), 4)
+        self.assert_same_queries(sharded, self.reference(DOCS))
+        self.assertEqual(sharded.match_span(["a", "test"], top_k=2), sharded.match_span(["a", "test"], top_k=2))
+
+    def test_append_adds_shards_without_rebuilding(self):
+        output = os.path.join(self.tmp.name, "index")
+        self.build("a", DOCS[:3], output, shard_tokens=100)
+        self.build("b", DOCS[3:], output, shard_tokens=100, append=True)
+        sharded = open_index(output)
+        self.assertEqual(len(sharded.shards), 2)
+        self.assert_same_queries(sharded, self.reference(DOCS))
+
+    def test_rejects_unaligned_vocabularies(self):
+        first, second = SuffixArrayIndex(["a", "b"]), SuffixArrayIndex(["b", "a"])
+        with self.assertRaises(ValueError):
+            ShardedIndex([first, second])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# tests/test_span_cache.py — Unit Tests for the Shared Span-Result Cache
+
+import pickle
+import unittest
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.live_index import LiveIndex
+from tracealign.bci import BeliefConflictIndex
+from tracealign.traceshield import TraceShield
+from tracealign.span_cache import MISSING, SpanCache, SharedSpanTable, CachedTracer, CachedBCI
+
+class CountingTracer:
+    """Tracer without a vocabulary that counts the lookups reaching it"""
+    def __init__(self):
+        self.calls = 0
+
+    def trace_span(self, span):
+        self.calls += 1
+        return [{"span": span}]
+
+class TestSpanCache(unittest.TestCase):
+    def setUp(self):
+        self.index = SuffixArrayIndex()
+        self.index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        self.index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        self.index.build()
+        self.bci = BeliefConflictIndex({"bad": 0.00001, "stuff": 0.0001, "safe": 0.9, "how": 0.1})
+
+    def test_lru_respects_byte_budget(self):
+        cache = SpanCache(max_bytes=2000)
+        for i in range(100):
+            cache.put(("k", i), [i] * 10)
+        self.assertLessEqual(cache.nbytes, 2000)
+        self.assertGreater(cache.counters["evictions"], 0)
+        self.assertIs(cache.get(("k", 0)), MISSING)
+        self.assertEqual(cache.get(("k", 99)), [99] * 10)
+
+    def test_tinylfu_keeps_frequent_entries(self):
+        cache = SpanCache(max_bytes=3000, policy="tinylfu")
+        for _ in range(5):
+            for i in range(5):
+                cache.get(("hot", i))
+        for i in range(5):
+            cache.put(("hot", i), [i] * 10)
+        for i in range(200):
+            cache.get(("cold", i))
+            cache.put(("cold", i), [i] * 10)
+        self.assertTrue(all(cache.get(("hot", i)) is not MISSING for i in range(5)))
+        self.assertGreater(cache.counters["rejections"], 0)
+
+    def test_cached_tracer_matches_and_counts_hits(self):
+        cache = SpanCache()
+        tracer = CachedTracer(self.index, cache)
+        spans = [["bad", "stuff"], ["how", "to"], ["bad", "stuff"], ["missing"]]
+        self.assertEqual(tracer.trace_spans(spans), [self.index.trace_span(s) for s in spans])
+        self.assertEqual(tracer.trace_span(["bad", "stuff"]), self.index.trace_span(["bad", "stuff"]))
+        self.assertEqual(tracer.count_span(["bad", "stuff"]), 2)
+        self.assertEqual(cache.counters["hits"], 1)
+        self.assertEqual(tracer.suffix_array.tolist(), self.index.suffix_array.tolist())
+
+        tokens = ["so", "how", "to", "make", "bad", "stuff", "safe", "bad", "stuff"]
+        plain = TraceShield(self.index, self.bci, threshold=10.0, window_size=2)
+        cached = TraceShield(tracer, CachedBCI(self.bci, cache), threshold=10.0, window_size=2)
+        for _ in range(2):
+            self.assertEqual(cached.explain(tokens), plain.explain(tokens))
+
+    def test_tracer_without_vocab_and_bci(self):
+        inner = CountingTracer()
+        tracer = CachedTracer(inner, SpanCache())
+        for _ in range(3):
+            tracer.trace_span(["a", "b"])
+        self.assertEqual(inner.calls, 1)
+        bci = CachedBCI(self.bci, SpanCache())
+        report = bci.explain_span(["bad", "stuff"])
+        report["match_doc"] = "doc1"
+        self.assertEqual(bci.explain_span(["bad", "stuff"]), self.bci.explain_span(["bad", "stuff"]))
+        self.assertEqual(bci.compute_kl_divergence(["x", "y"]), self.bci.compute_kl_divergence(["x", "y"]))
+
+    def test_live_index_generation_invalidates(self):
+        live = LiveIndex(self.index, background=False)
+        tracer = CachedTracer(live, SpanCache())
+        self.assertEqual(tracer.count_span(["bad", "stuff"]), 2)
+        live.add_document("doc3", ["bad", "stuff"])
+        self.assertEqual(tracer.count_span(["bad", "stuff"]), 3)
+
+    def test_shared_table_between_caches(self):
+        table = SharedSpanTable.create(1 << 16, slot_bytes=256)
+        try:
+            attached = pickle.loads(pickle.dumps(table))
+            first, second = SpanCache(shared=table), SpanCache(shared=attached)
+            first.put(("t", (1, 2)), [{"doc_id": "d", "position": 3}])
+            self.assertEqual(second.get(("t", (1, 2))), [{"doc_id": "d", "position": 3}])
+            self.assertEqual(second.counters["shared_hits"], 1)
+            self.assertFalse(table.put(("big",), list(range(1000))))
+            self.assertIs(second.get(("big",)), MISSING)
+            attached.close()
+        finally:
+            table.close()
+
+if __name__ == "__main__":
+    unittest.main()
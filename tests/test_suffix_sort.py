@@ -0,0 +1,32 @@
+# tests/test_suffix_sort.py — Unit Tests for Suffix Array Construction
+
+import unittest
+import numpy as np
+from tracealign.suffix_sort import prefix_doubling, naive_suffix_array, check_suffix_array
+from tracealign.traceindex import SuffixArrayIndex
+
+class TestSuffixSort(unittest.TestCase):
+    def test_banana(self):
+        stream = np.array([ord(c) for c in "banana"], dtype=np.int32)
+        self.assertEqual(prefix_doubling(stream).tolist(), [5, 3, 1, 0, 4, 2])
+
+    def test_matches_naive_on_random_streams(self):
+        rng = np.random.default_rng(0)
+        for n in [0, 1, 2, 17, 300]:
+            stream = rng.integers(0, 3, size=n).astype(np.int32)
+            self.assertTrue(np.array_equal(prefix_doubling(stream), naive_suffix_array(stream)))
+            self.assertTrue(check_suffix_array(stream))
+
+    def test_index_build_verify(self):
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["a", "b", "a", "b", "a"])
+        index.add_document("doc2", ["b", "a", "b"])
+        index.build(verify=True)
+        naive = SuffixArrayIndex()
+        naive.add_document("doc1", ["a", "b", "a", "b", "a"])
+        naive.add_document("doc2", ["b", "a", "b"])
+        naive.build(method="naive")
+        self.assertTrue(np.array_equal(index.suffix_array, naive.suffix_array))
+
+if __name__ == '__main__':
+    unittest.main()
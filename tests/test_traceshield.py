@@ -1,28 +1,78 @@
 # tests/test_traceshield.py — Unit Tests for TraceShield Refusal Logic
- 
+
 import unittest
 from tracealign.traceshield import TraceShield
 from tracealign.traceindex import SuffixArrayIndex
 from tracealign.bci import BeliefConflictIndex
- 
+
 class DummyTracer:
-	def trace_span(self, span):
-    	return [{"span": span}]
- 
+    def trace_span(self, span):
+        return [{"span": span}]
+
+class PlainTracer:
+    """Hides the index scan so TraceShield falls back to per-window lookups"""
+    def __init__(self, index):
+        self.index = index
+
+    def trace_span(self, span):
+        return self.index.trace_span(span)
+
 class TestTraceShield(unittest.TestCase):
-	def setUp(self):
-    	dummy_probs = {"bad": 0.00001, "safe": 0.9}
-    	self.bci = BeliefConflictIndex(dummy_probs)
-    	self.tracer = DummyTracer()
-    	self.shield = TraceShield(self.tracer, self.bci, threshold=10.0)
- 
-	def test_refuse_true(self):
-    	tokens = ["this", "is", "bad"]
-    	self.assertTrue(self.shield.refuse(tokens))
- 
-	def test_refuse_false(self):
-    	tokens = ["safe", "tokens"]
-    	self.assertFalse(self.shield.refuse(tokens))
- 
+    def setUp(self):
+        dummy_probs = {"bad": 0.00001, "safe": 0.9}
+        self.bci = BeliefConflictIndex(dummy_probs)
+        self.tracer = DummyTracer()
+        self.shield = TraceShield(self.tracer, self.bci, threshold=10.0, window_size=3)
+
+    def test_refuse_true(self):
+        tokens = ["this", "is", "bad"]
+        self.assertTrue(self.shield.refuse(tokens))
+
+    def test_refuse_false(self):
+        tokens = ["safe", "safe", "safe"]
+        self.assertFalse(self.shield.refuse(tokens))
+
+    def test_scan_matches_per_window_lookups(self):
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        index.build()
+        tokens = ["so", "how", "to", "make", "bad", "stuff", "safe", "bad", "stuff"]
+        scan = TraceShield(index, self.bci, threshold=10.0, window_size=2)
+        lookup = TraceShield(PlainTracer(index), self.bci, threshold=10.0, window_size=2)
+        self.assertEqual(scan.detect_risky_spans(tokens), lookup.detect_risky_spans(tokens))
+        self.assertTrue(scan.refuse(tokens))
+        self.assertEqual(scan.detect_risky_spans(tokens)[0]["match_doc"], "doc1")
+
+    def test_session_matches_refuse(self):
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["how", "to", "make", "bad", "stuff"])
+        index.build()
+        shield = TraceShield(index, self.bci, threshold=10.0, window_size=3)
+        session = shield.session()
+        tokens = ["safe", "how", "to", "make", "safe"]
+        for i, token in enumerate(tokens):
+            self.assertEqual(session.push(token).refuse, shield.refuse(tokens[:i + 1]))
+        self.assertTrue(session.refused)
+        session.rollback(2)
+        self.assertFalse(session.refused)
+        verdict = session.push("to")
+        self.assertFalse(verdict.refuse)
+        verdict = session.fork().push("make")
+        self.assertEqual(verdict.span, ["how", "to", "make"])
+        self.assertEqual(verdict.match["doc_id"], "doc1")
+
+    def test_batched_checks_match_per_completion(self):
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        index.build()
+        completions = [["so", "how", "to", "make", "bad", "stuff", "safe", "bad", "stuff"],
+                       ["safe", "tokens"], [], ["bad"], ["safe", "bad", "stuff"]]
+        for shield in (TraceShield(index, self.bci, threshold=10.0, window_size=2),
+                       TraceShield(PlainTracer(index), self.bci, threshold=10.0, window_size=2)):
+            self.assertEqual(shield.refuse_many(completions), [shield.refuse(c) for c in completions])
+            self.assertEqual(shield.explain_many(completions), [shield.explain(c) for c in completions])
+
 if __name__ == '__main__':
-	unittest.main()
+    unittest.main()
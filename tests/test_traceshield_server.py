@@ -0,0 +1,123 @@
+# tests/test_traceshield_server.py — Unit Tests for the Micro-Batching TraceShield Service
+
+import asyncio
+import unittest
+from tracealign import metrics
+from tracealign.traceindex import SuffixArrayIndex
+from tracealign.bci import BeliefConflictIndex
+from tracealign.traceshield import TraceShield
+from tracealign.traceshield_server import TraceShieldServer, TraceShieldClient
+
+class ExplodingShield(TraceShield):
+    """Fails any batch holding the token 'boom', as a request the shield cannot score would"""
+    def refuse_many(self, completions):
+        if any("boom" in tokens for tokens in completions):
+            raise RuntimeError("cannot score 'boom'")
+        return super().refuse_many(completions)
+
+class TestTraceShieldServer(unittest.TestCase):
+    def setUp(self):
+        index = SuffixArrayIndex()
+        index.add_document("doc1", ["how", "to", "make", "bad", "stuff", "at", "home"])
+        index.add_document("doc2", ["safe", "bad", "stuff", "safe"])
+        index.build()
+        bci = BeliefConflictIndex({"bad": 0.00001, "stuff": 0.0001, "safe": 0.9})
+        self.shield = TraceShield(index, bci, threshold=10.0, window_size=2)
+        self.completions = [["how", "to", "make", "bad", "stuff"], ["safe", "and", "sound"], ["safe", "bad", "stuff"]] * 10
+
+    def serve(self, scenario, **kwargs):
+        async def run():
+            server = TraceShieldServer(self.shield, **kwargs)
+            await server.start(port=0)
+            try:
+                return await scenario(*server.address())
+            finally:
+                await server.stop()
+        return asyncio.run(run())
+
+    def test_concurrent_requests_are_batched(self):
+        async def scenario(host, port):
+            clients = [TraceShieldClient(host, port) for _ in self.completions]
+            verdicts = await asyncio.gather(*(c.check(tokens) for c, tokens in zip(clients, self.completions)))
+            _, explained = await clients[0].request("POST", "/explain", {"text": "So, how to make bad stuff?"})
+            _, stats = await clients[0].request("GET", "/stats")
+            health = await clients[0].request("GET", "/health")
+            missing = await clients[0].request("POST", "/check", {"nothing": 1})
+            for c in clients:
+                await c.close()
+            return verdicts, explained, stats, health, missing
+
+        verdicts, explained, stats, health, missing = self.serve(scenario, max_batch=16, max_wait_ms=20)
+        self.assertEqual(verdicts, [self.shield.refuse(c) for c in self.completions])
+        self.assertEqual(explained, self.shield.explain(["so", ",", "how", "to", "make", "bad", "stuff", "?"]))
+        self.assertEqual(stats["requests"], len(self.completions) + 1)
+        self.assertLess(stats["batches"], len(self.completions))
+        self.assertEqual(health[0], 200)
+        self.assertEqual(missing[0], 400)
+
+    def test_full_queue_answers_503(self):
+        async def scenario(host, port):
+            clients = [TraceShieldClient(host, port) for _ in range(20)]
+            results = await asyncio.gather(*(c.request("POST", "/check", {"tokens": ["bad", "stuff"]}) for c in clients))
+            for c in clients:
+                await c.close()
+            return [status for status, _ in results]
+
+        statuses = self.serve(scenario, max_batch=1, max_wait_ms=0, max_pending=2)
+        self.assertIn(503, statuses)
+        self.assertIn(200, statuses)
+
+    def test_malformed_requests_do_not_fail_their_batch(self):
+        payloads = [{"tokens": ["bad", "stuff"]}, {"tokens": [["x"], "stuff"]}, {"tokens": "bad stuff"},
+                    {"text": 7}, {"tokens": ["safe", "and", "sound"]}]
+
+        async def scenario(host, port):
+            clients = [TraceShieldClient(host, port) for _ in payloads]
+            results = await asyncio.gather(*(c.request("POST", "/check", p) for c, p in zip(clients, payloads)))
+            for c in clients:
+                await c.close()
+            return results
+
+        results = self.serve(scenario, max_batch=8, max_wait_ms=20)
+        self.assertEqual([status for status, _ in results], [200, 400, 400, 400, 200])
+        self.assertEqual([results[0][1], results[4][1]], [{"refused": True}, {"refused": False}])
+
+    def test_failing_request_is_isolated_from_its_batch(self):
+        self.shield = ExplodingShield(self.shield.tracer, self.shield.bci, threshold=10.0, window_size=2)
+        completions = [["bad", "stuff"], ["boom", "bad", "stuff"], ["safe", "and", "sound"]]
+
+        async def scenario(host, port):
+            clients = [TraceShieldClient(host, port) for _ in completions]
+            await asyncio.gather(*(c.connect() for c in clients))  # every client is open before the batch closes
+            results = await asyncio.gather(*(c.request("POST", "/check", {"tokens": t}) for c, t in zip(clients, completions)))
+            _, stats = await clients[0].request("GET", "/stats")
+            for c in clients:
+                await c.close()
+            return results, stats
+
+        results, stats = self.serve(scenario, max_batch=8, max_wait_ms=500)
+        self.assertEqual([status for status, _ in results], [200, 500, 200])
+        self.assertEqual([results[0][1], results[2][1]], [{"refused": True}, {"refused": False}])
+        self.assertEqual((stats["batches"], stats["errors"]), (1, 1))
+
+    def test_metrics_route(self):
+        async def scenario(host, port):
+            client = TraceShieldClient(host, port)
+            disabled = await client.request("GET", "/metrics")
+            metrics.enable()
+            try:
+                await client.check(["make", "bad", "stuff"])
+                enabled = await client.request("GET", "/metrics")
+            finally:
+                metrics.disable()
+            await client.close()
+            return disabled, enabled
+
+        disabled, (status, text) = self.serve(scenario)
+        self.assertEqual(disabled[0], 404)
+        self.assertEqual(status, 200)
+        self.assertIn('traceshield_refusals_total{op="refuse_many"} 1', text)
+        self.assertIn("server_batch_size_count 1", text)
+
+if __name__ == "__main__":
+    unittest.main()
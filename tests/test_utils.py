@@ -0,0 +1,54 @@
+# tests/test_utils.py — Unit Tests for Corpus Ingestion
+
+import os
+import gzip
+import json
+import tempfile
+import unittest
+import numpy as np
+from tracealign.utils import iter_corpus, tokenize_corpus, compute_token_frequencies, ingest_corpus
+from tracealign.traceindex import SuffixArrayIndex, read_stream_counts
+
+class TestIngestion(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.corpus_dir = os.path.join(self.tmp.name, "corpus")
+        os.makedirs(self.corpus_dir)
+        with open(os.path.join(self.corpus_dir, "a.txt"), "w") as f:
+            f.write("This is a test.")
+        with open(os.path.join(self.corpus_dir, "b.jsonl"), "w") as f:
+            f.write(json.dumps({"id": "b1", "text": "this is another example"}) + "\n")
+            f.write(json.dumps({"id": "b2", "text": ""}) + "\n")
+        with gzip.open(os.path.join(self.corpus_dir, "c.jsonl.gz"), "wt") as f:
+            for i in range(5):
+                f.write(json.dumps({"id": f"c{i}", "text": "a test , again " * i}) + "\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_iter_corpus_streams_gzip_in_file_order(self):
+        ids = [doc["id"] for doc in iter_corpus(self.corpus_dir)]
+        self.assertEqual(ids, ["a.txt", "b1", "b2", "c0", "c1", "c2", "c3", "c4"])
+
+    def test_parallel_tokenize_keeps_order(self):
+        corpus = list(iter_corpus(self.corpus_dir))
+        self.assertEqual(tokenize_corpus(corpus, workers=2), tokenize_corpus(corpus))
+
+    def test_ingest_matches_in_memory_build(self):
+        corpus = list(iter_corpus(self.corpus_dir))
+        reference = SuffixArrayIndex()
+        for doc in tokenize_corpus(corpus):
+            reference.add_document(doc["id"], doc["tokens"])
+        reference.build()
+        for workers in [1, 2]:
+            stream_dir = os.path.join(self.tmp.name, f"stream{workers}")
+            ingest_corpus(self.corpus_dir, stream_dir, workers=workers, chunk_size=3)
+            self.assertEqual(read_stream_counts(stream_dir), compute_token_frequencies(corpus))
+            index = SuffixArrayIndex.from_token_stream(stream_dir)
+            self.assertEqual(list(index.doc_ids), reference.doc_ids)
+            self.assertTrue(np.array_equal(index.tokens, reference.tokens))
+            self.assertTrue(np.array_equal(index.suffix_array, reference.suffix_array))
+            self.assertEqual(index.match_span(["a", "test"]), reference.match_span(["a", "test"]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,62 +1,825 @@
 # tracealign/traceindex.py — Efficient and Attributable Suffix Array Index for Unsafe Span Retrieval
- 
-from typing import Tuple
+
+import logging
+import os
 import pickle
- 
-class SuffixArrayIndex:
-	def __init__(self):
-    	self.suffix_array: List[Tuple[List[str], str, int]] = []  # (suffix tokens, doc_id, start index)
-    	self.lexicon: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
-    	self.doc_lengths: Dict[str, int] = {}
- 
-	def add_document(self, doc_id: str, tokens: List[str]):
-    	self.doc_lengths[doc_id] = len(tokens)
-    	for i in range(len(tokens)):
-        	suffix = tokens[i:]
-        	self.suffix_array.append((suffix, doc_id, i))
-        	self.lexicon[tokens[i]].append((doc_id, i))
- 
-	def build(self):
-    	logger.info("Sorting suffix array lexicographically...")
-    	self.suffix_array.sort(key=lambda x: x[0])
-    	logger.info(f"Suffix array built with {len(self.suffix_array)} suffixes.")
- 
-	def match_span(self, span: List[str], top_k: int = 5) -> List[Dict]:
-    	matches = []
-    	low, high = 0, len(self.suffix_array)
-    	while low < high:
-        	mid = (low + high) // 2
-        	if self.suffix_array[mid][0][:len(span)] < span:
-        	    low = mid + 1
-        	else:
-            	high = mid
-    	start = low
-    	while start < len(self.suffix_array):
-        	suffix, doc_id, offset = self.suffix_array[start]
-        	if suffix[:len(span)] == span:
-            	matches.append({"doc_id": doc_id, "position": offset, "span": suffix[:len(span)]})
-            	if len(matches) >= top_k:
-                	break
-            	start += 1
-        	else:
-            	break
-    	return matches
- 
-	def save(self, path: str):
-    	logger.info(f"Saving suffix array index to {path}")
-    	with open(path, "wb") as f:
-        	pickle.dump({
-            	"suffix_array": self.suffix_array,
-            	"lexicon": self.lexicon,
-            	"doc_lengths": self.doc_lengths
-        	}, f)
-    	logger.info("Suffix array saved.")
- 
-	def load(self, path: str):
-    	logger.info(f"Loading suffix array index from {path}")
-    	with open(path, "rb") as f:
-        	data = pickle.load(f)
-        	self.suffix_array = data["suffix_array"]
-        	self.lexicon = data["lexicon"]
-        	self.doc_lengths = data["doc_lengths"]
-    	logger.info("Suffix array loaded successfully.")
+import time
+from array import array
+from typing import Iterator, List, Dict, Optional, Tuple
+
+import numpy as np
+
+from tracealign.suffix_sort import prefix_doubling, naive_suffix_array, naive_lcp
+from tracealign.prefilter import NgramBloom
+from tracealign.lsh import SpanLSH, shingle_hashes, shingle_jaccard
+from tracealign.doc_listing import DocumentListing, scan_intervals, rank_documents
+from tracealign.index_store import (INDEX_VERSION, StringTable, open_array, read_header, read_index, write_array, write_header,
+                                    write_index, write_strings)
+from tracealign.span_index import SpanIndex, has_unknown, pad_queries, prefilter_spans
+
+logger = logging.getLogger("tracealign.traceindex")
+
+# Every document in the token stream is closed by its own terminator id. Terminators are
+# negative (below every interned token) and increase with document order, so no suffix
+# comparison crosses a document boundary and equal suffixes keep insertion order.
+TERMINATOR_BASE = -(2 ** 31)
+
+# On-disk layout written by save(): see index_store
+INDEX_FORMAT = "tracealign-suffix-array"
+# Token stream written by TokenStreamWriter during ingestion: the unsorted input of build()
+STREAM_FORMAT = "tracealign-token-stream"
+
+
+class SuffixArrayIndex(SpanIndex):
+    def __init__(self, vocab: Optional[List[str]] = None):
+        self.vocab: Dict[str, int] = {}  # token -> interned id
+        self.id_to_token: List[str] = []
+        self.doc_ids: List[str] = []
+        self.tokens = np.empty(0, dtype=np.int32)  # contiguous corpus stream, one terminator per document
+        self.doc_offsets = np.empty(0, dtype=np.int64)  # sorted start offset of each document in the stream
+        self.suffix_array = np.empty(0, dtype=np.int64)  # suffix start positions into the stream
+        self.lcp = np.empty(0, dtype=np.int32)  # lcp[i] = common prefix length of suffixes i - 1 and i
+        self.token_starts = np.zeros(1, dtype=np.int64)  # suffixes starting with id t are [token_starts[t], token_starts[t + 1])
+        self._pending = array("i")
+        self._pending_offsets: List[int] = []
+        self.path: Optional[str] = None  # index directory once loaded, so worker processes can re-map it
+        self.prefilter: Optional[NgramBloom] = None  # n-gram Bloom filter consulted before suffix array searches
+        self.lsh: Optional[SpanLSH] = None  # MinHash band tables for near-duplicate window lookups
+        self.doc_listing: Optional[DocumentListing] = None  # document array for distinct-document queries
+        for token in vocab or ():
+            self.intern(token)  # ID-aligned: interned id == position in vocab, e.g. a tokenizer's ids
+
+    def intern(self, token: str) -> int:
+        tid = self.vocab.get(token)
+        if tid is None:
+            tid = self.vocab[token] = len(self.id_to_token)
+            self.id_to_token.append(token)
+        return tid
+
+    @property
+    def doc_lengths(self) -> Dict[str, int]:
+        offsets = np.concatenate([self.doc_offsets, np.array(self._pending_offsets, dtype=np.int64)])
+        ends = np.append(offsets[1:], len(self.tokens) + len(self._pending))
+        return dict(zip(self.doc_ids, (ends - offsets - 1).tolist()))
+
+    def add_document(self, doc_id: str, tokens: List[str]):
+        if not isinstance(self.doc_ids, list):
+            self.doc_ids = list(self.doc_ids)
+        self._pending_offsets.append(len(self.tokens) + len(self._pending))
+        self._pending.extend(self.intern(t) for t in tokens)
+        self._pending.append(TERMINATOR_BASE + len(self.doc_ids))
+        self.doc_ids.append(doc_id)
+
+    def add_document_ids(self, doc_id: str, ids):
+        """Add a document that is already a sequence of interned (or ID-aligned tokenizer) ids"""
+        if not isinstance(self.doc_ids, list):
+            self.doc_ids = list(self.doc_ids)
+        ids = np.asarray(ids, dtype=np.int32)
+        if len(ids) and (ids.min() < 0 or ids.max() >= len(self.id_to_token)):
+            raise ValueError(f"Document {doc_id} has token ids outside the {len(self.id_to_token)}-token vocabulary")
+        self._pending_offsets.append(len(self.tokens) + len(self._pending))
+        self._pending.extend(ids.tolist())
+        self._pending.append(TERMINATOR_BASE + len(self.doc_ids))
+        self.doc_ids.append(doc_id)
+
+    def build(self, method: str = "doubling", verify: bool = False):
+        """
+        Sort all suffixes of the token stream.
+
+        method: "doubling" (vectorized prefix doubling, default) or "naive" (comparison sort reference).
+        verify: also run the naive sort and assert both agree; only sensible on small corpora.
+        """
+        if self._pending_offsets:
+            self.tokens = np.concatenate([self.tokens, np.array(self._pending, dtype=np.int32)])
+            self.doc_offsets = np.concatenate([self.doc_offsets, np.array(self._pending_offsets, dtype=np.int64)])
+            self._pending = array("i")
+            self._pending_offsets = []
+        logger.info(f"Sorting suffix array lexicographically ({method}, {len(self.tokens)} stream tokens)...")
+        start = time.perf_counter()
+        if method == "doubling":
+            full, lcp = prefix_doubling(self.tokens, progress=self._log_progress, return_lcp=True)
+        elif method == "naive":
+            full = naive_suffix_array(self.tokens)
+            lcp = naive_lcp(self.tokens, full)
+        else:
+            raise ValueError(f"Unknown suffix array construction method: {method}")
+        if verify and method != "naive":
+            if not np.array_equal(full, naive_suffix_array(self.tokens)):
+                raise RuntimeError("Suffix array does not match the naive sort")
+            logger.info("Suffix array verified against naive sort.")
+        # terminators are the smallest symbols, so the first len(doc_offsets) suffixes are document ends
+        self.suffix_array = full[len(self.doc_offsets):]
+        self.lcp = lcp[len(self.doc_offsets):]
+        counts = np.bincount(self.tokens[self.tokens >= 0], minlength=len(self.id_to_token))
+        self.token_starts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.token_starts[1:])
+        logger.info(f"Suffix array built with {len(self.suffix_array)} suffixes in {time.perf_counter() - start:.2f}s.")
+        if self.prefilter is not None:
+            self.build_prefilter(self.prefilter.n, self.prefilter.fpr)
+        if self.lsh is not None:
+            self.build_lsh(self.lsh.window, self.lsh.shingle, self.lsh.bands, self.lsh.rows)
+        if self.doc_listing is not None:
+            self.build_doc_listing()
+
+    def build_prefilter(self, n: int = 8, fpr: float = 0.01) -> Dict:
+        """
+        Build the n-gram Bloom prefilter sized for every n-token window of the corpus at the target
+        false-positive rate. interval() and window_prefilter() consult it before any search.
+        """
+        lengths = np.diff(np.append(self.doc_offsets, len(self.tokens))) - 1
+        capacity = int(np.maximum(lengths - n + 1, 0).sum())
+        start = time.perf_counter()
+        self.prefilter = NgramBloom.for_capacity(n, capacity, fpr)
+        self.prefilter.add_stream(self.tokens)
+        stats = self.prefilter.stats()
+        logger.info(f"Built {n}-gram prefilter over {stats['items']} windows: {stats['bits']} bits, {stats['probes']} probes, "
+                    f"expected FPR {stats['expected_fpr']:.4g} (target {fpr}) in {time.perf_counter() - start:.2f}s.")
+        return stats
+
+    def window_prefilter(self, tokens: List[str], n: int) -> Optional[np.ndarray]:
+        """Per n-token window of tokens, whether it may occur (False is exact); None without an n-gram prefilter"""
+        if self.prefilter is None or self.prefilter.n != n:
+            return None
+        ids = np.fromiter((self.vocab.get(t, -1) for t in tokens), dtype=np.int64, count=len(tokens))
+        ids[ids >= len(self.token_starts) - 1] = -1  # interned after this index was built (shared vocabularies)
+        return self.prefilter.contains_windows(ids)
+
+    def build_lsh(self, window: int = 8, shingle: int = 1, bands: int = 10, rows: int = 3) -> Dict:
+        """
+        Build MinHash LSH tables over every window-token window of the corpus, for trace_similar().
+        The defaults put the candidate threshold (SpanLSH.threshold) at a Jaccard similarity of about
+        0.4, below trace_similar's default min_jaccard, at bands * 8 bytes per window.
+        """
+        start = time.perf_counter()
+        self.lsh = SpanLSH(window, shingle, bands, rows)
+        self.lsh.add_stream(self.tokens)
+        stats = self.lsh.stats()
+        logger.info(f"Built LSH tables over {stats['windows']} {window}-token windows: {bands}x{rows} bands, "
+                    f"threshold {stats['threshold']:.2f}, {stats['bytes'] / 2 ** 20:.1f} MiB in {time.perf_counter() - start:.2f}s.")
+        return stats
+
+    def build_doc_listing(self) -> Dict:
+        """
+        Build the document array and its range-minimum structure, so list_documents() reports the
+        distinct documents of an interval in time proportional to their number, not to the
+        occurrences. Costs 20 bytes per suffix.
+        """
+        start = time.perf_counter()
+        self.doc_listing = DocumentListing.from_suffix_array(np.asarray(self.suffix_array), np.asarray(self.doc_offsets))
+        logger.info(f"Built document listing over {len(self.suffix_array)} suffixes in {time.perf_counter() - start:.2f}s.")
+        return self.doc_listing.meta()
+
+    def list_documents(self, intervals: List[Tuple[int, int]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Per suffix array interval, (document indices, occurrence counts, first suffix ranks) of
+        every distinct document in it, most occurrences first (ties by first rank). Without
+        build_doc_listing() every occurrence is visited instead.
+        """
+        if self.doc_listing is not None:
+            listed = self.doc_listing.list_intervals(intervals)
+        else:
+            listed = scan_intervals(self.suffix_array, np.asarray(self.doc_offsets), intervals)
+        ranked = []
+        for docs, counts, ranks in listed:
+            order = rank_documents(docs, counts, ranks)
+            ranked.append((docs[order], counts[order], ranks[order]))
+        return ranked
+
+    def document_frequencies(self, span: List[str]) -> List[Dict]:
+        """Every document containing span with its number of occurrences there, most occurrences first"""
+        docs, counts, _ = self.list_documents([self.interval(span)])[0]
+        return [{"doc_id": self.doc_ids[d], "count": c} for d, c in zip(docs.tolist(), counts.tolist())]
+
+    def trace_documents_many(self, spans: List[List[str]], top_k: int = 5) -> List[List[Dict]]:
+        """
+        Per span, one match in each of up to top_k distinct documents, those with the most
+        occurrences first, located at the document's first occurrence in suffix order. Matches
+        also carry "count" (occurrences in that document) and "documents" (documents containing
+        the span). Used by TraceShield's attribution reports instead of trace_spans.
+        """
+        results = []
+        for span, (docs, counts, ranks) in zip(spans, self.list_documents(self.intervals(spans))):
+            top = docs[:top_k]
+            positions = np.asarray(self.suffix_array)[ranks[:top_k]] - np.asarray(self.doc_offsets)[top]
+            results.append([{"doc_id": self.doc_ids[d], "position": p, "span": list(span), "count": c, "documents": len(docs)}
+                            for d, p, c in zip(top.tolist(), positions.tolist(), counts[:top_k].tolist())])
+        return results
+
+    def trace_documents(self, span: List[str], top_k: int = 5) -> List[Dict]:
+        return self.trace_documents_many([span], top_k)[0]
+
+    def similarity_ids(self, tokens: List[str]) -> np.ndarray:
+        """Ids of tokens for similarity queries; each distinct unknown token gets its own id beyond the vocabulary"""
+        unknown: Dict[str, int] = {}
+        ids = [self.vocab.get(t) for t in tokens]
+        return np.array([tid if tid is not None else unknown.setdefault(t, len(self.id_to_token) + len(unknown))
+                         for t, tid in zip(tokens, ids)], dtype=np.int64)
+
+    def similarity_window(self) -> Optional[int]:
+        """Shortest window trace_similar_windows() accepts (the LSH window), or None without LSH tables"""
+        return self.lsh.window if self.lsh is not None else None
+
+    def trace_similar_windows(self, tokens: List[str], window_size: int, min_jaccard: float = 0.5, top_k: int = 5) -> Dict[int, List[Dict]]:
+        """
+        Corpus windows similar to each window_size window of tokens: {window start: matches}, for the
+        windows with at least one corpus window whose shingle-set Jaccard similarity is at least
+        min_jaccard. Candidates come from the LSH tables (window_size may exceed the LSH window; every
+        LSH window inside it proposes its alignment) and are verified exactly. Matches carry the
+        corpus tokens as "span" and their "jaccard", best first.
+        """
+        if self.lsh is None:
+            raise ValueError("This index has no LSH tables; build them with build_lsh()")
+        lsh = self.lsh
+        if window_size < lsh.window:
+            raise ValueError(f"Windows of {window_size} tokens are shorter than the {lsh.window}-token LSH window")
+        ids = self.similarity_ids(tokens)
+        owners, starts = lsh.candidates(ids)
+        shifts = np.arange(window_size - lsh.window + 1)
+        windows, starts = (owners[:, None] - shifts).ravel(), (starts[:, None] - shifts).ravel()
+        keep = (windows >= 0) & (windows <= len(ids) - window_size) & (starts >= 0) & (starts <= len(self.tokens) - window_size)
+        if not keep.any():
+            return {}
+        pairs = np.unique(windows[keep] * len(self.tokens) + starts[keep])
+        windows, starts = pairs // len(self.tokens), pairs % len(self.tokens)
+        offsets = np.arange(window_size)
+        segments = np.asarray(self.tokens)[starts[:, None] + offsets].astype(np.int64)
+        inside = (segments >= 0).all(axis=1)  # no document terminator
+        windows, starts, segments = windows[inside], starts[inside], segments[inside]
+        jaccard = shingle_jaccard(shingle_hashes(ids[windows[:, None] + offsets], lsh.shingle), shingle_hashes(segments, lsh.shingle))
+        similar = jaccard >= min_jaccard
+        windows, starts, segments, jaccard = windows[similar], starts[similar], segments[similar], jaccard[similar]
+        order = np.lexsort((starts, -jaccard, windows))
+        docs = np.searchsorted(self.doc_offsets, starts, side="right") - 1
+        positions = starts - np.asarray(self.doc_offsets)[docs]
+        results: Dict[int, List[Dict]] = {}
+        for j in order.tolist():
+            matches = results.setdefault(int(windows[j]), [])
+            if len(matches) < top_k:
+                matches.append({"doc_id": self.doc_ids[int(docs[j])], "position": int(positions[j]),
+                                "span": [self.id_to_token[t] for t in segments[j].tolist()], "jaccard": float(jaccard[j])})
+        return results
+
+    def trace_similar(self, span: List[str], min_jaccard: float = 0.5, top_k: int = 5) -> List[Dict]:
+        """Corpus windows of len(span) tokens whose shingle sets have Jaccard similarity >= min_jaccard with span's, best first"""
+        return self.trace_similar_windows(span, len(span), min_jaccard, top_k).get(0, [])
+
+    def merge(self, delta: "SuffixArrayIndex") -> "SuffixArrayIndex":
+        """
+        New index over this index's documents followed by delta's, without re-sorting this one.
+        Both must be built and share one id space (delta's vocabulary extends this one's).
+
+        Renumbering delta's terminators after ours keeps both suffix orders intact, so each delta
+        suffix only needs its rank among our suffixes: a binary search inside its first-token
+        bucket, run for all delta suffixes at once. LCP values are recomputed only next to the
+        inserted suffixes.
+        """
+        n_base, n_docs = len(self.tokens), len(self.doc_offsets)
+        delta_tokens = np.array(delta.tokens, dtype=np.int32)
+        terminators = delta_tokens < 0
+        delta_tokens[terminators] = TERMINATOR_BASE + n_docs + np.arange(int(terminators.sum()))
+        stream = np.concatenate([np.asarray(self.tokens, dtype=np.int32), delta_tokens])
+        base_sa = np.asarray(self.suffix_array, dtype=np.int64)
+        queries = np.asarray(delta.suffix_array, dtype=np.int64) + n_base
+
+        first = stream[queries].astype(np.int64)
+        in_vocab = first + 1 < len(self.token_starts)
+        lo = np.full(len(queries), len(base_sa), dtype=np.int64)
+        hi = lo.copy()
+        lo[in_vocab] = self.token_starts[first[in_vocab]]
+        hi[in_vocab] = self.token_starts[first[in_vocab] + 1]
+        active = np.flatnonzero(lo < hi)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            less = _suffix_less(stream, base_sa[mid], queries[active])
+            lo[active[less]] = mid[less] + 1
+            hi[active[~less]] = mid[~less]
+            active = active[lo[active] < hi[active]]
+
+        merged = SuffixArrayIndex()
+        merged.vocab, merged.id_to_token = delta.vocab, delta.id_to_token
+        merged.doc_ids = list(self.doc_ids) + list(delta.doc_ids)
+        merged.tokens = stream
+        merged.doc_offsets = np.concatenate([self.doc_offsets, np.asarray(delta.doc_offsets, dtype=np.int64) + n_base])
+        merged.suffix_array = np.insert(base_sa, lo, queries)
+        lcp = np.insert(np.asarray(self.lcp, dtype=np.int32), lo, 0)
+        placed = lo + np.arange(len(queries))
+        fix = np.unique(np.concatenate([placed, placed + 1]))
+        fix = fix[(fix > 0) & (fix < len(lcp))]
+        lcp[fix] = _common_prefix(stream, merged.suffix_array[fix - 1], merged.suffix_array[fix])
+        merged.lcp = lcp
+        counts = np.bincount(stream[stream >= 0], minlength=len(merged.id_to_token))
+        merged.token_starts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=merged.token_starts[1:])
+        if self.prefilter is not None:
+            # the filter keeps its size, so its false-positive rate rises as merged documents fill it
+            merged.prefilter = self.prefilter.copy()
+            merged.prefilter.add_stream(delta_tokens)
+        if self.lsh is not None:
+            merged.lsh = self.lsh.copy()
+            merged.lsh.add_stream(delta_tokens, offset=n_base)
+        if self.doc_listing is not None:
+            # every suffix rank shifts, so the document array is rebuilt rather than patched
+            merged.build_doc_listing()
+        logger.info(f"Merged {len(queries)} delta suffixes into {len(base_sa)} indexed suffixes.")
+        return merged
+
+    @staticmethod
+    def _log_progress(h: int, resolved: int, total: int, elapsed: float):
+        logger.info(f"Prefix doubling h={h}: {resolved}/{total} suffixes ranked ({elapsed:.2f}s)")
+
+    def token_bounds(self, token_id: int) -> Tuple[int, int]:
+        """Suffix array interval of suffixes starting with token_id, in O(1)"""
+        if token_id + 1 >= len(self.token_starts):
+            return 0, 0
+        return int(self.token_starts[token_id]), int(self.token_starts[token_id + 1])
+
+    def _bounds(self, query: List[int]) -> Tuple[int, int]:
+        """Suffix array interval [lo, hi) of suffixes starting with the encoded query"""
+        if not query:
+            return 0, len(self.suffix_array)
+        low, high = self.token_bounds(query[0])
+        if len(query) == 1:
+            return low, high
+        rest = query[1:]
+        m = len(query)
+        sa, tokens = self.suffix_array, self.tokens
+        upper = high  # tightest probe seen whose remaining prefix is greater than the query's
+        while low < high:
+            mid = (low + high) // 2
+            p = int(sa[mid])
+            prefix = tokens[p + 1:p + m].tolist()
+            if prefix < rest:
+                low = mid + 1
+            else:
+                high = mid
+                if prefix != rest:
+                    upper = mid
+        first, high = low, upper
+        while low < high:
+            mid = (low + high) // 2
+            p = int(sa[mid])
+            if tokens[p + 1:p + m].tolist() == rest:
+                low = mid + 1
+            else:
+                high = mid
+        return first, low
+
+    def extend(self, lo: int, hi: int, depth: int, token_id: int) -> Tuple[int, int]:
+        """
+        Narrow [lo, hi), whose suffixes share their first `depth` tokens, to those followed by token_id.
+        Costs O(log(hi - lo)) single-token probes.
+        """
+        if depth == 0:
+            return self.token_bounds(token_id)
+        sa, tokens = np.asarray(self.suffix_array), np.asarray(self.tokens)  # plain views: memmap scalar reads are slow
+        low, high = lo, hi
+        while low < high:
+            mid = (low + high) // 2
+            if tokens[sa[mid] + depth] < token_id:
+                low = mid + 1
+            else:
+                high = mid
+        first, high = low, hi
+        while low < high:
+            mid = (low + high) // 2
+            if tokens[sa[mid] + depth] == token_id:
+                low = mid + 1
+            else:
+                high = mid
+        return first, low
+
+    def extend_interval(self, interval: Tuple[int, int], depth: int, token_id: int) -> Tuple[int, int]:
+        """extend() on an interval as returned by interval(); empty intervals stay empty"""
+        lo, hi = interval
+        return self.extend(lo, hi, depth, token_id) if lo < hi else (lo, lo)
+
+    def interval_successors(self, interval: Tuple[int, int], depth: int) -> np.ndarray:
+        """successors_in() on an interval as returned by interval()"""
+        return self.successors_in(interval[0], interval[1], depth)
+
+    def intervals(self, spans: List[List[str]], prefiltered: bool = False) -> List[Tuple[int, int]]:
+        """
+        interval() of many spans, aligned with the input (empty intervals are (0, 0)); prefiltered
+        skips the prefilter, for spans already checked against it. Duplicate
+        queries are searched once, and all distinct queries binary search in lockstep inside
+        their first-token bucket, comparing whole spans per vectorized step. Queries are sorted,
+        so unless a query is a prefix of the next, its occurrences end before the next query's
+        first occurrence: that bound caps each upper-bound search at its neighbour's lower bound.
+        """
+        padded, lengths = pad_queries(self.vocab, spans)
+        keep = np.flatnonzero((lengths > 0) & ~has_unknown(padded, lengths))
+        results = np.zeros((len(spans), 2), dtype=np.int64)
+        results[lengths == 0, 1] = len(self.suffix_array)
+        if not len(keep):
+            return list(map(tuple, results.tolist()))
+        padded, lengths = padded[keep], lengths[keep]
+        queries, first, inverse = np.unique(padded, axis=0, return_index=True, return_inverse=True)
+        lengths = lengths[first]
+        bucket = np.minimum(queries[:, 0], len(self.token_starts) - 2)
+        lo = np.where(queries[:, 0] < len(self.token_starts) - 1, self.token_starts[bucket], 0)
+        hi = np.where(queries[:, 0] < len(self.token_starts) - 1, self.token_starts[bucket + 1], 0)
+        if self.prefilter is not None and not prefiltered:
+            hi = np.where(prefilter_spans(self.prefilter, queries, lengths), hi, lo)
+        searched = lo < hi
+        lower = self._search_many(queries, lengths, lo.copy(), hi.copy(), upper=False)
+        # first occurrence of the nearest later searched query, which bounds this query's occurrences
+        bound = np.where(searched, lower, len(self.suffix_array))
+        bound = np.append(np.minimum.accumulate(bound[::-1])[::-1][1:], len(self.suffix_array))
+        prefix_of_next = np.zeros(len(queries), dtype=bool)
+        if len(queries) > 1:
+            same = (queries[:-1] == queries[1:]) | (np.arange(queries.shape[1]) >= lengths[:-1, None])
+            prefix_of_next[:-1] = same.all(axis=1)
+        hi = np.where(prefix_of_next, hi, np.minimum(hi, np.maximum(bound, lower)))
+        # most spans occur rarely: the LCP with the next suffix settles the upper bound of a single
+        # occurrence, and a query absent at its lower bound needs no upper-bound search at all
+        matched = lower < hi
+        matched[matched] = self._prefix_matches(queries[matched], lengths[matched], lower[matched])
+        lcp_next = np.asarray(self.lcp)[np.minimum(lower + 1, len(self.lcp) - 1)] if len(self.lcp) else lengths
+        single = matched & ((lower + 1 == hi) | (lcp_next < lengths))
+        upper = np.where(single, lower + 1, lower)
+        wide = np.flatnonzero(matched & ~single)
+        upper[wide] = self._search_many(queries[wide], lengths[wide], lower[wide] + 1, hi[wide], upper=True)
+        found = lower < upper
+        results[keep, 0] = np.where(found, lower, 0)[inverse]
+        results[keep, 1] = np.where(found, upper, 0)[inverse]
+        return list(map(tuple, results.tolist()))
+
+    def _search_many(self, queries: np.ndarray, lengths: np.ndarray, lo: np.ndarray, hi: np.ndarray, upper: bool) -> np.ndarray:
+        """
+        Lockstep binary search of padded queries within [lo, hi), whose suffixes all start with the
+        query's first token: the first suffix not below the query, or with upper, above it.
+        """
+        if queries.shape[1] == 1:
+            return hi if upper else lo  # the first-token bucket is the whole answer
+        columns = np.arange(1, queries.shape[1])
+        last = len(self.tokens) - 1
+        todo = np.flatnonzero(lo < hi)
+        while len(todo):
+            mid = (lo[todo] + hi[todo]) // 2
+            following = self.tokens[np.minimum(self.suffix_array[mid][:, None] + columns, last)]
+            expected = queries[todo, 1:]
+            differs = (following != expected) & (columns < lengths[todo, None])
+            at = differs.argmax(axis=1)
+            rows = np.arange(len(todo))
+            below = following[rows, at] < expected[rows, at]
+            right = (below | ~differs[rows, at]) if upper else (below & differs[rows, at])
+            lo[todo] = np.where(right, mid + 1, lo[todo])
+            hi[todo] = np.where(right, hi[todo], mid)
+            todo = todo[lo[todo] < hi[todo]]
+        return lo
+
+    def _prefix_matches(self, queries: np.ndarray, lengths: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Whether the suffix at each row starts with its padded query"""
+        columns = np.arange(queries.shape[1])
+        following = self.tokens[np.minimum(self.suffix_array[rows][:, None] + columns, len(self.tokens) - 1)]
+        return ((following == queries) | (columns >= lengths[:, None])).all(axis=1)
+
+    def positions(self, rows: np.ndarray) -> np.ndarray:
+        """Stream position of each suffix array row"""
+        return np.asarray(self.suffix_array)[np.asarray(rows, dtype=np.int64)].astype(np.int64)
+
+    def longest_match(self, tokens: List[str], start: int = 0) -> Tuple[int, Tuple[int, int]]:
+        """Length of the longest corpus-attested prefix of tokens[start:] and its suffix array interval"""
+        lo, hi = 0, len(self.suffix_array)
+        length = 0
+        for i in range(start, len(tokens)):
+            tid = self.vocab.get(tokens[i])
+            if tid is None:
+                break
+            next_lo, next_hi = self.extend(lo, hi, length, tid)
+            if next_lo == next_hi:
+                break
+            lo, hi = next_lo, next_hi
+            length += 1
+        return length, (lo, hi)
+
+    def iter_matching_statistics(self, tokens: List[str], cap: Optional[int] = None) -> Iterator[int]:
+        """
+        Yield, for every start i, the length of the longest prefix of tokens[i:] that occurs in the
+        corpus (at most cap), in one left-to-right pass.
+
+        Dropping the first token of a match keeps it a match, so each step resumes from the previous
+        length with the previous occurrence shifted by one. Extensions that continue that occurrence
+        cost one stream probe; only a mismatch searches for the extended span, and no position
+        restarts from an empty match.
+        """
+        return self._iter_matching_statistics([self.vocab.get(t) for t in tokens], cap)
+
+    def matching_statistics_ids(self, ids, cap: Optional[int] = None) -> np.ndarray:
+        """iter_matching_statistics over interned ids (an int array or list); negative or unknown ids never match"""
+        size = len(self.id_to_token)
+        ids = [i if 0 <= i < size else None for i in np.asarray(ids, dtype=np.int64).tolist()]
+        return np.fromiter(self._iter_matching_statistics(ids, cap), dtype=np.int64, count=len(ids))
+
+    def _iter_matching_statistics(self, ids: List[Optional[int]], cap: Optional[int]) -> Iterator[int]:
+        n = len(ids)
+        cap = n if cap is None else cap
+        full = (0, len(self.suffix_array))
+        length, occ, bounds = 0, -1, full  # ids[i:i + length] occurs at stream position occ
+        for i in range(n):
+            while length < cap and i + length < n:
+                tid = ids[i + length]
+                if tid is None:
+                    break
+                if bounds is None:
+                    if self.tokens[occ + length] == tid:
+                        length += 1
+                        continue
+                    lo, hi = self._bounds(ids[i:i + length + 1])
+                else:
+                    lo, hi = self.extend(bounds[0], bounds[1], length, tid)
+                if lo == hi:
+                    break
+                bounds, occ = (lo, hi), int(self.suffix_array[lo])
+                length += 1
+            yield length
+            if length > 1:
+                length, occ, bounds = length - 1, occ + 1, None
+            else:
+                length, bounds = 0, full
+
+    def successors(self, context: List[str]) -> np.ndarray:
+        """Distinct token ids that follow context somewhere in the corpus"""
+        lo, hi = self.interval(context)
+        return self.successors_in(lo, hi, len(context))
+
+    def successors_in(self, lo: int, hi: int, depth: int) -> np.ndarray:
+        """
+        Distinct token ids at offset depth of the suffixes in [lo, hi), which share their first
+        depth tokens. The next token changes exactly where the LCP drops to depth, so one
+        vectorized pass over that LCP slice replaces a lookup per candidate token.
+        """
+        if depth == 0:
+            return np.flatnonzero(np.diff(self.token_starts))
+        if lo == hi:
+            return np.empty(0, dtype=np.int64)
+        starts = np.concatenate([[lo], lo + 1 + np.flatnonzero(np.asarray(self.lcp[lo + 1:hi]) == depth)])
+        following = self.tokens[self.suffix_array[starts] + depth].astype(np.int64)
+        return following[following >= 0]
+
+    def suffix_matcher(self, cap: int) -> "SuffixMatcher":
+        return SuffixMatcher(self, cap)
+
+    def save(self, path: str):
+        """Write the index as a directory of raw little-endian arrays plus a JSON header"""
+        logger.info(f"Saving suffix array index to {path}")
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            "tokens": write_array(path, "tokens", self.tokens, "<i4"),
+            "suffix_array": write_array(path, "suffix_array", self.suffix_array, "<i8"),
+            "lcp": write_array(path, "lcp", self.lcp, "<i4"),
+            "token_starts": write_array(path, "token_starts", self.token_starts, "<i8"),
+            "doc_offsets": write_array(path, "doc_offsets", self.doc_offsets, "<i8")
+        }
+        sections = {}
+        if self.lsh is not None:
+            arrays["lsh_keys"] = write_array(path, "lsh_keys", self.lsh.keys.ravel(), "<u4")
+            arrays["lsh_positions"] = write_array(path, "lsh_positions", self.lsh.positions.ravel(), self.lsh.positions.dtype.newbyteorder("<").str)
+            sections["lsh"] = self.lsh.meta()
+        if self.doc_listing is not None:
+            arrays["doc_array"] = write_array(path, "doc_array", self.doc_listing.docs, "<i4")
+            arrays["doc_prev"] = write_array(path, "doc_prev", self.doc_listing.prev, "<i8")
+            arrays["doc_keys"] = write_array(path, "doc_keys", self.doc_listing.doc_keys, "<i8")
+            arrays["doc_sparse"] = write_array(path, "doc_sparse", self.doc_listing.sparse.ravel(), "<i8")
+            sections["doc_listing"] = self.doc_listing.meta()
+        write_index(path, INDEX_FORMAT, len(self.suffix_array), self.id_to_token, self.doc_ids, arrays, self.prefilter, **sections)
+        logger.info("Suffix array saved.")
+
+    def load(self, path: str):
+        """Memory-map an index directory written by save(); arrays stay in the shared page cache"""
+        logger.info(f"Loading suffix array index from {path}")
+        if not os.path.isdir(path):
+            raise ValueError(f"{path} is not an index directory; convert pickled indexes once with convert_pickle_index()")
+        header, self.id_to_token, self.doc_ids, self.prefilter = read_index(path, INDEX_FORMAT)
+        arrays = header["arrays"]
+        self.vocab = {t: i for i, t in enumerate(self.id_to_token)}
+        self.tokens = open_array(path, arrays["tokens"])
+        self.suffix_array = open_array(path, arrays["suffix_array"])
+        self.lcp = open_array(path, arrays["lcp"])
+        self.token_starts = open_array(path, arrays["token_starts"])
+        self.doc_offsets = open_array(path, arrays["doc_offsets"])
+        self._pending = array("i")
+        self._pending_offsets = []
+        self.lsh = SpanLSH.from_meta(header["lsh"], open_array(path, arrays["lsh_keys"]),
+                                     open_array(path, arrays["lsh_positions"])) if "lsh" in header else None
+        self.doc_listing = DocumentListing.from_meta(
+            header["doc_listing"], *(open_array(path, arrays[name]) for name in ("doc_array", "doc_prev", "doc_keys", "doc_sparse"))
+        ) if "doc_listing" in header else None
+        self.path = path
+        logger.info("Suffix array loaded successfully.")
+
+    @classmethod
+    def from_token_stream(cls, path: str, method: str = "doubling", verify: bool = False,
+                          docs: Optional[Tuple[int, int]] = None) -> "SuffixArrayIndex":
+        """
+        Build an index over a token stream directory written by TokenStreamWriter; the stream stays
+        memory-mapped. docs=(first, last) indexes only that document range (a shard), copied out
+        of the stream with its terminators renumbered from 0; the vocabulary is always the full one.
+        """
+        arrays = read_header(path, STREAM_FORMAT)["arrays"]
+        index = cls()
+        index.id_to_token = list(StringTable(path, arrays["vocab"], arrays["vocab_offsets"]))
+        index.vocab = {t: i for i, t in enumerate(index.id_to_token)}
+        index.doc_ids = StringTable(path, arrays["doc_ids"], arrays["doc_ids_offsets"])
+        index.tokens = open_array(path, arrays["tokens"])
+        index.doc_offsets = open_array(path, arrays["doc_offsets"])
+        if docs is not None:
+            first, last = docs
+            start = int(index.doc_offsets[first]) if first < len(index.doc_offsets) else len(index.tokens)
+            end = int(index.doc_offsets[last]) if last < len(index.doc_offsets) else len(index.tokens)
+            tokens = np.array(index.tokens[start:end], dtype=np.int32)
+            tokens[tokens < 0] = TERMINATOR_BASE + np.arange(last - first)
+            index.tokens = tokens
+            index.doc_offsets = np.array(index.doc_offsets[first:last], dtype=np.int64) - start
+            index.doc_ids = [index.doc_ids[i] for i in range(first, last)]
+        index.build(method=method, verify=verify)
+        return index
+
+    @classmethod
+    def from_pickle(cls, path: str) -> "SuffixArrayIndex":
+        """Read a pickled index, either the original list-of-suffixes layout or the interned-array one"""
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        index = cls()
+        if isinstance(data["suffix_array"], list):
+            # each document survives as its suffix at offset 0, and doc_lengths keeps insertion order
+            logger.info("Legacy suffix list detected, re-indexing documents...")
+            full_docs: Dict[str, List[List[str]]] = {}
+            for suffix, doc_id, start in data["suffix_array"]:
+                if start == 0:
+                    full_docs.setdefault(doc_id, []).append(suffix)
+            for doc_id in data["doc_lengths"]:
+                for tokens in full_docs.get(doc_id) or [[]]:
+                    index.add_document(doc_id, tokens)
+            index.build()
+        else:
+            index.id_to_token = data["id_to_token"]
+            index.vocab = {t: i for i, t in enumerate(index.id_to_token)}
+            index.doc_ids = data["doc_ids"]
+            index.tokens = data["tokens"]
+            index.doc_offsets = data["doc_offsets"]
+            # re-sort rather than trust the pickled suffix array, which predates the LCP array
+            index.build()
+        return index
+
+
+
+class SuffixMatcher:
+    """
+    Online longest corpus-attested suffix (at most cap tokens) of a growing token stream.
+
+    Mirrors iter_matching_statistics from the right: a push first tries to continue the current
+    occurrence with one stream probe, and only on a mismatch searches for the extended match,
+    dropping tokens from the left until it occurs. Every token is dropped at most once.
+    """
+
+    def __init__(self, index: SuffixArrayIndex, cap: int):
+        self.index = index
+        self.cap = cap
+        self.recent: Tuple[int, ...] = ()  # ids of the last cap pushed tokens
+        self.length = 0
+        self.occ = -1  # stream position of one occurrence of the current match
+        self.bounds: Optional[Tuple[int, int]] = None  # its suffix array interval, when known
+
+    def push(self, token: str) -> int:
+        """Append a token and return the length of the new longest matching suffix"""
+        index = self.index
+        tid = index.vocab.get(token)
+        if tid is None:
+            self.recent, self.length, self.bounds = (), 0, None
+            return 0
+        match = list(self.recent[len(self.recent) - self.length:])
+        length, occ, bounds = self.length, self.occ, self.bounds
+        if length == self.cap:
+            match, length, occ, bounds = match[1:], length - 1, occ + 1, None
+        while length > 0:
+            if bounds is None and index.tokens[occ + length] == tid:
+                length += 1
+                break
+            lo, hi = index._bounds(match + [tid]) if bounds is None else index.extend(bounds[0], bounds[1], length, tid)
+            if lo < hi:
+                length, occ, bounds = length + 1, int(index.suffix_array[lo]), (lo, hi)
+                break
+            match, length, occ, bounds = match[1:], length - 1, occ + 1, None
+        if length == 0:
+            lo, hi = index.token_bounds(tid)
+            length, bounds = (1, (lo, hi)) if lo < hi else (0, None)
+            occ = int(index.suffix_array[lo]) if lo < hi else -1
+        self.recent = (self.recent + (tid,))[-self.cap:]
+        self.length, self.occ, self.bounds = length, occ, bounds
+        return length
+
+    def state(self) -> Tuple:
+        return self.recent, self.length, self.occ, self.bounds
+
+    def restore(self, state: Tuple):
+        self.recent, self.length, self.occ, self.bounds = state
+
+
+class TokenStreamWriter:
+    """
+    Append-only writer of an unsorted token stream in the index layout (terminated documents,
+    doc offsets, vocab, doc ids) plus per-token occurrence counts, so ingestion can stream
+    documents to disk in one pass and SuffixArrayIndex.from_token_stream can sort it later.
+    Chunks arrive with chunk-local token ids; only each chunk's distinct tokens are interned.
+    """
+
+    def __init__(self, path: str, vocab: Optional[List[str]] = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.vocab: Dict[str, int] = {}
+        self.id_to_token: List[str] = []
+        for token in vocab or ():
+            self.intern(token)
+        self.counts = np.zeros(len(self.id_to_token), dtype=np.int64)
+        self.doc_ids: List[str] = []
+        self.doc_offsets = array("q")
+        self.n_tokens = 0  # stream length, terminators included
+        self._stream = open(os.path.join(path, "tokens.bin"), "wb")
+
+    def intern(self, token: str) -> int:
+        tid = self.vocab.get(token)
+        if tid is None:
+            tid = self.vocab[token] = len(self.id_to_token)
+            self.id_to_token.append(token)
+        return tid
+
+    def write_chunk(self, doc_ids: List[str], chunk_vocab: List[str], chunk_ids: np.ndarray, lengths: List[int]):
+        """Append documents whose tokens are chunk_vocab[chunk_ids], split by lengths"""
+        mapping = np.fromiter((self.intern(t) for t in chunk_vocab), dtype=np.int64, count=len(chunk_vocab))
+        ids = mapping[np.asarray(chunk_ids, dtype=np.int64)] if len(chunk_ids) else np.empty(0, dtype=np.int64)
+        if len(self.counts) < len(self.id_to_token):
+            self.counts = np.concatenate([self.counts, np.zeros(len(self.id_to_token) - len(self.counts), dtype=np.int64)])
+        self.counts += np.bincount(ids, minlength=len(self.counts))
+        lengths = np.asarray(lengths, dtype=np.int64)
+        ends = np.cumsum(lengths)
+        terminators = TERMINATOR_BASE + len(self.doc_ids) + np.arange(len(lengths))
+        self.doc_offsets.extend((self.n_tokens + ends - lengths + np.arange(len(lengths))).tolist())
+        stream = np.insert(ids, ends, terminators).astype("<i4")
+        self._stream.write(stream.tobytes())
+        self.n_tokens += len(stream)
+        self.doc_ids.extend(doc_ids)
+
+    def close(self) -> Dict:
+        self._stream.close()
+        arrays = {
+            "tokens": {"file": "tokens.bin", "dtype": "<i4", "length": self.n_tokens},
+            "doc_offsets": write_array(self.path, "doc_offsets", self.doc_offsets, "<i8"),
+            "counts": write_array(self.path, "counts", self.counts, "<i8")
+        }
+        arrays.update(write_strings(self.path, "vocab", self.id_to_token))
+        arrays.update(write_strings(self.path, "doc_ids", self.doc_ids))
+        header = {
+            "format": STREAM_FORMAT,
+            "version": INDEX_VERSION,
+            "n_tokens": int(self.counts.sum()),
+            "n_docs": len(self.doc_ids),
+            "vocab_size": len(self.id_to_token),
+            "arrays": arrays
+        }
+        write_header(self.path, header)
+        return header
+
+
+def read_stream_counts(path: str) -> Dict[str, int]:
+    """Token occurrence counts recorded by TokenStreamWriter"""
+    arrays = read_header(path, STREAM_FORMAT)["arrays"]
+    return dict(zip(StringTable(path, arrays["vocab"], arrays["vocab_offsets"]), open_array(path, arrays["counts"]).tolist()))
+
+
+def _common_prefix(stream: np.ndarray, a: np.ndarray, b: np.ndarray, width: int = 16) -> np.ndarray:
+    """
+    Common prefix length of the suffixes at positions a[i] and b[i] (distinct), compared
+    width tokens at a time for all pairs at once. Every suffix runs into its own unique
+    terminator, so each pair differs before the end of the stream.
+    """
+    lengths = np.zeros(len(a), dtype=np.int64)
+    todo = np.arange(len(a))
+    offsets = np.arange(width)
+    last = len(stream) - 1
+    while len(todo):
+        va = stream[np.minimum(a[todo, None] + lengths[todo, None] + offsets, last)]
+        vb = stream[np.minimum(b[todo, None] + lengths[todo, None] + offsets, last)]
+        differs = va != vb
+        found = differs.any(axis=1)
+        lengths[todo] += np.where(found, differs.argmax(axis=1), width)
+        todo = todo[~found]
+    return lengths
+
+
+def _suffix_less(stream: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Whether the suffix at a[i] sorts before the suffix at b[i]"""
+    lengths = _common_prefix(stream, a, b)
+    return stream[a + lengths] < stream[b + lengths]
+
+
+def read_stream_offsets(path: str) -> np.ndarray:
+    """Start offset of every document of a token stream, followed by the stream length"""
+    arrays = read_header(path, STREAM_FORMAT)["arrays"]
+    return np.append(open_array(path, arrays["doc_offsets"]), arrays["tokens"]["length"])
+
+
+def convert_pickle_index(pickle_path: str, output_dir: str):
+    """One-time conversion of a pickled index into the memory-mapped directory format"""
+    logger.info(f"Converting pickled index {pickle_path} -> {output_dir}")
+    SuffixArrayIndex.from_pickle(pickle_path).save(output_dir)
@@ -1,65 +1,365 @@
 # tracealign/traceshield.py — Inference-Time Refusal Filter with Span Tracing, Risk Reporting, and Attribution Logging
- 
+
+import time
 import logging
-from typing import List, Dict
- 
+from typing import Iterator, List, Dict, NamedTuple, Optional
+
+import numpy as np
+
+from tracealign import metrics
+
 logger = logging.getLogger("tracealign.traceshield")
-logger.setLevel(logging.DEBUG)
- 
+
+# the streaming session keeps its window BCI as a running sum, so it only skips the exact
+# compute_bci check when the running sum is below the threshold by more than this margin
+ROLLING_BCI_SLACK = 1e-6
+
+# with a prefilter, windows that pass it are looked up one by one unless more than 1 in this many
+# pass, in which case the single matching-statistics scan over the completion is cheaper
+PREFILTER_SCAN_RATIO = 4
+
+
+class Verdict(NamedTuple):
+    refuse: bool  # True once any window of the stream so far is a traced high-BCI span
+    span: Optional[List[str]] = None  # risky window completed by the latest token, if any
+    match: Optional[Dict] = None  # first traced match of that window
+
+
 class TraceShield:
-	def __init__(self, tracer, bci_model, threshold: float, window_size: int = 8, max_matches: int = 5):
-    	self.tracer = tracer
-    	self.bci = bci_model
+    def __init__(self, tracer, bci_model, threshold: float, window_size: int = 8, max_matches: int = 5,
+                 fuzzy_jaccard: Optional[float] = None):
+        self.tracer = tracer
+        self.bci = bci_model
         self.threshold = threshold
-    	self.window_size = window_size
-    	self.max_matches = max_matches
- 
-	def _window_spans(self, tokens: List[str]) -> List[List[str]]:
-    	return [tokens[i:i + self.window_size] for i in range(len(tokens) - self.window_size + 1)]
- 
-	def detect_risky_spans(self, tokens: List[str]) -> List[Dict]:
-    	risky = []
-    	for span in self._window_spans(tokens):
-        	matches = self.tracer.trace_span(span)
-        	for match in matches[:self.max_matches]:
-            	if self.bci.high_risk(match['span'], self.threshold):
-                	report = self.bci.explain_span(match['span'])
-                	report.update({
-                    	"match_doc": match.get("doc_id", "?"),
-      	              "match_offset": match.get("position", -1)
-                	})
-                	risky.append(report)
-    	return risky
- 
-	def refuse(self, tokens: List[str]) -> bool:
-    	for span in self._window_spans(tokens):
-        	matches = self.tracer.trace_span(span)
-        	for match in matches[:self.max_matches]:
-            	if self.bci.high_risk(match['span'], self.threshold):
-                	logger.warning(f"TRACESHIELD: Refusing output due to high-BCI span: {match['span']}")
-                	return True
-    	return False
- 
-	def explain(self, tokens: List[str]) -> Dict:
-    	risky = self.detect_risky_spans(tokens)
-    	return {
-        	"refused": len(risky) > 0,
-        	"span_count": len(tokens) - self.window_size + 1,
-        	"risky_count": len(risky),
-        	"risky_spans": risky[:5]  # only top few for verbosity
-    	}
- 
-	def detailed_log(self, tokens: List[str]):
-    	logger.info("Running TRACESHIELD diagnostic log...")
-    	risky = self.detect_risky_spans(tokens)
-    	for r in risky:
-        	logger.info(f"BCI {r['total_bci']} | Span: {' '.join(r['span'])} | KL: {r['kl_divergence']} | Max Token Risk: {r['max_token_risk']} | Matched in: {r['match_doc']} @ {r['match_offset']}")
- 
-	def refusal_report(self, tokens: List[str]) -> str:
-    	risky = self.detect_risky_spans(tokens)
-    	if not risky:
-        	return "✅ Output passed TRACESHIELD. No high-BCI spans detected."
-    	report = ["⛔ REFUSAL TRIGGERED BY TRACESHIELD"]
-    	for r in risky:
-        	report.append(f"- Span: {' '.join(r['span'])} | BCI: {r['total_bci']} | Source: {r['match_doc']} @ {r['match_offset']}")
-    	return "\n".join(report)
+        self.window_size = window_size
+        self.max_matches = max_matches
+        # also refuse windows this similar to a high-BCI corpus window (needs an index with LSH tables)
+        self.fuzzy_jaccard = fuzzy_jaccard
+        if fuzzy_jaccard is not None:
+            # fail here rather than on every refuse/explain call
+            lsh_window = tracer.similarity_window() if hasattr(tracer, "similarity_window") else None
+            if lsh_window is None:
+                raise ValueError("fuzzy_jaccard needs an index with LSH tables (in every shard), see build_lsh()")
+            if lsh_window > window_size:
+                raise ValueError(f"fuzzy_jaccard needs an LSH window of at most window_size={window_size} tokens, the index has {lsh_window}")
+
+    def _window_spans(self, tokens: List[str]) -> List[List[str]]:
+        return [tokens[i:i + self.window_size] for i in range(len(tokens) - self.window_size + 1)]
+
+    def _occurring_windows(self, tokens: List[str]) -> Iterator[List[str]]:
+        """
+        Lazily yield the windows that occur in the corpus, from one matching-statistics pass. With
+        an n-gram prefilter at the window size, windows it rules out are never searched, and when
+        few windows pass, they are counted in one batch that does not probe the filter again.
+        """
+        candidates = self.tracer.window_prefilter(tokens, self.window_size) if hasattr(self.tracer, "window_prefilter") else None
+        if candidates is not None:
+            passed = np.flatnonzero(candidates)
+            if len(passed) * PREFILTER_SCAN_RATIO <= len(candidates):
+                spans = [tokens[i:i + self.window_size] for i in passed.tolist()]
+                for span, count in zip(spans, self.tracer.count_spans(spans, prefiltered=True)):
+                    if count:
+                        yield span
+                return
+        last = len(tokens) - self.window_size
+        for i, length in enumerate(self.tracer.iter_matching_statistics(tokens, cap=self.window_size)):
+            if i > last:
+                break
+            if length == self.window_size:
+                yield tokens[i:i + self.window_size]
+
+    def _risky_matches(self, tokens: List[str]) -> Iterator[Dict]:
+        """Yield traced matches with a high-BCI span, in window order"""
+        if hasattr(self.tracer, "iter_matching_statistics"):
+            # index matches are exact, so match['span'] is the window itself and can be scored before tracing
+            for span in self._occurring_windows(tokens):
+                if self.bci.high_risk(span, self.threshold):
+                    yield from self.tracer.trace_span(span)[:self.max_matches]
+            return
+        for span in self._window_spans(tokens):
+            matches = self.tracer.trace_span(span)
+            for match in matches[:self.max_matches]:
+                if self.bci.high_risk(match['span'], self.threshold):
+                    yield match
+
+    def _all_risky_matches(self, tokens: List[str], by_document: bool = False) -> List[Dict]:
+        """
+        Every match _risky_matches yields, tracing all spans in one batch when the tracer supports
+        it. by_document reports index windows by distinct source document (see _trace_sources).
+        """
+        if not hasattr(self.tracer, "trace_spans"):
+            matches = list(self._risky_matches(tokens))
+        elif hasattr(self.tracer, "iter_matching_statistics"):
+            spans = [span for span in self._occurring_windows(tokens) if self.bci.high_risk(span, self.threshold)]
+            traced = self._trace_sources(spans) if by_document else self.tracer.trace_spans(spans)
+            matches = [m for found in traced for m in found[:self.max_matches]]
+        else:
+            traced = self.tracer.trace_spans(self._window_spans(tokens))
+            matches = [m for found in traced for m in found[:self.max_matches] if self.bci.high_risk(m['span'], self.threshold)]
+        return matches + self._fuzzy_matches(tokens, {tuple(m['span']) for m in matches})
+
+    def _trace_sources(self, spans: List[List[str]]) -> List[List[Dict]]:
+        """
+        One match per distinct source document, most occurrences first, when the tracer lists
+        documents; otherwise its first suffixes, which for a span repeated within one document
+        may all come from that document.
+        """
+        if hasattr(self.tracer, "trace_documents_many"):
+            return self.tracer.trace_documents_many(spans, self.max_matches)
+        return self.tracer.trace_spans(spans)
+
+    def _fuzzy_matches(self, tokens: List[str], flagged=frozenset()) -> List[Dict]:
+        """
+        With fuzzy_jaccard set, matches of the windows not in flagged (tuples of exactly matched
+        risky windows) whose corpus window is at least that similar and high-BCI. The corpus
+        window is scored, not the completion's, since an inserted or swapped token can lower the
+        latter's BCI without making the copied content any safer.
+        """
+        if self.fuzzy_jaccard is None or len(tokens) < self.window_size:
+            return []
+        width = self.window_size
+        similar = self.tracer.trace_similar_windows(tokens, width, self.fuzzy_jaccard, self.max_matches)
+        risky = [m for i, matches in similar.items() if tuple(tokens[i:i + width]) not in flagged
+                 for m in matches if self.bci.high_risk(m['span'], self.threshold)]
+        if metrics.registry.enabled:
+            metrics.registry.inc("traceshield_fuzzy_matches_total", len(risky))
+        return risky
+
+    def _batchable(self) -> bool:
+        return all(hasattr(self.tracer, name) for name in ("iter_matching_statistics", "count_spans", "trace_spans")) \
+            and hasattr(self.bci, "window_scores")
+
+    def _risky_windows_many(self, completions: List[List[str]]) -> List[List[List[str]]]:
+        """
+        High-BCI windows that occur in the corpus, per completion in window order. Windows are
+        scored by a vectorized prefix sum (confirmed exactly by high_risk near the threshold), and
+        the survivors of every completion are counted in a single count_spans batch.
+        """
+        width = self.window_size
+        slack = ROLLING_BCI_SLACK * max(1.0, abs(self.threshold))
+        candidates, owners = [], []
+        for c, tokens in enumerate(completions):
+            scores = self.bci.window_scores(self.bci.encode(tokens), width)
+            for i in np.flatnonzero(scores > self.threshold - slack).tolist():
+                span = tokens[i:i + width]
+                if self.bci.high_risk(span, self.threshold):
+                    candidates.append(span)
+                    owners.append(c)
+        if metrics.registry.enabled:
+            metrics.registry.inc("traceshield_candidate_windows_total", len(candidates))
+        risky = [[] for _ in completions]
+        for span, owner, count in zip(candidates, owners, self.tracer.count_spans(candidates)):
+            if count:
+                risky[owner].append(span)
+        return risky
+
+    def refuse_many(self, completions: List[List[str]]) -> List[bool]:
+        """refuse for each completion, with one batched index lookup when the tracer supports it"""
+        if not self._batchable():
+            return [self.refuse(tokens) for tokens in completions]
+        start = time.perf_counter() if metrics.registry.enabled else None
+        verdicts = []
+        for tokens, spans in zip(completions, self._risky_windows_many(completions)):
+            if spans:
+                logger.warning("TRACESHIELD: Refusing output due to high-BCI span: %s", spans[0])
+            elif self.fuzzy_jaccard is not None:
+                spans = self._fuzzy_matches(tokens)
+                if spans:
+                    logger.warning("TRACESHIELD: Refusing output due to near-duplicate of high-BCI span: %s", spans[0]['span'])
+            verdicts.append(bool(spans))
+        if start is not None:
+            self._record("refuse_many", completions, sum(verdicts), start)
+        return verdicts
+
+    def explain_many(self, completions: List[List[str]]) -> List[Dict]:
+        """explain for each completion, tracing the risky windows of all of them in one batch"""
+        if not self._batchable():
+            return [self.explain(tokens) for tokens in completions]
+        start = time.perf_counter() if metrics.registry.enabled else None
+        risky_windows = self._risky_windows_many(completions)
+        traced = iter(self.tracer.trace_spans([span for spans in risky_windows for span in spans]))
+        results = []
+        for tokens, spans in zip(completions, risky_windows):
+            matches = [m for _ in spans for m in next(traced)[:self.max_matches]]
+            matches += self._fuzzy_matches(tokens, {tuple(span) for span in spans})
+            results.append(self._explanation(tokens, self._reports(matches)))
+        if start is not None:
+            self._record("explain_many", completions, sum(r["refused"] for r in results), start)
+        return results
+
+    def _record(self, op: str, completions: List[List[str]], refused: int, start: float):
+        """Latency, completion, window and refusal metrics of one check call (metrics enabled only)"""
+        registry = metrics.registry
+        registry.observe("traceshield_check_seconds", time.perf_counter() - start, op=op)
+        registry.inc("traceshield_completions_total", len(completions), op=op)
+        registry.inc("traceshield_windows_total", sum(max(0, len(t) - self.window_size + 1) for t in completions), op=op)
+        registry.inc("traceshield_refusals_total", refused, op=op)
+
+    def _reports(self, matches: List[Dict]) -> List[Dict]:
+        risky = []
+        for match in matches:
+            report = self.bci.explain_span(match['span'])
+            report.update({
+                "match_doc": match.get("doc_id", "?"),
+                "match_offset": match.get("position", -1)
+            })
+            if "jaccard" in match:
+                report["jaccard"] = match["jaccard"]  # near-duplicate: span is the corpus window, not the completion's
+            if "count" in match:
+                report.update({"match_count": match["count"], "source_docs": match["documents"]})
+            risky.append(report)
+        return risky
+
+    def detect_risky_spans(self, tokens: List[str], by_document: bool = False) -> List[Dict]:
+        """
+        BCI reports of the risky windows' matches. by_document attributes each window to up to
+        max_matches distinct source documents, adding "match_count" and "source_docs" to the
+        reports, instead of its first max_matches occurrences.
+        """
+        return self._reports(self._all_risky_matches(tokens, by_document))
+
+    def _explanation(self, tokens: List[str], risky: List[Dict]) -> Dict:
+        return {
+            "refused": len(risky) > 0,
+            "span_count": len(tokens) - self.window_size + 1,
+            "risky_count": len(risky),
+            "risky_spans": risky[:5]  # only top few for verbosity
+        }
+
+    def refuse(self, tokens: List[str]) -> bool:
+        start = time.perf_counter() if metrics.registry.enabled else None
+        refused = False
+        for match in self._risky_matches(tokens):
+            logger.warning("TRACESHIELD: Refusing output due to high-BCI span: %s", match['span'])
+            refused = True
+            break
+        if not refused and self.fuzzy_jaccard is not None:
+            fuzzy = self._fuzzy_matches(tokens)
+            if fuzzy:
+                logger.warning("TRACESHIELD: Refusing output due to near-duplicate of high-BCI span: %s", fuzzy[0]['span'])
+                refused = True
+        if start is not None:
+            self._record("refuse", [tokens], int(refused), start)
+        return refused
+
+    def session(self) -> "TraceShieldSession":
+        """Start an incremental refusal check for token-by-token generation"""
+        return TraceShieldSession(self)
+
+    def explain(self, tokens: List[str]) -> Dict:
+        start = time.perf_counter() if metrics.registry.enabled else None
+        explanation = self._explanation(tokens, self.detect_risky_spans(tokens))
+        if start is not None:
+            self._record("explain", [tokens], int(explanation["refused"]), start)
+        return explanation
+
+    def detailed_log(self, tokens: List[str]):
+        logger.info("Running TRACESHIELD diagnostic log...")
+        risky = self.detect_risky_spans(tokens, by_document=True)
+        for r in risky:
+            logger.info(f"BCI {r['total_bci']} | Span: {' '.join(r['span'])} | KL: {r['kl_divergence']} | Max Token Risk: {r['max_token_risk']} | Matched in: {r['match_doc']} @ {r['match_offset']}{_source_note(r)}")
+
+    def refusal_report(self, tokens: List[str]) -> str:
+        risky = self.detect_risky_spans(tokens, by_document=True)
+        if not risky:
+            return "✅ Output passed TRACESHIELD. No high-BCI spans detected."
+        report = ["⛔ REFUSAL TRIGGERED BY TRACESHIELD"]
+        for r in risky:
+            similarity = f" | Jaccard: {r['jaccard']:.2f}" if "jaccard" in r else ""
+            report.append(f"- Span: {' '.join(r['span'])} | BCI: {r['total_bci']} | Source: {r['match_doc']} @ {r['match_offset']}{_source_note(r)}{similarity}")
+        return "\n".join(report)
+
+
+def _source_note(report: Dict) -> str:
+    """How often the source document holds the span, out of how many documents, when listed"""
+    if "match_count" not in report:
+        return ""
+    return f" ({report['match_count']}x; {report['source_docs']} source docs)"
+
+
+class TraceShieldSession:
+    """
+    Streaming counterpart of TraceShield.refuse: push(token) checks only the window the token
+    completes, keeping the longest matching suffix and a rolling window BCI between calls.
+    After pushing tokens, push's verdict equals refuse(tokens) on the whole stream so far,
+    including near-duplicate windows when the shield is fuzzy.
+    """
+
+    def __init__(self, shield: TraceShield):
+        self.shield = shield
+        tracer = shield.tracer
+        self.matcher = tracer.suffix_matcher(shield.window_size) if hasattr(tracer, "suffix_matcher") else None
+        self.tokens: List[str] = []
+        self.risks: List[float] = []
+        self.rolling_bci = 0.0
+        self.refused = False
+        self._history: List[tuple] = []  # state before each push, for rollback
+
+    def push(self, token: str) -> Verdict:
+        shield = self.shield
+        width = shield.window_size
+        self._history.append((self.matcher.state() if self.matcher else None, self.rolling_bci, self.refused))
+        self.tokens.append(token)
+        self.risks.append(shield.bci.compute_bci([token]))
+        self.rolling_bci += self.risks[-1]
+        if len(self.risks) > width:
+            self.rolling_bci -= self.risks[-width - 1]
+        occurs = self.matcher.push(token) >= width if self.matcher else None
+        if len(self.tokens) < width:
+            return Verdict(self.refused)
+        window = self.tokens[-width:]
+        match = self._risky_match(window, occurs)
+        if match is None and shield.fuzzy_jaccard is not None:
+            fuzzy = shield._fuzzy_matches(window)
+            match = fuzzy[0] if fuzzy else None
+        if match is None:
+            return Verdict(self.refused)
+        if not self.refused:
+            logger.warning("TRACESHIELD: Refusing output due to high-BCI span: %s", match['span'])
+            if metrics.registry.enabled:
+                metrics.registry.inc("traceshield_refusals_total", op="session")
+        self.refused = True
+        return Verdict(True, window, match)
+
+    def _risky_match(self, window: List[str], occurs: Optional[bool]) -> Optional[Dict]:
+        shield = self.shield
+        if self.matcher is not None:
+            # same shortcut as TraceShield._risky_matches: exact index matches are the window itself
+            slack = ROLLING_BCI_SLACK * max(1.0, abs(shield.threshold))
+            if not occurs or self.rolling_bci <= shield.threshold - slack:
+                return None
+            if not shield.bci.high_risk(window, shield.threshold):
+                return None
+            matches = shield.tracer.trace_span(window)[:shield.max_matches]
+            return matches[0] if matches else None
+        for match in shield.tracer.trace_span(window)[:shield.max_matches]:
+            if shield.bci.high_risk(match['span'], shield.threshold):
+                return match
+        return None
+
+    def checkpoint(self) -> int:
+        """Current stream length, to pass to rollback()"""
+        return len(self.tokens)
+
+    def rollback(self, length: int):
+        """Discard every token pushed after the stream had `length` tokens"""
+        if length < len(self.tokens):
+            state, self.rolling_bci, self.refused = self._history[length]
+            if self.matcher is not None:
+                self.matcher.restore(state)
+            del self.tokens[length:], self.risks[length:], self._history[length:]
+
+    def fork(self) -> "TraceShieldSession":
+        """Independent copy sharing the shield and index, e.g. for a new beam"""
+        clone = TraceShieldSession.__new__(TraceShieldSession)
+        clone.shield = self.shield
+        clone.matcher = None
+        if self.matcher is not None:
+            clone.matcher = self.shield.tracer.suffix_matcher(self.shield.window_size)
+            clone.matcher.restore(self.matcher.state())
+        clone.tokens = list(self.tokens)
+        clone.risks = list(self.risks)
+        clone.rolling_bci = self.rolling_bci
+        clone.refused = self.refused
+        clone._history = list(self._history)
+        return clone
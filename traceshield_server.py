@@ -0,0 +1,318 @@
+# tracealign/traceshield_server.py — Asyncio TraceShield Service with Micro-Batched Checks
+
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracealign import metrics
+from tracealign.traceshield import TraceShield
+from tracealign.utils import soft_tokenize, json_default
+
+logger = logging.getLogger("tracealign.server")
+
+LATENCY_WINDOW = 10000  # recent requests kept for the latency percentiles in /stats
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class ServerBusy(Exception):
+    """More requests are waiting than max_pending allows; the client should retry later"""
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent check/explain requests into batches for TraceShield.refuse_many and
+    explain_many. A batch is closed when it holds max_batch requests or max_wait has passed
+    since its first request, and runs on a worker thread so the event loop keeps accepting
+    (and batching) requests meanwhile. When the server tracks open connections, each of which
+    has at most one request in flight, a batch holding one request per connection is closed at
+    once, so a lone client never waits for company. At most max_pending requests wait; beyond
+    that, submit raises ServerBusy instead of letting the queue and latency grow without bound.
+    """
+
+    def __init__(self, shield: TraceShield, max_batch: int = 64, max_wait_ms: float = 2.0, max_pending: int = 1024):
+        self.shield = shield
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="traceshield")
+        self._task: Optional[asyncio.Task] = None
+        self.connections: Optional[int] = None  # open client connections, when the server counts them
+        self.latencies_ms = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {"requests": 0, "batches": 0, "batched_requests": 0, "rejected": 0, "errors": 0}
+
+    def start(self):
+        self.queue = asyncio.Queue(self.max_pending)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, kind: str, tokens: List[str]):
+        """Result of shield.refuse (kind="check") or shield.explain (kind="explain") on tokens"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((kind, tokens, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise ServerBusy(f"{self.max_pending} requests already pending")
+        self.counters["requests"] += 1
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch and (self.connections is None or len(batch) < self.connections):
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _evaluate(self, batch: list) -> list:
+        results = [None] * len(batch)
+        for kind, fn in (("check", self.shield.refuse_many), ("explain", self.shield.explain_many)):
+            positions = [i for i, item in enumerate(batch) if item[0] == kind]
+            if positions:
+                for i, result in zip(positions, fn([batch[i][1] for i in positions])):
+                    results[i] = result
+        return results
+
+    def _evaluate_each(self, batch: list) -> list:
+        """_evaluate one request at a time, so a request that fails gets its own exception as its result"""
+        results = []
+        for item in batch:
+            try:
+                results.extend(self._evaluate([item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            self.counters["batches"] += 1
+            self.counters["batched_requests"] += len(batch)
+            try:
+                results = await loop.run_in_executor(self._executor, self._evaluate, batch)
+            except Exception:
+                # one bad request must not fail its batch-mates: retry them separately
+                logger.exception(f"TraceShield batch of {len(batch)} failed, retrying its requests one at a time")
+                results = await loop.run_in_executor(self._executor, self._evaluate_each, batch)
+            now = time.perf_counter()
+            registry = metrics.registry
+            if registry.enabled:
+                registry.observe("server_batch_size", len(batch), metrics.COUNT_BUCKETS)
+            for (kind, _, future, start), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.counters["errors"] += 1
+                    if not future.done():
+                        future.set_exception(result)
+                    continue
+                self.latencies_ms.append((now - start) * 1e3)
+                if registry.enabled:
+                    registry.observe("server_request_seconds", now - start, kind=kind)
+                if not future.done():  # the client may have disconnected
+                    future.set_result(result)
+
+    def stats(self) -> Dict:
+        stats = dict(self.counters, pending=self.queue.qsize() if self.queue is not None else 0, connections=self.connections or 0,
+                     mean_batch=self.counters["batched_requests"] / max(1, self.counters["batches"]))
+        if self.latencies_ms:
+            p50, p95, p99 = np.percentile(self.latencies_ms, [50, 95, 99]).tolist()
+            stats.update({"p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3)})
+        cache = getattr(self.shield.tracer, "cache", None)
+        if cache is not None and hasattr(cache, "stats"):
+            stats["cache"] = cache.stats()
+        return stats
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """(method, path, headers, body) of the next HTTP/1.1 request on a connection, or None at EOF"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def _request_tokens(request, tokenizer_fn: Callable[[str], List[str]]) -> Optional[List[str]]:
+    """Tokens of a /check or /explain request body, or None when it is malformed"""
+    if not isinstance(request, dict):
+        return None
+    if "tokens" in request:
+        tokens = request["tokens"]
+        return tokens if isinstance(tokens, list) and all(isinstance(t, str) for t in tokens) else None
+    text = request.get("text")
+    return tokenizer_fn(text) if isinstance(text, str) else None
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool = True):
+    """payload is sent as JSON, or as plain text when it is a str (the Prometheus /metrics page)"""
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), "text/plain; version=0.0.4"
+    else:
+        body, content_type = json.dumps(payload, default=json_default).encode(), "application/json"
+    writer.write(
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+    )
+
+
+class TraceShieldServer:
+    """
+    Local HTTP service around one TraceShield, so every process on a host shares one loaded
+    index. POST /check and POST /explain take {"tokens": [...]} or {"text": "..."} (tokenized
+    with tokenizer_fn); GET /health and GET /stats report liveness and batching/latency counters,
+    and GET /metrics serves the metrics registry in Prometheus text format while metrics are
+    enabled. A malformed body answers 400 and a full queue 503, so callers can fall back or retry.
+    """
+
+    def __init__(self, shield: TraceShield, tokenizer_fn: Callable[[str], List[str]] = soft_tokenize,
+                 max_batch: int = 64, max_wait_ms: float = 2.0, max_pending: int = 1024):
+        self.shield = shield
+        self.tokenizer_fn = tokenizer_fn
+        self.batcher = MicroBatcher(shield, max_batch, max_wait_ms, max_pending)
+        self.started = time.time()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, unix_socket: Optional[str] = None) -> asyncio.AbstractServer:
+        self.batcher.start()
+        if unix_socket:
+            self._server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"TraceShield service listening on {unix_socket or self.address()}")
+        return self._server
+
+    def address(self) -> Tuple[str, int]:
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, object]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "uptime_s": round(time.time() - self.started, 1),
+                         "window_size": self.shield.window_size, "threshold": self.shield.threshold}
+        if method == "GET" and path == "/stats":
+            return 200, self.batcher.stats()
+        if method == "GET" and path == "/metrics" and metrics.registry.enabled:
+            return 200, metrics.registry.to_prometheus()
+        if method != "POST" or path not in ("/check", "/explain"):
+            return 404, {"error": f"no route for {method} {path}"}
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        tokens = _request_tokens(request, self.tokenizer_fn)
+        if tokens is None:
+            return 400, {"error": "expected a JSON object with 'tokens' (a list of strings) or 'text' (a string)"}
+        try:
+            result = await self.batcher.submit(path[1:], tokens)
+        except ServerBusy as e:
+            return 503, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": str(e)}
+        return 200, {"refused": result} if path == "/check" else result
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.batcher.connections = (self.batcher.connections or 0) + 1
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._dispatch(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.batcher.connections -= 1
+            writer.close()
+
+
+class TraceShieldClient:
+    """Minimal keep-alive client for TraceShieldServer, one request at a time per connection"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, unix_socket: Optional[str] = None):
+        self.host, self.port, self.unix_socket = host, port, unix_socket
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        if self.unix_socket:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix_socket)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method: str, path: str, payload: Optional[Dict] = None) -> Tuple[int, object]:
+        if self.writer is None:
+            await self.connect()
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: tracealign\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        status = int(status_line.split()[1])
+        length, content_type = 0, "application/json"
+        while True:
+            header = await self.reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+            elif name.strip().lower() == "content-type":
+                content_type = value.strip()
+        body = await self.reader.readexactly(length)
+        return status, json.loads(body) if content_type == "application/json" else body.decode()
+
+    async def check(self, tokens: List[str]) -> bool:
+        status, payload = await self.request("POST", "/check", {"tokens": tokens})
+        if status != 200:
+            raise RuntimeError(f"TraceShield service returned {status}: {payload.get('error')}")
+        return payload["refused"]
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
@@ -1,90 +1,233 @@
 # tracealign/utils.py — Extended Utility Layer for I/O, Logging, Token Normalization, Token Stats
- 
+
 import os
+import gzip
 import json
 import logging
 import re
-from typing import List, Dict, Optional
- 
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
+
+import numpy as np
+
+from tracealign.traceindex import TokenStreamWriter
+
 logger = logging.getLogger("tracealign.utils")
-logger.setLevel(logging.DEBUG)
- 
-formatter = logging.Formatter('[%(asctime)s] %(levelname)s - %(message)s')
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
- 
- 
+
+LOG_FORMAT = '[%(asctime)s] %(levelname)s - %(message)s'
+
+
+def setup_logging(level: str = "INFO"):
+    """
+    Console logging for the tracealign loggers, called by the scripts. Library modules never
+    configure logging themselves, so debug calls in hot loops are dropped at the level check.
+    """
+    root = logging.getLogger("tracealign")
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    if not any(getattr(h, "_tracealign", False) for h in root.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler._tracealign = True
+        root.addHandler(handler)
+
+
 def soft_tokenize(text: str) -> List[str]:
     return re.findall(r"\w+|[^\w\s]", text.lower())
- 
- 
+
+
 def load_token_probs(path: str) -> Dict[str, float]:
-	logger.info(f"Loading token probability distribution from {path} ...")
-	with open(path) as f:
-    	probs = json.load(f)
-	logger.info(f"Loaded {len(probs)} token probabilities.")
-	return probs
- 
- 
+    logger.info(f"Loading token probability distribution from {path} ...")
+    with open(path) as f:
+        probs = json.load(f)
+    logger.info(f"Loaded {len(probs)} token probabilities.")
+    return probs
+
+
+def json_default(value):
+    """json.dumps default for the numpy scalars that index and BCI results may carry"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def open_text(path: str):
+    """Open a text file for reading, transparently decompressing .gz files"""
+    return gzip.open(path, "rt") if path.endswith(".gz") else open(path, "r")
+
+
+def iter_jsonl(path: str) -> Iterator[Dict]:
+    """Stream records from a (optionally gzip'd) JSONL file"""
+    with open_text(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
 def load_jsonl(path: str) -> List[Dict]:
-	logger.info(f"Loading JSONL file: {path}")
-	data = []
-	with open(path, "r") as f:
-    	for line in f:
-        	data.append(json.loads(line))
-	logger.info(f"Loaded {len(data)} records from {path}.")
-	return data
- 
- 
+    logger.info(f"Loading JSONL file: {path}")
+    data = list(iter_jsonl(path))
+    logger.info(f"Loaded {len(data)} records from {path}.")
+    return data
+
+
 def save_jsonl(path: str, records: List[Dict]):
-	logger.info(f"Saving {len(records)} records to {path} ...")
-	with open(path, "w") as f:
-    	for r in records:
-     	   f.write(json.dumps(r) + "\n")
-	logger.info("Save complete.")
- 
- 
+    logger.info(f"Saving {len(records)} records to {path} ...")
+    with open(path, "w") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+    logger.info("Save complete.")
+
+
+def iter_corpus(dir_path: str) -> Iterator[Dict[str, str]]:
+    """
+    Stream documents from .txt/.jsonl files (optionally .gz) in a directory, file by file in
+    name order; a .txt file is one document named after the file
+    """
+    for filename in sorted(os.listdir(dir_path)):
+        path = os.path.join(dir_path, filename)
+        name = filename[:-3] if filename.endswith(".gz") else filename
+        if name.endswith(".txt"):
+            with open_text(path) as f:
+                yield {"id": filename, "text": f.read()}
+        elif name.endswith(".jsonl"):
+            logger.debug("Streaming JSONL file: %s", path)
+            yield from iter_jsonl(path)
+
+
 def read_corpus(dir_path: str) -> List[Dict[str, str]]:
-	"""
-	Loads all .txt/.jsonl files from a directory as documents
-	"""
-	corpus = []
-	for filename in os.listdir(dir_path):
-    	if filename.endswith(".txt"):
-        	with open(os.path.join(dir_path, filename), "r") as f:
-            	corpus.append({"id": filename, "text": f.read()})
-    	elif filename.endswith(".jsonl"):
-        	for record in load_jsonl(os.path.join(dir_path, filename)):
-            	corpus.append(record)
-	logger.info(f"Loaded corpus from {dir_path} with {len(corpus)} documents.")
-	return corpus
- 
- 
-def tokenize_corpus(corpus: List[Dict[str, str]], tokenizer_fn=soft_tokenize) -> List[Dict]:
-	tokenized = []
-	for doc in corpus:
-    	tokens = tokenizer_fn(doc["text"])
-    	tokenized.append({"id": doc["id"], "tokens": tokens})
-	logger.info(f"Tokenized {len(tokenized)} documents.")
-	return tokenized
- 
- 
-def compute_token_frequencies(corpus: List[Dict[str, str]]) -> Dict[str, int]:
-	freq = {}
-	for doc in corpus:
-    	tokens = soft_tokenize(doc["text"])
-    	for tok in tokens:
-        	freq[tok] = freq.get(tok, 0) + 1
-	return freq
- 
- 
+    """
+    Loads all .txt/.jsonl files from a directory as documents
+    """
+    corpus = list(iter_corpus(dir_path))
+    logger.info(f"Loaded corpus from {dir_path} with {len(corpus)} documents.")
+    return corpus
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Consecutive lists of size items (the last one shorter), pulled lazily from any iterable"""
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(fn: Callable, chunks: Iterable, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                initializer: Optional[Callable] = None, initargs: Tuple = ()) -> Iterator:
+    """
+    fn over every chunk in a process pool, yielding results in input order. At most max_pending
+    chunks (default 2 per worker) are in flight, so memory stays bounded however long the input
+    is. workers=1 maps in-process; fn must be picklable otherwise. initializer(*initargs) runs
+    once per worker (or once in-process), e.g. to memory-map an index.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, chunks)
+        return
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _tokenize_chunk(tokenizer_fn: Callable, docs: List[Dict[str, str]]) -> List[Dict]:
+    return [{"id": doc["id"], "tokens": tokenizer_fn(doc["text"])} for doc in docs]
+
+
+def _encode_chunk(tokenizer_fn: Callable, docs: List[Dict[str, str]]) -> Tuple[List[str], List[str], np.ndarray, List[int]]:
+    """Tokenize a chunk into (doc ids, chunk vocab, chunk-local token ids, document lengths)"""
+    local: Dict[str, int] = {}
+    ids, lengths = [], []
+    for doc in docs:
+        tokens = tokenizer_fn(doc["text"])
+        ids.extend(local.setdefault(t, len(local)) for t in tokens)
+        lengths.append(len(tokens))
+    return [doc["id"] for doc in docs], list(local), np.array(ids, dtype=np.int32), lengths
+
+
+def iter_tokenized(docs: Iterable[Dict[str, str]], tokenizer_fn=soft_tokenize, workers: Optional[int] = None,
+                   chunk_size: int = 256) -> Iterator[Dict]:
+    """Stream {"id", "tokens"} records, tokenizing chunk_size documents per task in a process pool"""
+    for chunk in ordered_map(partial(_tokenize_chunk, tokenizer_fn), chunked(docs, chunk_size), workers):
+        yield from chunk
+
+
+def tokenize_corpus(corpus: List[Dict[str, str]], tokenizer_fn=soft_tokenize, workers: int = 1) -> List[Dict]:
+    tokenized = list(iter_tokenized(corpus, tokenizer_fn, workers))
+    logger.info(f"Tokenized {len(tokenized)} documents.")
+    return tokenized
+
+
+def compute_token_frequencies(corpus: Iterable[Dict[str, str]], workers: int = 1) -> Dict[str, int]:
+    freq = Counter()
+    for doc in iter_tokenized(corpus, workers=workers):
+        freq.update(doc["tokens"])
+    return dict(freq)
+
+
+def ingest_corpus(dir_path: str, output_dir: str, tokenizer_fn=soft_tokenize, workers: Optional[int] = None,
+                  chunk_size: int = 256, vocab: Optional[List[str]] = None) -> Dict:
+    """
+    Single streaming pass over a corpus directory: documents are tokenized in a process pool
+    and written in order as an integer token stream with per-token counts (TokenStreamWriter),
+    ready for SuffixArrayIndex.from_token_stream. Memory is bounded by the chunks in flight
+    plus the vocabulary and per-document ids. vocab pre-interns an ID-aligned vocabulary.
+    """
+    writer = TokenStreamWriter(output_dir, vocab)
+    encode = partial(_encode_chunk, tokenizer_fn)
+    for i, chunk in enumerate(ordered_map(encode, chunked(iter_corpus(dir_path), chunk_size), workers)):
+        writer.write_chunk(*chunk)
+        if (i + 1) % 100 == 0:
+            logger.info(f"Ingested {len(writer.doc_ids)} documents, {writer.n_tokens} stream tokens")
+    header = writer.close()
+    logger.info(f"Ingested {header['n_docs']} documents ({header['n_tokens']} tokens, "
+                f"{header['vocab_size']} distinct) from {dir_path} into {output_dir}.")
+    return header
+
+
+class HFTokenizerFn:
+    """Picklable tokenizer_fn producing a Hugging Face tokenizer's token strings; loaded lazily in each worker"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._tokenizer = None
+
+    def __getstate__(self):
+        return {"name": self.name, "_tokenizer": None}
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.name)
+        return self._tokenizer
+
+    def vocab(self) -> List[str]:
+        tokenizer = self.tokenizer
+        return tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+    def __call__(self, text: str) -> List[str]:
+        ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        return self.tokenizer.convert_ids_to_tokens(ids)
+
+
 def normalize_token_frequencies(freq: Dict[str, int]) -> Dict[str, float]:
-	total = sum(freq.values())
-	return {k: v / total for k, v in freq.items()}
- 
- 
+    total = sum(freq.values())
+    return {k: v / total for k, v in freq.items()}
+
+
 def save_token_distribution(path: str, freq: Dict[str, float]):
-	with open(path, "w") as f:
-    	json.dump(freq, f, indent=2)
-	logger.info(f"Saved token distribution to {path}.")
+    with open(path, "w") as f:
+        json.dump(freq, f, indent=2)
+    logger.info(f"Saved token distribution to {path}.")